@@ -3,17 +3,25 @@
 Flask app for Railway/Render deployment with Telegram webhooks.
 """
 
-from flask import Flask, request, jsonify
+from utils.startup import STARTUP
+STARTUP.track_imports()
+
+from flask import Flask, Response, request, jsonify
 import logging
-import requests
 import os
 import time
-import json
-import asyncio
 import threading
+from utils.batch_coordinator import CoordinatorClient, RemoteContentIndex, RemoteDeduplicator, RemoteHealthProbe
+from utils.batch_manager import WEBHOOK_SPOOL_PATH, create_batch_manager
+from utils.dedup import create_content_index, create_deduplicator
+from utils.health_probe import GasHealthProbe
+from utils.http_client import get_http_client
 from utils.logger import setup_logger
-from telegram import Update
-from telegram.ext import Application
+from utils.metrics import REGISTRY
+from utils.pipeline_metrics import WEBHOOK_SECONDS, WEBHOOK_SHED, register_pipeline_gauges
+from utils.telegram_updates import parse_update
+
+STARTUP.finish_imports()
 
 app = Flask(__name__)
 
@@ -21,19 +29,30 @@ app = Flask(__name__)
 WEB_APP_URL = os.getenv('GOOGLE_WEB_APP_URL')
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 APP_VERSION = "2026-02-16-batching-v1"
-setup_logger(logging.INFO)
+# Behind a batch coordinator, the coordinator rotates the shared log file
+setup_logger(logging.INFO, rotate=not os.getenv('BATCH_COORDINATOR_SOCKET'))
 logger = logging.getLogger(__name__)
 
-# Initialize Telegram Application (Optional - only if needed for advanced extraction)
+# Telegram Application (Optional - only if needed for advanced extraction).
+# /webhook reads raw JSON, so python-telegram-bot is only imported on first use.
 tg_application = None
-if BOT_TOKEN:
-    try:
-        tg_application = Application.builder().token(BOT_TOKEN).build()
-        logger.info("Telegram Application initialized successfully")
-    except Exception as e:
-        logger.error(f"Failed to initialize Telegram Application: {e}")
-        # Don't crash the whole app if TG init fails
-        tg_application = None
+tg_application_lock = threading.Lock()
+
+def get_tg_application():
+    """Build the Telegram Application on first use; returns None if it is unavailable."""
+    global tg_application
+    if not BOT_TOKEN:
+        return None
+    with tg_application_lock:
+        if tg_application is None:
+            try:
+                from telegram.ext import Application
+                tg_application = Application.builder().token(BOT_TOKEN).build()
+                logger.info("Telegram Application initialized successfully")
+            except Exception as e:
+                # Don't crash the whole app if TG init fails
+                logger.error(f"Failed to initialize Telegram Application: {e}")
+        return tg_application
 
 # Log startup info
 logger.info("Starting Flask app for Railway")
@@ -44,142 +63,50 @@ if WEB_APP_URL:
 else:
     logger.error("GOOGLE_WEB_APP_URL environment variable not found!")
 
-BATCH_MAX_SIZE = 100
-BATCH_MAX_WAIT_SEC = 5.0
-
-class BatchManager:
-    def __init__(self, web_app_url):
-        self.web_app_url = web_app_url
-        self.lock = threading.Lock()
-        self.buffer = []
-        self.chat_ids = set()
-        self.timer = None
-        self.batch_id = None
-
-    def start_timer(self):
-        if self.timer:
-            return
-        self.timer = threading.Timer(BATCH_MAX_WAIT_SEC, self.flush_and_finalize)
-        self.timer.daemon = True
-        self.timer.start()
-
-    def add_message(self, data):
-        with self.lock:
-            if not self.batch_id:
-                self.batch_id = str(int(time.time() * 1000))
-            self.buffer.append(data)
-            chat_id = data.get('chat_id')
-            if chat_id:
-                self.chat_ids.add(chat_id)
-            if len(self.buffer) >= BATCH_MAX_SIZE:
-                self._finalize_locked()
-            else:
-                self.start_timer()
-
-    def flush_and_finalize(self):
-        with self.lock:
-            self._finalize_locked()
-
-    def _finalize_locked(self):
-        if not self.buffer or not self.batch_id:
-            return
-        expected = len(self.buffer)
-        payload = {
-            "mode": "batch_ingest",
-            "batch_id": self.batch_id,
-            "messages": list(self.buffer),
-            "transmission_complete": True,
-            "expected_count": expected
-        }
-        try:
-            resp = requests.post(self.web_app_url, json=payload, timeout=60, headers={'Content-Type': 'application/json'})
-            logger.info(f"Finalize ack: {resp.status_code} {resp.text[:200]}")
-            try:
-                data = resp.json()
-            except Exception:
-                data = {}
-            status = data.get("status")
-            ack = data.get("ack")
-            processed = data.get("processed_messages")
-            rollback = data.get("rollback")
-            for chat_id in list(self.chat_ids):
-                try:
-                    if not BOT_TOKEN:
-                        continue
-                    text = f"Batch {self.batch_id}: status={status}, ack={ack}, processed={processed}, rollback={rollback}"
-                    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-                    requests.post(url, json={"chat_id": chat_id, "text": text}, timeout=10)
-                except Exception as e:
-                    logger.error(f"Error sending Telegram status: {e}")
-        except Exception as e:
-            logger.error(f"Batch finalize error: {e}")
-        finally:
-            self.buffer = []
-            self.batch_id = None
-            self.chat_ids = set()
-            if self.timer:
-                try:
-                    self.timer.cancel()
-                except:
-                    pass
-            self.timer = None
+# Set by gunicorn.conf.py when several workers share one batch coordinator process
+BATCH_COORDINATOR_SOCKET = os.getenv('BATCH_COORDINATOR_SOCKET')
 
 batch_manager = None
+batch_manager_lock = threading.Lock()
 
-def extract_forward_data(message):
-    """Extract data from forwarded Telegram message."""
-    forward_origin = message.get('forward_origin', {})
-
-    # Base data
-    data = {
-        'id': str(message.get('message_id', '')),
-        'content': message.get('text', '') or message.get('caption', ''),
-        'has_media': bool(message.get('photo') or message.get('document') or message.get('video')),
-        'media_type': get_media_type(message),
-        'forwarded_by': message.get('from', {}).get('username', 'Unknown'),
-        'forwarded_at': message.get('date', ''),
-        'channel': 'telegram',
-        'channel_username': 'Unknown',
-        'author': 'Unknown',
-        'timestamp': None,
-        'url': '',
-        'chat_id': message.get('chat', {}).get('id')
-    }
-
-    # Extract origin information
-    origin_type = forward_origin.get('type')
-    if origin_type == 'channel':
-        chat = forward_origin.get('chat', {})
-        data['channel_username'] = f"@{chat.get('username', '')}" if chat.get('username') else chat.get('title', 'Channel')
-        data['author'] = chat.get('title', 'Channel')
-        data['timestamp'] = forward_origin.get('date', '')
-        if chat.get('username'):
-            data['url'] = f"https://t.me/{chat['username']}/{forward_origin.get('message_id', '')}"
+if BATCH_COORDINATOR_SOCKET:
+    logger.info(f"Using batch coordinator at {BATCH_COORDINATOR_SOCKET}")
+    coordinator = CoordinatorClient(BATCH_COORDINATOR_SOCKET)
+    deduplicator = RemoteDeduplicator(coordinator)
+    content_index = RemoteContentIndex(coordinator)
+else:
+    coordinator = None
+    deduplicator = create_deduplicator()
+    content_index = create_content_index()
+    register_pipeline_gauges(lambda: batch_manager, deduplicator)
+
+def get_batch_manager():
+    """Create the shared BatchManager (and its spool) on first use."""
+    global batch_manager
+    if coordinator:
+        return coordinator
+    with batch_manager_lock:
+        if batch_manager is None:
+            batch_manager = create_batch_manager(WEB_APP_URL, BOT_TOKEN)
+        return batch_manager
 
-    elif origin_type == 'user':
-        sender = forward_origin.get('sender_user', {})
-        if sender:
-            first_name = sender.get('first_name', '')
-            last_name = sender.get('last_name', '')
-            username = sender.get('username', '')
-            data['author'] = f"{first_name} {last_name}".strip() or username or 'User'
-            data['timestamp'] = forward_origin.get('date', '')
+if WEB_APP_URL and WEBHOOK_SPOOL_PATH and not coordinator:
+    # Open the spool now so messages left over from the last run are replayed
+    try:
+        get_batch_manager()
+    except Exception as e:
+        logger.error(f"Failed to replay webhook spool: {e}")
 
-    return data
+# /health/detailed reports Apps Script reachability from this background probe;
+# with a coordinator, its single probe answers for every worker
+gas_probe = None
+if coordinator:
+    gas_probe = RemoteHealthProbe(coordinator)
+elif WEB_APP_URL:
+    gas_probe = GasHealthProbe(WEB_APP_URL)
+    gas_probe.start()
 
-def get_media_type(message):
-    """Get media type from message."""
-    if message.get('photo'):
-        return 'photo'
-    elif message.get('document'):
-        return 'document'
-    elif message.get('video'):
-        return 'video'
-    elif message.get('audio'):
-        return 'audio'
-    elif message.get('voice'):
-        return 'voice'
-    return None
+STARTUP.mark('app_loaded')
 
 def send_to_google_apps_script(data):
     """Send data to Google Apps Script."""
@@ -188,17 +115,13 @@ def send_to_google_apps_script(data):
         return False
 
     try:
-        logger.info(f"Sending data to Google Apps Script: {WEB_APP_URL}")
         # Prefer fast ingestion by default: only write MessageData on webhook
         if 'processing_mode' not in data:
             data['processing_mode'] = 'message_only'
-        logger.info(f"Data: {data}")
+        # Per-message record: lazy %-formatting, so nothing is built unless DEBUG is on
+        logger.debug("Queueing message for Apps Script: %s", data)
 
-        global batch_manager
-        if batch_manager is None:
-            batch_manager = BatchManager(WEB_APP_URL)
-
-        batch_manager.add_message(data)
+        get_batch_manager().add_message(data)
         return True
     except Exception as e:
         logger.error(f"Error sending to Google Apps Script: {str(e)}")
@@ -207,47 +130,37 @@ def send_to_google_apps_script(data):
 @app.route('/webhook', methods=['POST'])
 def telegram_webhook():
     """Handle Telegram webhook."""
+    started = time.perf_counter()
     try:
         update_json = request.get_json()
         
         if not update_json:
             return jsonify({'status': 'error', 'message': 'No JSON data'}), 400
 
-        # Handle Telegram Update object
-        if 'message' in update_json:
-            message = update_json['message']
-            
-            # 1. Process as forwarded message (original logic)
-            if 'forward_origin' in message:
-                forward_data = extract_forward_data(message)
-                success = send_to_google_apps_script(forward_data)
-                if success:
-                    return jsonify({'status': 'success', 'source': 'forward'})
-            
-            # 2. Process as direct message (if text exists but not forwarded)
-            elif 'text' in message:
-                # Minimal data for direct messages
-                direct_data = {
-                    'id': str(message.get('message_id')),
-                    'content': message.get('text'),
-                    'channel_username': 'DirectMessage',
-                    'author': message.get('from', {}).get('username', 'User'),
-                    'timestamp': message.get('date'),
-                    'channel': 'telegram'
-                }
-                success = send_to_google_apps_script(direct_data)
-                if success:
-                    return jsonify({'status': 'success', 'source': 'direct'})
+        # Shed load before de-duplication, so Telegram's redelivery is not dropped as a duplicate
+        if WEB_APP_URL and get_batch_manager().is_overloaded():
+            WEBHOOK_SHED.inc()
+            return jsonify({'status': 'overloaded'}), 503
 
-        return jsonify({'status': 'ignored'})
+        data, result, claims = parse_update(update_json, deduplicator, content_index)
+        if data is not None and not send_to_google_apps_script(data):
+            # Not accepted: let Telegram's redelivery through again
+            claims.release()
+            result = {'status': 'ignored'}
+        return jsonify(result)
 
     except Exception as e:
         logger.error(f"Webhook error: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
+    finally:
+        WEBHOOK_SECONDS.observe(time.perf_counter() - started)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Simple health check endpoint for Railway."""
+    if 'first_health' not in STARTUP.milestones:
+        STARTUP.mark('first_health')
+        STARTUP.log_report()
     return jsonify({
         'status': 'healthy',
         'service': 'telegram-webhook',
@@ -255,25 +168,37 @@ def health_check():
         'version': APP_VERSION
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus text-format metrics for the webhook pipeline.
+
+    With a batch coordinator, batch and Apps Script metrics come from the
+    coordinator and cover the whole host, but the ``webhook_*`` metrics are
+    recorded by each worker and only cover the worker that answered the
+    scrape.
+    """
+    if coordinator:
+        text = REGISTRY.render(skip_prefixes=('batch_', 'gas_')) + coordinator.metrics_text()
+    else:
+        text = REGISTRY.render()
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
 @app.route('/health/detailed', methods=['GET'])
 def detailed_health_check():
     """Detailed health check for debugging."""
     try:
-        # Test Google Apps Script connectivity
-        gas_status = 'unknown'
-        if WEB_APP_URL:
-            try:
-                # Use a very short timeout for the detailed check
-                test_response = requests.get(f'{WEB_APP_URL}?action=health', timeout=2)
-                gas_status = 'connected' if test_response.status_code == 200 else 'error'
-            except:
-                gas_status = 'unreachable'
-
         return jsonify({
             'status': 'healthy',
             'service': 'telegram-webhook',
-            'google_apps_script': gas_status,
+            'google_apps_script': gas_probe.status() if gas_probe else 'unknown',
+            'google_apps_script_probe': gas_probe.stats() if gas_probe else None,
             'web_app_url': bool(WEB_APP_URL),
+            'http_pool': get_http_client().stats(),
+            'dedup': deduplicator.stats(),
+            'content_index': content_index.stats(),
+            'delivery': get_batch_manager().delivery_stats() if WEB_APP_URL else None,
+            'startup': STARTUP.report(),
             'version': APP_VERSION,
             'timestamp': int(time.time())
         })
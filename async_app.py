@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+Asyncio-native webhook server (aiohttp) with the same routes as app.py.
+
+Each update is a coroutine rather than a thread, so one process can hold
+thousands of in-flight updates while batches are sent to Apps Script with
+an async HTTP client. Rows are built by utils.telegram_updates, exactly as
+in the Flask app.
+
+Run with:
+    python async_app.py
+or under gunicorn:
+    gunicorn async_app:create_app --worker-class aiohttp.GunicornWebWorker --bind 0.0.0.0:$PORT
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+
+import aiohttp
+from aiohttp import web
+
+from utils.batch_manager import (
+    BATCH_BREAKER_FAILURES, BATCH_BREAKER_RESET_SEC, BATCH_MAX_ERROR_ATTEMPTS, BATCH_MAX_PAYLOAD_BYTES,
+    BATCH_MAX_SIZE, BATCH_MAX_WAIT_SEC, BATCH_MIN_SIZE, BATCH_MIN_WAIT_SEC, BATCH_PAYLOAD_FORMAT,
+    BATCH_RETRY_BASE_SEC, BATCH_RETRY_MAX_SEC, BATCH_SEND_QUEUE_SIZE, BATCH_SHED_THRESHOLD,
+    BATCH_TARGET_LATENCY_SEC, WEBHOOK_DEAD_LETTER_PATH, WEBHOOK_SPOOL_PATH
+)
+from utils.dedup import create_content_index, create_deduplicator
+from utils.delivery import RETRY, SPLIT, BatchDelivery, BatchFactory, CircuitBreaker
+from utils.flush_policy import AdaptiveFlushPolicy
+from utils.logger import setup_logger
+from utils.media_groups import MEDIA_GROUP_WINDOW_SEC, MediaGroupCoalescer
+from utils.metrics import REGISTRY
+from utils.notifier import BatchNotifier
+from utils.pipeline_metrics import WEBHOOK_SECONDS, WEBHOOK_SHED, register_pipeline_gauges
+from utils.spool import DeadLetterFile, MessageSpool
+from utils.telegram_updates import parse_update
+
+WEB_APP_URL = os.getenv('GOOGLE_WEB_APP_URL')
+BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+APP_VERSION = "2026-02-16-batching-v1"
+setup_logger(logging.INFO)
+logger = logging.getLogger(__name__)
+
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '16'))
+
+class AsyncBatchManager:
+    """
+    Event-loop counterpart of utils.batch_manager.BatchManager.
+
+    Webhook coroutines append to the buffer; full batches (or the buffer
+    when the flush timer fires) go through a bounded ``asyncio.Queue`` to a
+    single sender task that posts them with ``aiohttp``. Spool appends are
+    written without blocking the loop, and waiting coroutines share one
+    fsync through a background waiter.
+
+    Batches are cut by the same ``BatchFactory`` and their replies handled
+    by the same ``BatchDelivery`` as in the threaded manager, so retry,
+    circuit-breaker and load-shedding rules are identical; buffered
+    messages are not spilled to disk. Album parts are coalesced into one
+    row the same way too. There is a single lane (no interactive fast
+    path), but batches are still taken round-robin across chats.
+    """
+
+    def __init__(self, web_app_url, spool=None, notifier=None, policy=None, breaker=None, media_groups=None,
+                 dead_letters=None):
+        self.web_app_url = web_app_url
+        self.spool = spool
+        self.notifier = notifier
+        self.dead_letters = dead_letters
+        self.breaker = breaker or CircuitBreaker(
+            failure_threshold=BATCH_BREAKER_FAILURES,
+            reset_timeout=BATCH_BREAKER_RESET_SEC
+        )
+        self.policy = policy or AdaptiveFlushPolicy(
+            min_size=BATCH_MIN_SIZE,
+            max_size=BATCH_MAX_SIZE,
+            min_wait=BATCH_MIN_WAIT_SEC,
+            max_wait=BATCH_MAX_WAIT_SEC,
+            target_latency=BATCH_TARGET_LATENCY_SEC,
+            max_payload_bytes=BATCH_MAX_PAYLOAD_BYTES
+        )
+        if media_groups is None and MEDIA_GROUP_WINDOW_SEC > 0:
+            media_groups = MediaGroupCoalescer()
+        self.media_groups = media_groups
+        self.media_group_handle = None
+        self.batches = BatchFactory()
+        self.delivery = BatchDelivery(self.breaker, self.policy, spool=spool, notifier=notifier,
+                                      dead_letters=dead_letters, payload_format=BATCH_PAYLOAD_FORMAT,
+                                      retry_base=BATCH_RETRY_BASE_SEC, retry_max=BATCH_RETRY_MAX_SEC,
+                                      max_error_attempts=BATCH_MAX_ERROR_ATTEMPTS)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.backlogged = False
+        self.flush_handle = None
+        self.in_flight_since = None
+        self.queued_since = []
+        self.send_queue = None
+        self.sender_task = None
+        self.session = None
+        self.sync_waiters = []
+        self.sync_task = None
+        self.stopping = None
+
+    async def start(self):
+        self.stopping = asyncio.Event()
+        self.send_queue = asyncio.Queue(maxsize=BATCH_SEND_QUEUE_SIZE)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_MAXSIZE),
+            timeout=aiohttp.ClientTimeout(total=60, connect=5)
+        )
+        self.sender_task = asyncio.create_task(self._sender_loop())
+        if self.spool:
+            pending = self.spool.pending()
+            if pending:
+                logger.info(f"Replaying {len(pending)} spooled messages")
+                for seq, data in pending:
+                    self._accept([seq], data)
+                self._handoff()
+                self._schedule_flush()
+
+    async def stop(self):
+        """Send everything still buffered (one attempt per batch) and release resources."""
+        self.stopping.set()
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.media_group_handle:
+            self.media_group_handle.cancel()
+            self.media_group_handle = None
+        if self.media_groups:
+            for seqs, data, first_arrival in self.media_groups.take_due(force=True):
+                self._append(seqs, data, first_arrival)
+        while self.buffer:
+            await self._put_batch(self._take_batch())
+        await self.send_queue.join()
+        self.sender_task.cancel()
+        await self.session.close()
+        if self.spool:
+            self.spool.close()
+        if self.dead_letters:
+            self.dead_letters.close()
+        if self.notifier:
+            self.notifier.close()
+
+    async def add_message(self, data):
+        seq = await self._spool(data) if self.spool else None
+        self.policy.record_arrival()
+        self._accept([seq] if seq is not None else [], data)
+        self._handoff()
+        self._schedule_flush()
+
+    def buffer_depth(self):
+        return len(self.buffer)
+
+    def backlog(self):
+        return len(self.buffer) + (len(self.media_groups) if self.media_groups else 0)
+
+    def is_overloaded(self):
+        return BATCH_SHED_THRESHOLD > 0 and self.backlog() >= BATCH_SHED_THRESHOLD
+
+    def oldest_unflushed_age(self):
+        times = [self.buffer[0][3]] if self.buffer else []
+        if self.media_groups and self.media_groups.oldest() is not None:
+            times.append(self.media_groups.oldest())
+        times.extend(self.queued_since)
+        if self.in_flight_since is not None:
+            times.append(self.in_flight_since)
+        return time.monotonic() - min(times) if times else 0.0
+
+    async def _spool(self, data):
+        seq, ticket = self.spool.write(data)
+        future = asyncio.get_running_loop().create_future()
+        self.sync_waiters.append((ticket, future))
+        if self.sync_task is None or self.sync_task.done():
+            self.sync_task = asyncio.create_task(self._sync_loop())
+        await future
+        return seq
+
+    async def _sync_loop(self):
+        # One executor call waits for the fsync covering every queued ticket
+        loop = asyncio.get_running_loop()
+        while self.sync_waiters:
+            target = max(ticket for ticket, _ in self.sync_waiters)
+            await loop.run_in_executor(None, self.spool.wait_synced, target)
+            remaining = []
+            for ticket, future in self.sync_waiters:
+                if ticket <= target:
+                    if not future.done():
+                        future.set_result(None)
+                else:
+                    remaining.append((ticket, future))
+            self.sync_waiters = remaining
+
+    def _accept(self, seqs, data):
+        if self.media_groups is None or not self.media_groups.is_part(data):
+            self._append(seqs, data)
+            return
+        completed = self.media_groups.add(seqs, data)
+        if completed:
+            self._append(*completed)
+        self._schedule_media_groups()
+
+    def _schedule_media_groups(self):
+        deadline = self.media_groups.next_deadline()
+        if deadline is not None and self.media_group_handle is None:
+            loop = asyncio.get_running_loop()
+            self.media_group_handle = loop.call_later(max(0.0, deadline - time.monotonic()), self._release_media_groups)
+
+    def _release_media_groups(self):
+        self.media_group_handle = None
+        for seqs, data, first_arrival in self.media_groups.take_due():
+            self._append(seqs, data, first_arrival)
+        self._handoff()
+        self._schedule_flush()
+        self._schedule_media_groups()
+
+    def _append(self, seqs, data, enqueued_at=None):
+        size = len(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        self.buffer.append((seqs, data, size, enqueued_at or time.monotonic()))
+        self.buffered_bytes += size
+
+    def _schedule_flush(self):
+        if self.buffer and self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self.flush_handle = loop.call_later(self.policy.flush_delay(), self._flush_partial)
+
+    def _flush_partial(self):
+        self.flush_handle = None
+        self._handoff(partial=True)
+        # Sender still busy with earlier batches; try again later
+        self._schedule_flush()
+
+    def _batch_ready(self):
+        return (len(self.buffer) >= self.policy.batch_size
+                or self.buffered_bytes >= self.policy.max_payload_bytes)
+
+    def _take_batch(self):
+        batch, self.buffer, taken_bytes = self.batches.cut(self.buffer, self.policy.batch_limit(len(self.buffer)),
+                                                           self.policy.max_payload_bytes)
+        self.buffered_bytes -= taken_bytes
+        return batch
+
+    def _handoff(self, partial=False):
+        while self.buffer and (partial or self._batch_ready()):
+            if self.send_queue.full():
+                if not self.backlogged:
+                    logger.warning(f"Batch send queue full; keeping {len(self.buffer)} messages buffered")
+                    self.backlogged = True
+                return
+            batch = self._take_batch()
+            self.queued_since.append(batch['enqueued_at'])
+            self.send_queue.put_nowait(batch)
+            self.backlogged = False
+
+    async def _put_batch(self, batch):
+        self.queued_since.append(batch['enqueued_at'])
+        await self.send_queue.put(batch)
+
+    async def _sender_loop(self):
+        while True:
+            batch = await self.send_queue.get()
+            self.queued_since.remove(batch['enqueued_at'])
+            self.in_flight_since = batch['enqueued_at']
+            try:
+                await self._deliver(batch)
+            except Exception as e:
+                logger.error(f"Batch sender error: {e}")
+            finally:
+                self.in_flight_since = None
+                self.send_queue.task_done()
+
+    async def _pause(self, delay):
+        """Sleep for ``delay`` seconds; returns True early if the manager is stopping."""
+        if delay <= 0:
+            return False
+        try:
+            await asyncio.wait_for(self.stopping.wait(), delay)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _deliver(self, batch):
+        attempt = 0
+        while not await self._pause(self.delivery.breaker_wait()):
+            outcome = await self._send_batch(batch, attempt)
+            if outcome == SPLIT:
+                for part in self.batches.split(batch):
+                    await self._deliver(part)
+                return
+            if outcome != RETRY:
+                return
+            attempt += 1
+            if await self._pause(self.delivery.retry_delay(attempt)):
+                return
+
+    async def _send_batch(self, batch, attempt=0):
+        loop = asyncio.get_running_loop()
+        outcome = RETRY
+        size = 0
+        started = time.monotonic()
+        try:
+            # Extraction is CPU-bound; keep it off the event loop
+            messages = await loop.run_in_executor(None, self.delivery.messages, batch)
+            body = self.delivery.encode(batch, messages, attempt)
+            if body is None:
+                outcome = SPLIT
+                return outcome
+            size = len(body)
+            started = time.monotonic()
+            async with self.session.post(self.web_app_url, data=body,
+                                         headers={'Content-Type': 'application/json; charset=utf-8'}) as resp:
+                text = await resp.text()
+            outcome = self.delivery.handle_reply(batch, attempt, resp.status, text, time.monotonic() - started)
+            if outcome != RETRY:
+                # Spool acks can compact (rewrite and fsync) the spool file; dead-lettering fsyncs too
+                await loop.run_in_executor(None, self.delivery.settle, batch, outcome)
+        except Exception as e:
+            logger.error(f"Batch {batch['batch_id']} attempt {attempt + 1} failed: {e}")
+        finally:
+            self.delivery.record_attempt(batch, outcome, time.monotonic() - started, size)
+        return outcome
+
+deduplicator = create_deduplicator()
+content_index = create_content_index()
+
+async def handle_webhook(request):
+    """Handle Telegram webhook."""
+    started = time.perf_counter()
+    try:
+        try:
+            update_json = await request.json()
+        except ValueError:
+            update_json = None
+
+        if not update_json:
+            return web.json_response({'status': 'error', 'message': 'No JSON data'}, status=400)
+
+        manager = request.app['state']['batch_manager']
+        # Shed load before de-duplication, so Telegram's redelivery is not dropped as a duplicate
+        if manager is not None and manager.is_overloaded():
+            WEBHOOK_SHED.inc()
+            return web.json_response({'status': 'overloaded'}, status=503)
+
+        data, result, claims = parse_update(update_json, deduplicator, content_index)
+        if data is not None:
+            if manager is None:
+                logger.error("GOOGLE_WEB_APP_URL not configured")
+                claims.release()
+                result = {'status': 'ignored'}
+            else:
+                # Prefer fast ingestion by default: only write MessageData on webhook
+                if 'processing_mode' not in data:
+                    data['processing_mode'] = 'message_only'
+                try:
+                    await manager.add_message(data)
+                except Exception:
+                    # Not accepted: let Telegram's redelivery through again
+                    claims.release()
+                    raise
+        return web.json_response(result)
+
+    except Exception as e:
+        logger.error(f"Webhook error: {str(e)}")
+        return web.json_response({'status': 'error', 'message': str(e)}, status=500)
+    finally:
+        WEBHOOK_SECONDS.observe(time.perf_counter() - started)
+
+async def handle_health(request):
+    """Simple health check endpoint for Railway."""
+    return web.json_response({
+        'status': 'healthy',
+        'service': 'telegram-webhook',
+        'timestamp': int(time.time()),
+        'version': APP_VERSION
+    })
+
+async def handle_metrics(request):
+    """Prometheus text-format metrics for the webhook pipeline."""
+    return web.Response(text=REGISTRY.render(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+async def on_startup(application):
+    if WEB_APP_URL:
+        spool = MessageSpool(WEBHOOK_SPOOL_PATH) if WEBHOOK_SPOOL_PATH else None
+        dead_letters = DeadLetterFile(WEBHOOK_DEAD_LETTER_PATH) if WEBHOOK_DEAD_LETTER_PATH else None
+        notifier = BatchNotifier(BOT_TOKEN) if BOT_TOKEN else None
+        manager = AsyncBatchManager(WEB_APP_URL, spool=spool, notifier=notifier, dead_letters=dead_letters)
+        await manager.start()
+        application['state']['batch_manager'] = manager
+    else:
+        logger.error("GOOGLE_WEB_APP_URL environment variable not found!")
+
+async def on_cleanup(application):
+    manager = application['state']['batch_manager']
+    if manager:
+        await manager.stop()
+
+def create_app():
+    """Build the aiohttp application."""
+    application = web.Application()
+    # Mutable holder: the application itself is frozen once it starts
+    application['state'] = {'batch_manager': None}
+    application.router.add_post('/webhook', handle_webhook)
+    application.router.add_get('/health', handle_health)
+    application.router.add_get('/metrics', handle_metrics)
+    application.on_startup.append(on_startup)
+    application.on_cleanup.append(on_cleanup)
+    register_pipeline_gauges(lambda: application['state']['batch_manager'], deduplicator)
+    return application
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 8080))
+    logger.info(f"Starting asyncio webhook server on port {port}")
+    web.run_app(create_app(), host='0.0.0.0', port=port)
@@ -8,11 +8,11 @@ import os
 import time
 import logging
 import json
-import requests
 from datetime import datetime
 from channels.telegram_bot_reader import TelegramBotReader
 from sheets.google_sheets_writer import GoogleSheetsWriter
 from utils.config import load_config
+from utils.http_client import get_http_client
 from utils.logger import setup_logger
 
 class AutoImporter:
@@ -158,10 +158,10 @@ class AutoImporter:
             # 2. Send to Google Apps Script Web App (Primary for processing)
             if self.web_app_url:
                 try:
-                    response = requests.post(
+                    response = get_http_client().post(
                         self.web_app_url,
-                        json=message,
-                        timeout=30
+                        endpoint='apps_script',
+                        json=message
                     )
                     if response.status_code == 200:
                         res_json = response.json()
@@ -10,33 +10,37 @@ Usage:
 """
 
 import argparse
+import importlib
 import logging
 import os
 import sys
 from datetime import datetime
 from typing import List, Dict, Any
-import pandas as pd
-
-# Import channel readers
-from channels.telegram_bot_reader import TelegramBotReader
-from channels.discord_reader import DiscordReader
-from channels.slack_reader import SlackReader
-
-# Import Google Sheets writers
-from sheets.google_sheets_writer import GoogleSheetsWriter
-from sheets.quick_sheets_writer import QuickSheetsWriter
 
 # Import utilities
 from utils.config import load_config
 from utils.logger import setup_logger
 
-# Supported channel types
+# Supported channel types, as (module, class); only the selected reader is imported
 SUPPORTED_CHANNELS = {
-    'telegram': TelegramBotReader,
-    'discord': DiscordReader,
-    'slack': SlackReader
+    'telegram': ('channels.telegram_bot_reader', 'TelegramBotReader'),
+    'discord': ('channels.discord_reader', 'DiscordReader'),
+    'slack': ('channels.slack_reader', 'SlackReader')
 }
 
+def load_channel_reader(channel_type: str):
+    """
+    Import the reader class for a channel type on first use.
+
+    Args:
+        channel_type: Key of SUPPORTED_CHANNELS
+
+    Returns:
+        Reader class for the channel
+    """
+    module_name, class_name = SUPPORTED_CHANNELS[channel_type]
+    return getattr(importlib.import_module(module_name), class_name)
+
 def parse_arguments():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description='Import channel posts to Google Sheets')
@@ -127,7 +131,7 @@ def main():
 
     try:
         # Initialize channel reader
-        channel_class = SUPPORTED_CHANNELS[args.channel]
+        channel_class = load_channel_reader(args.channel)
         reader = channel_class(config)
 
         # Read posts from channel
@@ -140,14 +144,17 @@ def main():
 
         logger.info(f"Found {len(posts)} posts to import")
 
-        # Convert to DataFrame for processing
+        # Convert to DataFrame for processing (pandas is only needed once there are posts)
+        import pandas as pd
         df = pd.DataFrame(posts)
 
         # Initialize Google Sheets writer
         if args.quick:
+            from sheets.quick_sheets_writer import QuickSheetsWriter
             logger.info("Using quick mode (manual copy-paste)...")
             sheets_writer = QuickSheetsWriter(args.sheet_id)
         else:
+            from sheets.google_sheets_writer import GoogleSheetsWriter
             sheets_writer = GoogleSheetsWriter(config['GOOGLE_SHEETS_CREDENTIALS_PATH'])
 
         # Write to Google Sheets
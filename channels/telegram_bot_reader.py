@@ -5,9 +5,9 @@ Telegram Bot API reader implementation using forwarded messages.
 import logging
 from typing import List, Dict, Any
 from datetime import datetime
-import requests
 import time
 
+from utils.http_client import get_http_client
 from .base_reader import BaseChannelReader
 
 logger = logging.getLogger(__name__)
@@ -32,7 +32,7 @@ class TelegramBotReader(BaseChannelReader):
             True if authentication successful, False otherwise
         """
         try:
-            response = requests.get(f"{self.base_url}/getMe", timeout=10)
+            response = get_http_client().get(f"{self.base_url}/getMe", endpoint='telegram')
             if response.status_code == 200:
                 bot_info = response.json()
                 if bot_info.get('ok'):
@@ -59,14 +59,14 @@ class TelegramBotReader(BaseChannelReader):
 
         try:
             # Get updates from bot (messages forwarded to it)
-            updates_response = requests.get(
+            updates_response = get_http_client().get(
                 f"{self.base_url}/getUpdates",
+                endpoint='telegram',
                 params={
                     'offset': self.last_update_id + 1,
                     'limit': limit,
                     'timeout': 1
-                },
-                timeout=10
+                }
             )
 
             if not updates_response.json().get('ok'):
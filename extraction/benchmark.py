@@ -0,0 +1,306 @@
+"""
+Extraction throughput and accuracy benchmark.
+
+Runs the extractors over the checked-in corpus of channel messages in
+``benchmarks/corpus`` (one JSONL file per channel with its own rules,
+``default.jsonl`` for the rest) and reports:
+
+- messages and products per second, overall and per channel
+- time per stage (normalize, segment, price analysis, categorize, other),
+  from a separate instrumented pass so the wrappers do not skew throughput
+- every message whose products differ from ``benchmarks/golden``
+
+It exits with status 1 when any message differs from its golden output, so
+a change made for speed cannot silently change results. After an
+intentional change to extraction, review the diff and regenerate the
+golden files with ``--update-golden``. Messages from new exports are
+added with ``--add-csv``::
+
+    python -m extraction.benchmark
+    python -m extraction.benchmark --add-csv telegram_messages_*.csv --update-golden
+
+The extraction cache is bypassed; every pass extracts every message.
+"""
+
+import argparse
+import csv
+import functools
+import glob
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from extraction import extractors
+from extraction.parallel import extract_message
+from extraction.patterns import DEFAULT_CHANNEL, PATTERNS, TrackedPattern
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks')
+CORPUS_DIR = os.path.join(BENCHMARK_DIR, 'corpus')
+GOLDEN_DIR = os.path.join(BENCHMARK_DIR, 'golden')
+
+# Stage -> functions of extraction.extractors timed as that stage
+STAGES = {
+    'normalize': ('normalize', 'normalize_batch', 'persian_to_english_numbers'),
+    'segment': ('_split_segments', '_segment_lines'),
+    'price analysis': ('analyze_pricing_for_segment', 'extract_prices_from_line', 'parse_price'),
+    'categorize': ('extract_category',),
+}
+
+def corpus_file(channel_username: Optional[str]) -> str:
+    """Corpus file name for a channel: its own if it has rules, else ``default.jsonl``."""
+    if channel_username and channel_username in PATTERNS.channels and channel_username != DEFAULT_CHANNEL:
+        return channel_username.lstrip('@') + '.jsonl'
+    return DEFAULT_CHANNEL + '.jsonl'
+
+def _read_jsonl(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def _write_jsonl(path: str, records: List[Dict[str, Any]]):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def load_corpus(corpus_dir: str = CORPUS_DIR) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Read the corpus.
+
+    Args:
+        corpus_dir: Directory of JSONL files with id, channel_username, content and source
+
+    Returns:
+        Corpus file name -> messages
+    """
+    return {os.path.basename(path): _read_jsonl(path)
+            for path in sorted(glob.glob(os.path.join(corpus_dir, '*.jsonl')))}
+
+def add_csv_messages(paths: List[str], corpus_dir: str = CORPUS_DIR) -> int:
+    """
+    Add messages from CSV exports (export_to_csv.py, channel readers) to the corpus.
+
+    Messages already in the corpus (same channel and text) are skipped.
+
+    Args:
+        paths: CSV files with id, channel_username and content columns
+        corpus_dir: Corpus directory
+
+    Returns:
+        Number of messages added
+    """
+    corpus = load_corpus(corpus_dir)
+    seen = {(m.get('channel_username'), m['content']) for messages in corpus.values() for m in messages}
+    added = 0
+    for path in paths:
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            for row in csv.DictReader(f):
+                key = (row.get('channel_username'), row.get('content') or '')
+                if not key[1].strip() or key in seen:
+                    continue
+                seen.add(key)
+                corpus.setdefault(corpus_file(key[0]), []).append({
+                    'id': row.get('id') or f"{os.path.basename(path)}:{added}",
+                    'channel_username': key[0],
+                    'content': key[1],
+                    'source': os.path.basename(path),
+                })
+                added += 1
+    for name, messages in corpus.items():
+        _write_jsonl(os.path.join(corpus_dir, name), messages)
+    return added
+
+def compare_golden(corpus: Dict[str, List[Dict[str, Any]]], golden_dir: str = GOLDEN_DIR) -> List[str]:
+    """
+    Extract every corpus message once and compare with the golden products.
+
+    Args:
+        corpus: Corpus file name -> messages
+        golden_dir: Directory of JSONL files with id and products
+
+    Returns:
+        One line per message that differs from (or is missing in) the golden output
+    """
+    problems = []
+    for name, messages in corpus.items():
+        path = os.path.join(golden_dir, name)
+        golden = {record['id']: record['products'] for record in _read_jsonl(path)} if os.path.exists(path) else {}
+        for message in messages:
+            products = extract_message(message['content'], message.get('channel_username'))
+            if message['id'] not in golden:
+                problems.append(f"{name} {message['id']}: no golden output")
+            elif products != golden[message['id']]:
+                problems.append(f"{name} {message['id']}: {_describe_difference(golden[message['id']], products)}")
+    return problems
+
+def _describe_difference(expected: Optional[List[Dict[str, Any]]], actual: Optional[List[Dict[str, Any]]]) -> str:
+    if expected is None or actual is None or len(expected) != len(actual):
+        count = lambda products: 'failed' if products is None else len(products)
+        return f"expected {count(expected)} products, got {count(actual)}"
+    for index, (want, got) in enumerate(zip(expected, actual)):
+        fields = sorted(key for key in set(want) | set(got) if want.get(key) != got.get(key))
+        if fields:
+            field = fields[0]
+            return (f"product {index} differs in {', '.join(fields)} "
+                    f"({field}: {want.get(field)!r} -> {got.get(field)!r})")
+    return 'products differ'
+
+def update_golden(corpus: Dict[str, List[Dict[str, Any]]], golden_dir: str = GOLDEN_DIR):
+    """Write the current extraction output of every corpus message as the golden output."""
+    for name, messages in corpus.items():
+        records = [{'id': m['id'], 'products': extract_message(m['content'], m.get('channel_username'))}
+                   for m in messages]
+        _write_jsonl(os.path.join(golden_dir, name), records)
+
+def measure_throughput(corpus: Dict[str, List[Dict[str, Any]]], min_seconds: float) -> Dict[str, Dict[str, float]]:
+    """
+    Extract each corpus file repeatedly for at least ``min_seconds`` in total.
+
+    Args:
+        corpus: Corpus file name -> messages
+        min_seconds: Measuring time, split evenly across corpus files
+
+    Returns:
+        Corpus file name -> passes, messages, products, seconds, messages_per_sec and products_per_sec
+    """
+    results = {}
+    budget = min_seconds / max(1, len(corpus))
+    for name, messages in corpus.items():
+        items = [(m['content'], m.get('channel_username')) for m in messages]
+        passes = processed = products = 0
+        elapsed = 0.0
+        started = time.perf_counter()
+        while passes == 0 or elapsed < budget:
+            for content, channel in items:
+                products += len(extract_message(content, channel) or ())
+            processed += len(items)
+            passes += 1
+            elapsed = time.perf_counter() - started
+        results[name] = {
+            'passes': passes,
+            'messages': processed,
+            'products': products,
+            'seconds': elapsed,
+            'messages_per_sec': processed / elapsed if elapsed else 0.0,
+            'products_per_sec': products / elapsed if elapsed else 0.0,
+        }
+    return results
+
+class StageTimer:
+    """Exclusive time per stage: time inside a nested stage counts only for the inner one."""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self.stack: List[float] = []
+
+    def wrap(self, stage: str, func: Callable) -> Callable:
+        timer = self
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            timer.stack.append(0.0)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                timer.seconds[stage] += elapsed - timer.stack.pop()
+                if timer.stack:
+                    timer.stack[-1] += elapsed
+        return timed
+
+@contextmanager
+def instrumented(timer: StageTimer) -> Iterator[StageTimer]:
+    """Time the STAGES functions (and pattern splits, as segmenting) while the block runs."""
+    originals = {name: getattr(extractors, name) for names in STAGES.values() for name in names}
+    original_split = TrackedPattern.split
+    try:
+        for stage, names in STAGES.items():
+            for name in names:
+                setattr(extractors, name, timer.wrap(stage, originals[name]))
+        TrackedPattern.split = timer.wrap('segment', original_split)
+        yield timer
+    finally:
+        for name, func in originals.items():
+            setattr(extractors, name, func)
+        TrackedPattern.split = original_split
+
+def measure_stages(corpus: Dict[str, List[Dict[str, Any]]], passes: int) -> Dict[str, float]:
+    """
+    Split extraction time into stages.
+
+    Args:
+        corpus: Corpus file name -> messages
+        passes: Times to extract the whole corpus
+
+    Returns:
+        Stage -> exclusive seconds, including ``other`` (names, packaging,
+        stock status, review checks) and ``total``
+    """
+    items = [(m['content'], m.get('channel_username')) for messages in corpus.values() for m in messages]
+    timer = StageTimer()
+    with instrumented(timer):
+        extract = timer.wrap('other', extract_message)
+        for _ in range(passes):
+            for content, channel in items:
+                extract(content, channel)
+    stages = {stage: timer.seconds.get(stage, 0.0) for stage in STAGES}
+    stages['other'] = timer.seconds.get('other', 0.0)
+    stages['total'] = sum(stages.values())
+    return stages
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark product extraction against the checked-in corpus')
+    parser.add_argument('--seconds', type=float, default=5.0, help='Total time for the throughput measurement')
+    parser.add_argument('--stage-passes', type=int, default=50, help='Corpus passes for the per-stage timing')
+    parser.add_argument('--add-csv', nargs='+', metavar='CSV', help='Add messages from CSV exports to the corpus')
+    parser.add_argument('--update-golden', action='store_true', help='Write the current output as the golden output')
+    parser.add_argument('--json', help='Also write the report to this file')
+    args = parser.parse_args()
+
+    if args.add_csv:
+        print(f"Added {add_csv_messages(args.add_csv)} messages to {CORPUS_DIR}")
+    corpus = load_corpus()
+    if not corpus:
+        sys.exit(f"No corpus files in {CORPUS_DIR}")
+    if args.update_golden:
+        update_golden(corpus)
+        print(f"Golden output written to {GOLDEN_DIR}")
+
+    problems = compare_golden(corpus)
+    throughput = measure_throughput(corpus, args.seconds)
+    stages = measure_stages(corpus, args.stage_passes)
+
+    messages = sum(len(m) for m in corpus.values())
+    print(f"\nCorpus: {messages} messages in {len(corpus)} files\n")
+    print(f"{'corpus file':<28}{'messages':>9}{'products':>9}{'msg/s':>10}{'products/s':>12}")
+    for name, result in throughput.items():
+        print(f"{name:<28}{len(corpus[name]):>9}{result['products'] // result['passes']:>9}"
+              f"{result['messages_per_sec']:>10.0f}{result['products_per_sec']:>12.0f}")
+    total_seconds = sum(r['seconds'] for r in throughput.values())
+    overall = {
+        'messages_per_sec': sum(r['messages'] for r in throughput.values()) / total_seconds,
+        'products_per_sec': sum(r['products'] for r in throughput.values()) / total_seconds,
+    }
+    print(f"{'all':<28}{'':>18}{overall['messages_per_sec']:>10.0f}{overall['products_per_sec']:>12.0f}")
+
+    per_message = 1e6 / (messages * args.stage_passes)
+    print(f"\n{'stage':<28}{'us/message':>12}{'share':>8}")
+    for stage, seconds in stages.items():
+        share = seconds / stages['total'] if stages['total'] else 0.0
+        print(f"{stage:<28}{seconds * per_message:>12.1f}{share:>8.0%}")
+
+    print(f"\nGolden output: {messages - len(problems)}/{messages} messages match")
+    for problem in problems:
+        print(f"  {problem}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'throughput': throughput, 'overall': overall, 'stages': stages, 'golden_mismatches': problems},
+                      f, ensure_ascii=False, indent=2)
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Service-side product extraction for batch ingest.
+
+With EXTRACTION_MODE=local the batch managers run ``extract_products`` on
+each message before sending, and Apps Script's ``writeExtractedProducts``
+only writes the resulting rows (one read of the Products sheet and a few
+``setValues`` calls) instead of re-reading the sheet for every product.
+The default, ``gas``, leaves extraction to Apps Script as before.
+"""
+
+import os
+from typing import Any, Dict, List
+
+from extraction.cache import get_extraction_cache
+from extraction.parallel import get_parallel_extractor
+
+# 'gas' (Apps Script extracts) or 'local' (this service extracts, Apps Script only writes rows)
+EXTRACTION_MODE = os.getenv('EXTRACTION_MODE', 'gas')
+
+def attach_products(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Extract products for a batch.
+
+    Messages whose text was extracted before come from the extraction
+    cache; of the rest, batches of EXTRACTION_PARALLEL_MIN messages or more
+    are spread over the extraction process pool. A message whose
+    extraction fails is sent without ``products`` and Apps Script extracts
+    it itself.
+
+    Args:
+        messages: Batch messages (not modified)
+
+    Returns:
+        Copies of the messages, each with a ``products`` list; products that
+        fail the discount/confidence checks carry a ``review_reason``
+    """
+    results = get_extraction_cache().extract(
+        [(message.get('content'), message.get('channel_username')) for message in messages],
+        get_parallel_extractor().extract)
+    extracted = []
+    for message, products in zip(messages, results):
+        message = dict(message)
+        if products is not None:
+            message['products'] = products
+        extracted.append(message)
+    return extracted
@@ -0,0 +1,334 @@
+"""
+Content-hash cache of extraction results.
+
+Channels repost the same price lists many times, and spill replays and
+backfills feed the same posts through again. ``ExtractionCache`` keys each
+result by a hash of the message text, its channel and the extraction
+version (EXTRACTOR_VERSION plus the fingerprint of the loaded channel
+rules), so repeated content skips extraction and any change to the
+extractors or rules misses automatically. Entries of an older version are
+deleted the first time a new version is seen.
+
+An in-memory LRU sits in front of a sqlite file shared by the service's
+processes. Disk entries older than EXTRACTION_CACHE_MAX_AGE_SEC are
+evicted, and least recently used ones once the cached products exceed
+EXTRACTION_CACHE_MAX_MB.
+
+The key uses the exact text rather than its normalized form: product names
+and descriptions copy the original lines, so two posts that only normalize
+alike can still produce different rows.
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from extraction.extractors import EXTRACTOR_VERSION
+from extraction.patterns import PATTERNS
+
+logger = logging.getLogger(__name__)
+
+# Results kept in memory; 0 disables the cache
+EXTRACTION_CACHE_SIZE = int(os.getenv('EXTRACTION_CACHE_SIZE', '10000'))
+# sqlite file shared by the service's processes; empty keeps the cache in memory only
+EXTRACTION_CACHE_PATH = os.getenv('EXTRACTION_CACHE_PATH', 'spool/extraction_cache.sqlite3')
+# Disk budget for cached products
+EXTRACTION_CACHE_MAX_MB = float(os.getenv('EXTRACTION_CACHE_MAX_MB', '64'))
+# Results older than this are extracted again
+EXTRACTION_CACHE_MAX_AGE_SEC = float(os.getenv('EXTRACTION_CACHE_MAX_AGE_SEC', str(7 * 24 * 3600)))
+# Disk stores between eviction passes
+EVICT_EVERY = 500
+# Keys per SELECT/UPDATE, below sqlite's bound-parameter limit
+SQL_CHUNK = 500
+
+Item = Tuple[Optional[str], Optional[str]]
+Products = Optional[List[Dict[str, Any]]]
+
+def extraction_version() -> str:
+    """Version of the extraction output: the extractor code version and the loaded rules."""
+    return f"{EXTRACTOR_VERSION}-{PATTERNS.version()}"
+
+def cache_key(content: str, channel: str, version: str) -> str:
+    """
+    Hash a message for the cache.
+
+    Args:
+        content: Message text
+        channel: Source channel
+        version: Extraction version
+
+    Returns:
+        Hex digest
+    """
+    # surrogatepass: webhook JSON can carry lone surrogates from split emojis
+    data = '\0'.join((version, channel, content)).encode('utf-8', 'surrogatepass')
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+class ExtractionCache:
+    """
+    Extraction results by content hash, in memory and on disk.
+
+    Disk errors are logged and counted; the cache then behaves as a miss
+    (or skips the store) and extraction carries on.
+    """
+
+    def __init__(self, path: str = EXTRACTION_CACHE_PATH, size: int = EXTRACTION_CACHE_SIZE,
+                 max_bytes: int = int(EXTRACTION_CACHE_MAX_MB * 1024 * 1024),
+                 max_age: float = EXTRACTION_CACHE_MAX_AGE_SEC):
+        """
+        Initialize the cache and open (or create) its sqlite file.
+
+        Args:
+            path: sqlite file; empty for memory only
+            size: Results kept in memory; 0 disables the cache
+            max_bytes: Disk budget for cached products
+            max_age: Seconds after which a result is extracted again
+        """
+        self.path = path
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.memory: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+        self.version = None
+        self.stores_since_evict = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        self.errors = 0
+        self.db = None
+        if path and size > 0:
+            try:
+                self.db = self._open(path)
+                with self.lock:
+                    self._evict(time.time())
+            except (OSError, sqlite3.Error) as e:
+                logger.error(f"Extraction cache {path} unavailable, caching in memory only: {e}")
+                self.db = None
+
+    @staticmethod
+    def _open(path: str) -> sqlite3.Connection:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS products (key TEXT PRIMARY KEY, version TEXT NOT NULL, '
+                   'products TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)')
+        db.execute('CREATE INDEX IF NOT EXISTS products_accessed ON products (accessed)')
+        return db
+
+    def extract(self, items: Sequence[Item], extract: Callable[[List[Item]], List[Products]]) -> List[Products]:
+        """
+        Get each item's products from the cache, extracting only the misses.
+
+        Args:
+            items: (content, channel_username) pairs
+            extract: Extracts a list of items, returning one result per item
+                (None where extraction failed; failures are not cached)
+
+        Returns:
+            One result per item, in input order
+        """
+        items = list(items)
+        if self.size <= 0:
+            return extract(items)
+        version, keys, results = self._lookup(items)
+        # Key -> positions; a post repeated within the input is extracted once
+        missing: Dict[str, List[int]] = {}
+        for i, result in enumerate(results):
+            if result is None:
+                missing.setdefault(keys[i], []).append(i)
+        if missing:
+            fresh = extract([items[positions[0]] for positions in missing.values()])
+            for positions, products in zip(missing.values(), fresh):
+                results[positions[0]] = products
+                for i in positions[1:]:
+                    results[i] = copy.deepcopy(products)
+            self._store(version, list(zip(missing, fresh)))
+        return results
+
+    def _check_version(self) -> str:
+        version = extraction_version()
+        if version != self.version:
+            self.memory.clear()
+            if self.db:
+                try:
+                    removed = self.db.execute('DELETE FROM products WHERE version != ?', (version,)).rowcount
+                    if removed:
+                        logger.info(f"Extraction version is now {version}: dropped {removed} cached results")
+                except sqlite3.Error as e:
+                    self._disk_error(e)
+            self.version = version
+        return version
+
+    def _lookup(self, items: List[Item]) -> Tuple[str, List[str], List[Products]]:
+        now = time.time()
+        with self.lock:
+            version = self._check_version()
+            keys = [cache_key(content or '', channel or '', version) for content, channel in items]
+            found: Dict[str, str] = {}
+            unknown = set()
+            for key in keys:
+                entry = self.memory.get(key)
+                if entry and now - entry[1] < self.max_age:
+                    self.memory.move_to_end(key)
+                    found[key] = entry[0]
+                elif key not in found:
+                    unknown.add(key)
+            if unknown and self.db:
+                found.update(self._load(list(unknown), now))
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        # Each caller gets its own copy of the products
+        return version, keys, [json.loads(found[key]) if key in found else None for key in keys]
+
+    def _load(self, keys: List[str], now: float) -> Dict[str, str]:
+        found = {}
+        try:
+            for start in range(0, len(keys), SQL_CHUNK):
+                chunk = keys[start:start + SQL_CHUNK]
+                marks = ','.join('?' * len(chunk))
+                rows = self.db.execute(f'SELECT key, products, created FROM products '
+                                       f'WHERE key IN ({marks}) AND created > ?',
+                                       (*chunk, now - self.max_age)).fetchall()
+                if rows:
+                    hit_keys = [row[0] for row in rows]
+                    self.db.execute(f"UPDATE products SET accessed = ? WHERE key IN ({','.join('?' * len(hit_keys))})",
+                                    (now, *hit_keys))
+                for key, products, created in rows:
+                    found[key] = products
+                    self._remember(key, products, created)
+        except sqlite3.Error as e:
+            self._disk_error(e)
+        self.disk_hits += len(found)
+        return found
+
+    def _remember(self, key: str, products: str, created: float):
+        self.memory[key] = (products, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def _store(self, version: str, results: List[Tuple[str, Products]]):
+        now = time.time()
+        rows = []
+        for key, products in results:
+            if products is None:
+                continue
+            encoded = json.dumps(products, ensure_ascii=False, separators=(',', ':'))
+            try:
+                size = len(encoded.encode('utf-8'))
+            except UnicodeEncodeError:
+                # A lone surrogate in the text; sqlite cannot store it
+                continue
+            rows.append((key, version, encoded, size, now, now))
+        with self.lock:
+            # Rules reloaded during extraction: these results may mix both versions
+            if not rows or version != self.version:
+                return
+            for key, _, encoded, _, created, _ in rows:
+                self._remember(key, encoded, created)
+            self.stored += len(rows)
+            if not self.db:
+                return
+            try:
+                self.db.execute('BEGIN')
+                try:
+                    self.db.executemany('INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?)', rows)
+                    self.db.execute('COMMIT')
+                except sqlite3.Error:
+                    self.db.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error as e:
+                self._disk_error(e)
+                return
+            self.stores_since_evict += len(rows)
+            if self.stores_since_evict >= EVICT_EVERY:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        self.stores_since_evict = 0
+        try:
+            removed = self.db.execute('DELETE FROM products WHERE created < ?', (now - self.max_age,)).rowcount
+            total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM products').fetchone()[0]
+            if total > self.max_bytes:
+                # Down to 90% of the budget, so eviction does not run on every store
+                excess = total - int(self.max_bytes * 0.9)
+                keys = []
+                for key, size in self.db.execute('SELECT key, size FROM products ORDER BY accessed').fetchall():
+                    keys.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                self.db.executemany('DELETE FROM products WHERE key = ?', keys)
+                removed += len(keys)
+            self.evicted += removed
+        except sqlite3.Error as e:
+            self._disk_error(e)
+
+    def _disk_error(self, error: sqlite3.Error):
+        self.errors += 1
+        logger.warning(f"Extraction cache {self.path}: {error}")
+
+    def clear(self):
+        """Drop every cached result, in memory and on disk."""
+        with self.lock:
+            self.memory.clear()
+            if self.db:
+                try:
+                    self.db.execute('DELETE FROM products')
+                except sqlite3.Error as e:
+                    self._disk_error(e)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache statistics.
+
+        Returns:
+            Dictionary with the version, memory entries, hits (of which from
+            disk), misses, hit rate, stores, disk evictions and disk errors
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'path': self.path if self.db else None,
+                'version': self.version,
+                'memory_entries': len(self.memory),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'stored': self.stored,
+                'evicted': self.evicted,
+                'errors': self.errors,
+            }
+
+    def close(self):
+        """Close the sqlite file; the memory cache stays usable."""
+        with self.lock:
+            db, self.db = self.db, None
+        if db:
+            db.close()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_extraction_cache() -> ExtractionCache:
+    """Get the process-wide ExtractionCache, configured from the environment."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ExtractionCache()
+        return _cache
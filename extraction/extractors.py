@@ -0,0 +1,547 @@
+"""
+Product extraction from channel posts.
+
+Python port of ``extractProducts`` and its helpers in google_apps_script.js.
+For a given message it returns the same products, with the same fields, as
+the Apps Script version, so rows written from either side are
+interchangeable. The regexes are translated one to one; JavaScript's
+``\\d`` and ``\\b`` are ASCII-only, which is why they appear here as
+``[0-9]`` and with ``re.ASCII``.
+
+Known difference: the Apps Script emoji character classes work on UTF-16
+code units, so an emoji that is not in the list loses only its high
+surrogate there. This port leaves such emojis whole.
+"""
+
+import math
+import re
+from typing import Any, Dict, List, Optional, Set
+
+from extraction.keywords import KEYWORD_GROUPS, LINE_KEYWORDS, SEGMENT_KEYWORDS, keyword_pattern
+from extraction.normalization import (
+    JS_WHITESPACE, js_regex, normalize, normalize_batch, parse_price, persian_to_english_numbers
+)
+from extraction.patterns import PATTERNS, ChannelRules
+
+CURRENCY = 'IRT'
+# Bump whenever a change to this module or extraction.normalization alters extracted products;
+# cached results of other versions are discarded (rule changes are tracked by PATTERNS.version())
+EXTRACTOR_VERSION = '2'
+
+# Segments (the channel-specific patterns live in extraction.patterns)
+_HAS_TEXT = re.compile('[0-9\u06F0-\u06F9a-zA-Z\u0600-\u06FF]')
+_NON_PRODUCT_FIRST_LINE = re.compile(r'^(?:آدرس|خرید حضوری|تماس|واتساپ|wa\.me|https?://|@)', re.I)
+_VARIATION_ONLY = re.compile(js_regex(r'^(?:یک|نیم|ربع|[0-9]+)\s+(?:مثقالی|گرمی)\s*\Z'), re.I)
+_OUT_OF_STOCK = keyword_pattern(KEYWORD_GROUPS['out_of_stock'])
+
+# Prices
+_CONTACT_OR_ADDRESS = re.compile(r'(آدرس|تماس|واتساپ|wa\.me|https?://|@)', re.I)
+_PRICE_NUMBER_SEPARATORS = re.compile('[,.\u066B/]')
+_SLASHED_NUMBER = re.compile(r'([0-9]+)/([0-9]+)')
+_NUMBER_SEPARATORS = re.compile('[,.\u066B]')
+_LONG_NUMBER = re.compile(r'\b[0-9]{4,}\b', re.ASCII)
+_NUMBER = re.compile(r'[0-9]+')
+_PACK_HINT = keyword_pattern(KEYWORD_GROUPS['packaging'])
+
+# Universal extractor
+_LINE_CONSUMER_LABEL = re.compile('(?:مصرف|روی جلد)')
+_PACKAGING = re.compile(js_regex(r'(?:باکس|کارتن|شیرینگ)\s*([0-9]+\s*(?:عددی|تایی|عدد))'), re.I)
+_VOLUME = re.compile(js_regex(r'([0-9]+\s*(?:گرم|gr|ml|لیتر|میلی))'), re.I)
+_VARIATION_PATTERNS = (
+    re.compile(js_regex('طعم\\s*([^\n،,]+)'), re.I),
+    re.compile(js_regex('مدل\\s*([^\n،,]+)'), re.I),
+    re.compile(js_regex('رنگ\\s*([^\n،,]+)'), re.I),
+)
+
+# Product names
+_NAME_EMOJIS = re.compile('[✅❌🛑⭕🚀🔥💎📦✨🌟📣💰🛍•●▪\uFE0F]')
+_NAME_PREFIX = re.compile(js_regex(r'^(?:نام)?\s*محصول[:\s]*'))
+_NAME_LEADING_SYMBOLS = re.compile('^[-+*○◦‣▪■□➔➢➤]+')
+_NAME_TRAILING_COLONS = re.compile(r'[:]+\Z')
+_NAME_LABELS = ('قیمت فروش ما', 'قیمت مصرف کننده', 'قیمت مصرف', 'قیمت', 'قیمت هر یک ورق', 'قیمت هر ورق',
+                'قیمت هر عدد', 'قیمت هر شیشه', 'فی', 'تعداد', 'باکس', 'کارتن', 'دونه ای', 'مصرف', 'موجود', 'خرید')
+_NAME_DIGITS = re.compile('[0-9\u06F0-\u06F9]')
+_NAME_SPLIT = re.compile('(?:قیمت|تعداد|باکس|کارتن|دونه ای|مصرف|فی|موجود|✅|🚀|🔥|💎|📦|✨|🌟|📣|💰|🛍\uFE0F)', re.I)
+_NAME_TRAILING_PUNCTUATION = re.compile(js_regex(r'[:\s-]+\Z'))
+_NAME_NOT_A_PRODUCT = re.compile(r'(آدرس|میدان|خیابان|پاساژ|پلاک|بازار|wa\.me|https?://|@|واتساپ|تماس)', re.I)
+_NAME_HAS_LETTERS = re.compile('[\u0600-\u06FFA-Za-z]')
+_NAME_ONLY_NUMBERS = re.compile(js_regex('^\\s*[0-9\u06F0-\u06F9\\-.,/\\s]+\\Z'))
+
+# Categories
+_PERSIAN_CATEGORIES = {
+    'food': ['کنسرو', 'خوراک', 'غذا', 'میوه', 'سبزی', 'لبنیات'],
+    'beverages': ['نوشیدنی', 'قهوه', 'چای', 'انرژی', 'مایع', 'جوشان'],
+    'electronics': ['گوشی', 'موبایل', 'لپ تاپ', 'تبلت', 'شارژر', 'هدفون'],
+    'clothing': ['لباس', 'شلوار', 'پیراهن', 'کفش', 'کلاه', 'تیشرت'],
+    'home': ['خانه', 'دکور', 'مبلمان', 'آشپزخانه', 'حمام', 'رختخواب'],
+    'beauty': ['آرایشی', 'پوست', 'مو', 'کرم', 'لوسیون', 'ماسک'],
+}
+_CATEGORIES = {
+    'electronics': ['phone', 'iphone', 'samsung', 'laptop', 'computer', 'tablet', 'charger', 'cable', 'headphone',
+                    'airpods', 'macbook', 'ipad'],
+    'clothing': ['shirt', 'pants', 'dress', 'jacket', 'shoe', 'boot', 'hat', 'jeans', 't-shirt', 'hoodie'],
+    'food': ['canned', 'food', 'conserves', 'fruit', 'vegetable', 'dairy'],
+    'beverages': ['drink', 'coffee', 'tea', 'energy', 'beverage', 'cappuccino'],
+    'home': ['furniture', 'decoration', 'kitchen', 'bathroom', 'bedding', 'sofa', 'table', 'chair'],
+    'beauty': ['cosmetic', 'skincare', 'makeup', 'perfume', 'hair', 'cream', 'lotion', 'mask'],
+    'sports': ['equipment', 'fitness', 'sport', 'gym', 'workout', 'bicycle', 'ball', 'racket'],
+    'automotive': ['car', 'auto', 'vehicle', 'tire', 'part', 'engine', 'wheel'],
+}
+
+def js_length(text: str) -> int:
+    """Length of a string in UTF-16 code units, as JavaScript's ``length`` counts it."""
+    return len(text) + sum(1 for char in text if ord(char) > 0xFFFF)
+
+def js_trim(text: str) -> str:
+    """Strip whitespace as JavaScript's ``trim()`` does (unlike ``str.strip()``, including U+FEFF)."""
+    return text.strip(JS_WHITESPACE)
+
+def _capitalize(word: str) -> str:
+    return word[:1].upper() + word[1:]
+
+def extract_products(content: str, channel_username: Optional[str]) -> List[Dict[str, Any]]:
+    """
+    Extract products from a message.
+
+    Args:
+        content: Message text
+        channel_username: Source channel (e.g. ``@bonakdarjavan``); picks the channel-specific extractor
+
+    Returns:
+        List of product dictionaries with the fields the Products sheet expects
+    """
+    rules = PATTERNS.rules_for(channel_username)
+    if rules.extractor == 'segmented':
+        return extract_segmented(content, rules)
+    if rules.extractor == 'line_pairs':
+        return extract_line_pairs(content, rules)
+    return extract_universal_products(content, channel_username, rules)
+
+def _split_segments(content: str, rules: ChannelRules) -> List[str]:
+    """Split a post into one segment per product: blank lines, or emoji bullets for long blocks."""
+    segments = rules['segment_split'].split(content)
+    if len(segments) == 1 or any(segment.count('\n') + 1 > 8 for segment in segments):
+        bullet_split = rules['bullet_split']
+        segments = [part for segment in segments for part in bullet_split.split(segment)]
+    return segments
+
+def _segment_lines(segment: str) -> List[str]:
+    lines = (js_trim(line) for line in js_trim(segment).split('\n'))
+    return [line for line in lines if line and js_length(line) > 1 and _HAS_TEXT.search(line)]
+
+def extract_segmented(content: str, rules: ChannelRules) -> List[Dict[str, Any]]:
+    """
+    Extract one product per segment (@bonakdarjavan, @top_shop_rahimi).
+
+    Uses the ``segment_split``, ``bullet_split``, ``packaging`` and
+    ``fallback_price`` patterns; with ``group_variations`` pure weight
+    labels ("یک مثقالی") are prefixed with the previous product's name.
+
+    Args:
+        content: Message text
+        rules: Channel rules
+
+    Returns:
+        List of products with a sale price
+    """
+    products = []
+    last_base_name = None
+    for segment in _split_segments(content, rules):
+        if js_length(js_trim(segment)) < 5:
+            continue
+        normalized_segment = normalize(segment)
+        lines = _segment_lines(segment)
+        if lines and _NON_PRODUCT_FIRST_LINE.search(lines[0]):
+            continue
+        if not lines:
+            continue
+        cleaned_name = clean_product_name(lines[0])
+        if not cleaned_name:
+            continue
+        keywords = SEGMENT_KEYWORDS.groups(segment)
+
+        final_name, variation_label = cleaned_name, ''
+        if rules.group_variations:
+            if _VARIATION_ONLY.search(cleaned_name) and last_base_name:
+                variation_label = cleaned_name
+                final_name = f"{last_base_name} {cleaned_name}"
+            else:
+                last_base_name = cleaned_name
+
+        product = {
+            'name': final_name,
+            'sale_price': 0,
+            'actual_price': 0,
+            'price_type': _presentation_method(keywords),
+            'price': 0,
+            'consumer_price': 0,
+            'packaging': '',
+            'variation_type': variation_label or extract_variation_type(lines[0]) or extract_variation_type(segment),
+            'confidence': 0.7,
+            'extraction_confidence': 0.7,
+            'raw_name': lines[0],
+            'description': segment,
+            'stock_status': 'Out of Stock' if 'out_of_stock' in keywords else 'Available',
+            'currency': CURRENCY,
+        }
+        pricing = analyze_pricing_for_segment(lines)
+        product['sale_price'] = pricing['sale_price'] or 0
+        product['actual_price'] = pricing['actual_price'] or 0
+        product['price_type'] = pricing['price_type'] or product['price_type']
+        product['extraction_confidence'] = pricing['extraction_confidence'] or product['extraction_confidence']
+        product['price'] = product['sale_price']
+        product['consumer_price'] = product['actual_price']
+        for pattern in rules['packaging']:
+            for match in pattern.finditer(normalized_segment):
+                product['packaging'] = match.group(1) + ' عددی'
+        if product['sale_price'] == 0:
+            match = rules['fallback_price'].search(normalized_segment)
+            if match:
+                product['sale_price'] = parse_price(match.group(1))
+            product['price'] = product['sale_price']
+
+        name = product['name']
+        if product['sale_price'] > 0 and js_length(name) > 3 and 'http' not in name and 'wa.me' not in name:
+            products.append(product)
+    return products
+
+def extract_line_pairs(content: str, rules: ChannelRules) -> List[Dict[str, Any]]:
+    """
+    Extract ``name : price`` pairs (@nobelshop118).
+
+    Uses the ``segment_split`` and ``line`` patterns.
+
+    Args:
+        content: Message text
+        rules: Channel rules
+
+    Returns:
+        List of products
+    """
+    products = []
+    line_pattern = rules['line']
+    for segment in rules['segment_split'].split(content):
+        # normalize() folds newlines, so each segment is a single line
+        for line in normalize(segment).split('\n'):
+            match = line_pattern.search(line)
+            if not match:
+                continue
+            left = js_trim(match.group(1))
+            if _CONTACT_OR_ADDRESS.search(left):
+                continue
+            digits = _PRICE_NUMBER_SEPARATORS.sub('', persian_to_english_numbers(match.group(2)))
+            if not 4 <= len(digits) <= 8:
+                continue
+            name = clean_product_name(left)
+            if name and js_length(name) > 3:
+                products.append({
+                    'name': name,
+                    'price': parse_price(match.group(2)),
+                    'confidence': 0.9,
+                    'raw_name': left,
+                    'description': segment,
+                    'stock_status': 'Available',
+                    'currency': CURRENCY,
+                    'packaging': '',
+                })
+    return products
+
+def extract_universal_products(content: str, channel_username: Optional[str],
+                               rules: Optional[ChannelRules] = None) -> List[Dict[str, Any]]:
+    """
+    Line-by-line extractor for list-style and block-style posts of any channel.
+
+    A product starts at a line that is not a price line once the previous
+    product has a price; following lines add prices, packaging, volume
+    and stock status to it.
+
+    Args:
+        content: Message text
+        channel_username: Source channel, used for categories
+        rules: Rules providing the ``price``, ``contact`` and ``detail_line`` patterns (default: the channel's)
+
+    Returns:
+        List of finalized products
+    """
+    rules = rules or PATTERNS.rules_for(channel_username)
+    price_pattern, contact_pattern, detail_pattern = rules['price'], rules['contact'], rules['detail_line']
+    lines = [js_trim(line) for line in content.split('\n')]
+    lines = [line for line in lines if line]
+    products = []
+    current = None
+
+    for line in lines:
+        contact_line = bool(contact_pattern.search(line))
+        is_price_line = not contact_line and bool(price_pattern.search(line)) and bool(_NUMBER.search(line))
+        is_new_product = (not is_price_line and js_length(line) > 3 and not detail_pattern.search(line)
+                          and (current is None or current['price'] > 0))
+
+        if is_new_product:
+            if current and (current['price'] > 0 or current['stock_status'] == 'Out of Stock'):
+                products.append(finalize_product(current, channel_username))
+            current = {
+                'raw_name': line,
+                'name': clean_product_name(line),
+                'sale_price': 0,
+                'actual_price': 0,
+                'price': 0,
+                'consumer_price': 0,
+                'packaging': extract_packaging(line),
+                'volume': extract_volume(line),
+                'stock_status': 'Out of Stock' if _OUT_OF_STOCK.search(line) else 'Available',
+                'description': line,
+                'extraction_confidence': 0.8,
+            }
+        elif current:
+            current['description'] += '\n' + line
+            if _OUT_OF_STOCK.search(line):
+                current['stock_status'] = 'Out of Stock'
+            if not current['packaging']:
+                current['packaging'] = extract_packaging(line)
+            if not current['volume']:
+                current['volume'] = extract_volume(line)
+
+            if is_price_line:
+                sale, consumer = extract_prices_from_line(line)
+                if sale > 0:
+                    current['sale_price'] = sale
+                    current['price'] = sale
+                if consumer > 0:
+                    current['actual_price'] = consumer
+                    current['consumer_price'] = consumer
+                current['extraction_confidence'] = max(current['extraction_confidence'], 0.9)
+                # The smaller of two prices is the sale price
+                if 0 < current['consumer_price'] < current['price']:
+                    current['price'], current['consumer_price'] = current['consumer_price'], current['price']
+                    current['sale_price'], current['actual_price'] = current['actual_price'], current['sale_price']
+
+    if current and (current['price'] > 0 or current['stock_status'] == 'Out of Stock'):
+        products.append(finalize_product(current, channel_username))
+    return products
+
+def extract_prices_from_line(line: str):
+    """
+    Read the sale and consumer price from one line.
+
+    Args:
+        line: Raw line text
+
+    Returns:
+        Tuple of (sale price, consumer price); 0 where not found
+    """
+    clean = _NUMBER_SEPARATORS.sub('', _SLASHED_NUMBER.sub(r'\1\2', persian_to_english_numbers(line)))
+    values = [int(number) for number in _NUMBER.findall(clean) if 4 <= len(number) <= 8]
+    values = [value for value in values if value > 1000]
+    first = values[0] if values else 0
+
+    sale, consumer = 0, 0
+    if _LINE_CONSUMER_LABEL.search(line):
+        consumer = first
+    else:
+        # A sale label, or no label at all
+        sale = first
+    if len(values) >= 2:
+        sale, consumer = min(values), max(values)
+    return sale, consumer
+
+def clean_product_name(raw: str) -> str:
+    """
+    Turn the first line of a product block into a product name.
+
+    Args:
+        raw: Raw line
+
+    Returns:
+        Cleaned name, or '' if the line is a price/info label, an address or only numbers
+    """
+    if not raw:
+        return ''
+    clean = _NAME_EMOJIS.sub('', raw)
+    clean = _NAME_PREFIX.sub('', clean, count=1)
+    clean = _NAME_LEADING_SYMBOLS.sub('', clean, count=1)
+    clean = js_trim(_NAME_TRAILING_COLONS.sub('', clean, count=1))
+
+    lower = clean.lower()
+    if any(lower == label or lower.startswith(label + ':') or lower.startswith(label + ' ') for label in _NAME_LABELS):
+        if _NAME_DIGITS.search(clean) or '٫' in clean or '/' in clean:
+            return ''
+
+    if _NAME_SPLIT.search(clean):
+        head = js_trim(_NAME_SPLIT.split(clean)[0])
+        if js_length(head) > 2:
+            return js_trim(_NAME_TRAILING_PUNCTUATION.sub('', head, count=1))
+    if _NAME_NOT_A_PRODUCT.search(clean):
+        return ''
+    if not _NAME_HAS_LETTERS.search(clean):
+        return ''
+    if _NAME_ONLY_NUMBERS.search(clean):
+        return ''
+    return clean
+
+def finalize_product(product: Dict[str, Any], channel: Optional[str]) -> Dict[str, Any]:
+    """
+    Build the output product from the universal extractor's working dictionary.
+
+    Args:
+        product: Working product
+        channel: Source channel username
+
+    Returns:
+        Product with standardized price fields and a category
+    """
+    sale_price = product.get('sale_price') or product.get('price') or 0
+    consumer_price = product.get('actual_price') or product.get('consumer_price') or None
+    # @nobelshop118 lists one price; mirror it as the consumer price
+    if not consumer_price and 'nobelshop118' in (channel or '').lower() and sale_price > 0:
+        consumer_price = sale_price
+
+    return {
+        'name': product.get('name'),
+        'sale_price': sale_price,
+        'actual_price': consumer_price,
+        'price_type': product.get('price_type') or infer_price_type_from_packaging(product.get('packaging')),
+        'price': sale_price,
+        'consumer_price': consumer_price,
+        'currency': CURRENCY,
+        'packaging': product.get('packaging'),
+        'volume': product.get('volume'),
+        'stock_status': product.get('stock_status'),
+        'variation_type': product.get('variation_type') or '',
+        'channel_username': channel,
+        'description': product.get('description'),
+        'category': extract_category(product.get('name'), product.get('description'), channel),
+        'confidence': product.get('confidence') or 0.95,
+        'extraction_confidence': product.get('extraction_confidence') or product.get('confidence') or 0.95,
+    }
+
+def extract_packaging(text: str) -> str:
+    """Packaging such as ``باکس 24 عددی`` from a line, or ''."""
+    match = _PACKAGING.search(text)
+    return match.group(0) if match else ''
+
+def extract_volume(text: str) -> str:
+    """Volume such as ``250 گرم`` or ``330ml`` from a line, or ''."""
+    match = _VOLUME.search(text)
+    return match.group(0) if match else ''
+
+def infer_price_type_from_packaging(packaging: Optional[str]) -> str:
+    """``pack`` if the packaging names a box, carton, shrink pack or sheet, else ``single``."""
+    if packaging and _PACK_HINT.search(packaging):
+        return 'pack'
+    return 'single'
+
+def detect_presentation_method(segment: Optional[str]) -> str:
+    """Whether a segment prices single items, packs, or both."""
+    return _presentation_method(SEGMENT_KEYWORDS.groups(segment or ''))
+
+def _presentation_method(keywords: Set[str]) -> str:
+    has_single = 'single_hint' in keywords
+    has_pack = 'packaging' in keywords
+    if has_single and has_pack:
+        return 'both'
+    if has_pack:
+        return 'pack_only'
+    return 'single_only'
+
+def extract_variation_type(text: Optional[str]) -> str:
+    """Flavor, model or color following طعم / مدل / رنگ, or ''."""
+    if not text:
+        return ''
+    for pattern in _VARIATION_PATTERNS:
+        match = pattern.search(text)
+        if match and match.group(1):
+            return js_trim(match.group(1))
+    return ''
+
+def analyze_pricing_for_segment(lines: List[str]) -> Dict[str, Any]:
+    """
+    Work out the sale and actual price of a product segment.
+
+    Labelled prices (مصرف for the consumer price, فروش/همکار/... for the
+    sale price) win; otherwise the smallest number is the sale price and
+    the largest the actual price.
+
+    Args:
+        lines: Cleaned lines of the segment
+
+    Returns:
+        Dictionary with sale_price, actual_price, price_type and extraction_confidence
+    """
+    result = {'sale_price': 0, 'actual_price': 0, 'price_type': 'single', 'extraction_confidence': 0.8}
+    if not lines:
+        return result
+
+    candidates = []
+    for line, normalized in zip(lines, normalize_batch(lines)):
+        norm = _NUMBER_SEPARATORS.sub('', _SLASHED_NUMBER.sub(r'\1\2', normalized))
+        numbers = _LONG_NUMBER.findall(norm)
+        keywords = LINE_KEYWORDS.groups(line)
+        if numbers and 'contact' not in keywords:
+            candidates.extend(int(number) for number in numbers if 4 <= len(number) <= 8)
+        if 'consumer_label' in keywords and numbers:
+            result['actual_price'] = parse_price(numbers[0])
+        if 'sale_label' in keywords and numbers:
+            result['sale_price'] = parse_price(numbers[0])
+        if 'packaging' in keywords:
+            result['price_type'] = 'pack'
+
+    unique = sorted(set(candidates))
+    if len(unique) == 1:
+        result['sale_price'] = result['sale_price'] or unique[0]
+        result['extraction_confidence'] = max(result['extraction_confidence'], 0.9)
+    elif len(unique) >= 2:
+        result['sale_price'] = result['sale_price'] or unique[0]
+        result['actual_price'] = result['actual_price'] or unique[-1]
+        result['extraction_confidence'] = max(result['extraction_confidence'], 0.92)
+
+    if result['actual_price'] and result['sale_price'] and result['sale_price'] > result['actual_price']:
+        result['sale_price'], result['actual_price'] = result['actual_price'], result['sale_price']
+    return result
+
+def extract_category(name: Optional[str], description: Optional[str], channel_username: Optional[str]) -> str:
+    """
+    Categorize a product by channel hints, then Persian and English keywords.
+
+    Args:
+        name: Product name
+        description: Product description
+        channel_username: Source channel
+
+    Returns:
+        Capitalized category name, or 'General'
+    """
+    text = f"{name} {description}".lower()
+
+    hints = PATTERNS.rules_for(channel_username).category_hints if channel_username else None
+    if hints and any(keyword in text for keyword in hints):
+        return _capitalize(hints[0])
+    for keywords_by_category in (_PERSIAN_CATEGORIES, _CATEGORIES):
+        for category, keywords in keywords_by_category.items():
+            if any(keyword in text for keyword in keywords):
+                return _capitalize(category)
+    return 'General'
+
+def review_reason(product: Dict[str, Any]) -> str:
+    """
+    Run the discount and confidence parts of ``performQualityChecks``.
+
+    The price-history check needs the Products sheet and stays in Apps Script.
+
+    Args:
+        product: Extracted product
+
+    Returns:
+        Reason the product needs review, or '' if it passes
+    """
+    sale_price = product.get('sale_price') or product.get('price') or 0
+    actual_price = product.get('actual_price') or product.get('consumer_price') or 0
+    confidence = product.get('extraction_confidence') or product.get('confidence') or 0
+    reason = ''
+    if actual_price and sale_price:
+        discount = 1 - sale_price / actual_price
+        if discount > 0.8 or discount < 0.05:
+            # Math.round rounds halves up
+            reason = f"Unusual discount {math.floor(discount * 100 + 0.5)}%"
+    if confidence < 0.85:
+        reason = reason + '; low confidence' if reason else 'Low confidence'
+    return reason
@@ -0,0 +1,161 @@
+"""
+Single-pass multi-keyword scanning for the extractors.
+
+A product line or segment used to be tested by several keyword regexes in
+turn (contact markers, price labels, packaging words, stock words).
+``KeywordScanner`` compiles all keywords of its groups into one
+alternation, longest first, and walks the text once, reporting every
+occurrence (overlapping ones included, as Aho-Corasick would) with its
+position and group. The matching runs inside ``re``: a scan costs one
+search, plus one per keyword found, instead of one search per group.
+
+A keyword is a literal, or a ``(head, tail)`` pair whose tail is a regex
+that must follow the head (``('دونه', r'\\s*ای')`` for ``دونه\\s*ای``);
+tails see the lower-cased text, so letters in them must be lowercase.
+ASCII letters are matched case-insensitively, as the JavaScript ``/i``
+regexes they replace do for these keywords. The alternation itself is
+compiled without ``re.IGNORECASE``, which would make every search several
+times slower; a text is lower-cased first only if it has ASCII capitals.
+google_apps_script.js has a ``KeywordScanner`` with the same behavior.
+"""
+
+import re
+import string
+from collections import namedtuple
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, Union
+
+from extraction.normalization import js_regex
+
+Keyword = Union[str, Tuple[str, str]]
+Hit = namedtuple('Hit', 'start end group keyword')
+Entry = Tuple[int, int, str, Optional['re.Pattern']]
+
+# Keyword groups of the product extractors (the same words as in google_apps_script.js)
+KEYWORD_GROUPS: Dict[str, Tuple[Keyword, ...]] = {
+    'out_of_stock': ('تمام', 'ناموجود', '❌'),
+    'contact': ('wa.me', 'http://', 'https://', '@', '📞', 'تماس', 'واتساپ'),
+    'consumer_label': ('مصرف', 'روی جلد', 'مصرف کننده'),
+    'sale_label': ('فروش', 'خرید', 'ما', 'همکار', ('دونه', r'\s*ای'), 'فی'),
+    'single_hint': (('دونه', r'\s*ای'), ('تک', r'\s*فروش'), ('فی', r'\s*هر\s*عدد')),
+    'packaging': ('باکس', 'کارتن', 'شیرینگ', 'ورق'),
+}
+
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_ASCII_UPPER = re.compile('[A-Z]')
+
+def _split_keyword(keyword: Keyword) -> Tuple[str, str]:
+    return keyword if isinstance(keyword, tuple) else (keyword, '')
+
+def keyword_pattern(keywords: Iterable[Keyword]) -> 're.Pattern':
+    """Compile one group as a plain regex, for places that test a single group."""
+    return re.compile(js_regex('|'.join(re.escape(head) + tail for head, tail in map(_split_keyword, keywords))), re.I)
+
+class KeywordScanner:
+    """
+    Finds every keyword of a set of groups in one pass over a text.
+
+    The search matches the longest keyword at the leftmost position. Every
+    other keyword lying within that match is known from a table built at
+    construction, so the search resumes after the match, or at the first
+    offset where a keyword could start inside it and run past its end.
+    """
+
+    def __init__(self, groups: Dict[str, Iterable[Keyword]]):
+        """
+        Build the scanner.
+
+        Args:
+            groups: Group name -> keywords (literals or ``(head, tail regex)`` pairs)
+        """
+        self.group_names = frozenset(groups)
+        entries: Dict[str, List[Tuple[str, Optional['re.Pattern']]]] = {}
+        for group, keywords in groups.items():
+            for keyword in keywords:
+                head, tail = _split_keyword(keyword)
+                entries.setdefault(head.translate(ASCII_LOWER), []).append((group, re.compile(js_regex(tail)) if tail else None))
+        heads = sorted(entries, key=len, reverse=True)
+        self.pattern = re.compile('|'.join(map(re.escape, heads)))
+        self.folds = any(char in string.ascii_lowercase for head in heads for char in head)
+        # Matched head -> (resume offset, groups of untailed keywords within it, tailed keywords
+        # within it, all keywords within it); keywords as (offset, head length, group, tail)
+        self.expansions: Dict[str, Tuple[int, FrozenSet[str], Tuple[Entry, ...], Tuple[Entry, ...]]] = {}
+        for head in heads:
+            resume = next((offset for offset in range(1, len(head))
+                           if any(other.startswith(head[offset:]) and len(other) > len(head) - offset
+                                  for other in heads)), len(head))
+            keywords = tuple((offset, len(other), group, tail)
+                             for offset in range(resume) for other in heads if head.startswith(other, offset)
+                             for group, tail in entries[other])
+            plain = frozenset(group for _, _, group, tail in keywords if tail is None)
+            tailed = tuple(keyword for keyword in keywords if keyword[3] is not None)
+            self.expansions[head] = (resume, plain, tailed, keywords)
+
+    def _fold(self, text: str) -> str:
+        # translate() keeps positions; it is only needed when a keyword has letters and the text capitals
+        return text.translate(ASCII_LOWER) if self.folds and _ASCII_UPPER.search(text) else text
+
+    def scan(self, text: str) -> List[Hit]:
+        """
+        Find all keyword occurrences.
+
+        Args:
+            text: Text to scan
+
+        Returns:
+            Hits (start, end, group, matched text) ordered by start position
+        """
+        hits = []
+        folded = self._fold(text)
+        search = self.pattern.search
+        position = 0
+        while True:
+            match = search(folded, position)
+            if match is None:
+                return hits
+            start = match.start()
+            resume, _, _, keywords = self.expansions[match.group()]
+            for offset, length, group, tail in keywords:
+                end = start + offset + length
+                if tail:
+                    tail_match = tail.match(folded, end)
+                    if not tail_match:
+                        continue
+                    end = tail_match.end()
+                hits.append(Hit(start + offset, end, group, text[start + offset:end]))
+            position = start + resume
+
+    def groups(self, text: str) -> Set[str]:
+        """
+        Get the groups with at least one keyword in the text.
+
+        Same scan as ``scan`` without building hits; stops once every group was seen.
+
+        Args:
+            text: Text to scan
+
+        Returns:
+            Group names
+        """
+        if self.folds and _ASCII_UPPER.search(text):
+            text = text.translate(ASCII_LOWER)
+        search = self.pattern.search
+        match = search(text)
+        found: Set[str] = set()
+        while match is not None:
+            start = match.start()
+            resume, plain, tailed, _ = self.expansions[match.group()]
+            found |= plain
+            for offset, length, group, tail in tailed:
+                if group not in found and tail.match(text, start + offset + length):
+                    found.add(group)
+            if len(found) == len(self.group_names):
+                break
+            match = search(text, start + resume)
+        return found
+
+# One scan per cleaned line of a product segment (analyze_pricing_for_segment)
+LINE_KEYWORDS = KeywordScanner({group: KEYWORD_GROUPS[group]
+                                for group in ('contact', 'consumer_label', 'sale_label', 'packaging')})
+# One scan per product segment (presentation method and stock status)
+SEGMENT_KEYWORDS = KeywordScanner({group: KEYWORD_GROUPS[group]
+                                   for group in ('out_of_stock', 'single_hint', 'packaging')})
@@ -0,0 +1,153 @@
+"""
+Table-driven Persian text normalization used by the product extractors.
+
+Python counterpart of ``persianToEnglishNumbers`` and
+``NormalizationEngine`` in google_apps_script.js, which apply the same
+mapping. The translation tables are built once at import; ``normalize``
+is a single ``str.translate`` pass followed by whitespace folding.
+
+- Persian (۰-۹) and Arabic-Indic (٠-٩) digits become ASCII digits
+- Arabic yeh/kaf (ي ك) become Persian yeh/keheh (ی ک)
+- Zero-width characters (U+200B-U+200D, U+FEFF) are removed
+- Runs of whitespace, including newlines, become a single space
+
+JavaScript's whitespace (``trim()``, ``\\s``) differs from Python's: it
+includes U+FEFF but not \\x1c-\\x1f or \\x85. ``JS_WHITESPACE`` and
+``js_regex`` let the extractors match what the Apps Script code matches.
+"""
+
+import re
+from typing import Iterable, List, Optional
+
+PERSIAN_DIGITS = '۰۱۲۳۴۵۶۷۸۹'
+ARABIC_INDIC_DIGITS = '٠١٢٣٤٥٦٧٨٩'
+ARABIC_TO_PERSIAN_LETTERS = {'ي': 'ی', 'ك': 'ک'}
+ZERO_WIDTH_CHARS = '\u200b\u200c\u200d\ufeff'
+# Characters JavaScript's \s matches and trim() strips
+JS_WHITESPACE = ('\t\n\v\f\r \xa0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a'
+                 '\u2028\u2029\u202f\u205f\u3000\ufeff')
+
+DIGIT_TABLE = str.maketrans(PERSIAN_DIGITS + ARABIC_INDIC_DIGITS, '0123456789' * 2)
+NORMALIZE_TABLE = {
+    **DIGIT_TABLE,
+    **str.maketrans(ARABIC_TO_PERSIAN_LETTERS),
+    **{ord(char): None for char in ZERO_WIDTH_CHARS},
+}
+
+_NON_DIGITS = re.compile('[^0-9]')
+# Whitespace to str.split() but not to JavaScript's \s
+_PYTHON_ONLY_WHITESPACE = re.compile('[\x1c-\x1f\x85]')
+_JS_WHITESPACE_RUN = re.compile(f'[{JS_WHITESPACE}]+')
+
+def js_regex(pattern: str) -> str:
+    """
+    Rewrite ``\\s`` (and ``\\S`` outside character classes) to match JavaScript's whitespace.
+
+    Args:
+        pattern: Regex source ported from google_apps_script.js
+
+    Returns:
+        Equivalent Python regex source
+    """
+    out = []
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern):
+            escaped = pattern[i + 1]
+            if escaped == 's':
+                out.append(JS_WHITESPACE if in_class else f'[{JS_WHITESPACE}]')
+            elif escaped == 'S' and not in_class:
+                out.append(f'[^{JS_WHITESPACE}]')
+            else:
+                out.append(pattern[i:i + 2])
+            i += 2
+            continue
+        if char == '[' and not in_class:
+            in_class = True
+            out.append(char)
+            i += 1
+            # A leading ^ and/or ] belong to the class
+            if pattern[i:i + 1] == '^':
+                out.append('^')
+                i += 1
+            if pattern[i:i + 1] == ']':
+                out.append(']')
+                i += 1
+            continue
+        if char == ']' and in_class:
+            in_class = False
+        out.append(char)
+        i += 1
+    return ''.join(out)
+
+def persian_to_english_numbers(text: Optional[str]) -> str:
+    """Replace Persian and Arabic-Indic digits with ASCII digits."""
+    if not text:
+        return ''
+    return text.translate(DIGIT_TABLE)
+
+def normalize(text: Optional[str]) -> str:
+    """
+    Normalize text for matching.
+
+    Args:
+        text: Raw text
+
+    Returns:
+        Text with ASCII digits, Persian yeh/kaf, no zero-width characters,
+        and all whitespace (including newlines) collapsed to single spaces
+    """
+    if not text:
+        return ''
+    return _fold_whitespace(text.translate(NORMALIZE_TABLE))
+
+def _fold_whitespace(text: str) -> str:
+    """Collapse whitespace runs to one space and trim, as ``replace(/\\s+/g, ' ').trim()`` does."""
+    if _PYTHON_ONLY_WHITESPACE.search(text):
+        return _JS_WHITESPACE_RUN.sub(' ', text).strip(' ')
+    # Otherwise str.split() splits on the same characters as \s and drops leading/trailing runs
+    return ' '.join(text.split())
+
+def normalize_batch(texts: Iterable[Optional[str]]) -> List[str]:
+    """
+    Normalize many texts (the lines of a post, or a batch of posts) at once.
+
+    Each distinct text is normalized once, so the address and contact
+    blocks repeated across a channel's posts cost a dictionary lookup.
+
+    Args:
+        texts: Raw texts; None is treated as ''
+
+    Returns:
+        ``[normalize(text) for text in texts]``
+    """
+    table = NORMALIZE_TABLE
+    done = {}
+    result = []
+    for text in texts:
+        if not text:
+            result.append('')
+            continue
+        normalized = done.get(text)
+        if normalized is None:
+            normalized = done[text] = _fold_whitespace(text.translate(table))
+        result.append(normalized)
+    return result
+
+def parse_price(value) -> int:
+    """
+    Parse a price such as ``۱۲۵/۰۰۰``, ``125,000`` or ``125.000``.
+
+    Args:
+        value: Price text (or number)
+
+    Returns:
+        Integer price, or 0 if there are no digits
+    """
+    if not value:
+        return 0
+    # Separators (/ , . ٫) and any other non-digits are dropped
+    clean = _NON_DIGITS.sub('', str(value).translate(DIGIT_TABLE))
+    return int(clean) if clean else 0
@@ -0,0 +1,198 @@
+"""
+Parallel product extraction over a process pool.
+
+Extraction is pure-Python regex work, so threads do not help. For large
+inputs (replayed spills, backfills of exported channel history)
+``ParallelExtractor`` splits the messages into chunks, extracts them in
+worker processes that compiled the channel rules at startup, and returns
+the results in input order. Small inputs are extracted in-process, where
+the pool's pickling overhead would cost more than it saves.
+
+Run as a module to backfill products from exported CSV files::
+
+    python -m extraction.parallel telegram_messages_*.csv --output products.jsonl
+
+Backfills go through the extraction cache (``--no-cache`` to bypass it),
+so re-running one only extracts messages it has not seen.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from extraction.cache import get_extraction_cache
+from extraction.extractors import extract_products, review_reason
+from extraction.patterns import PATTERNS
+
+logger = logging.getLogger(__name__)
+
+# Worker processes; 0 uses every core
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', '0'))
+# Inputs smaller than this are extracted in-process
+EXTRACTION_PARALLEL_MIN = int(os.getenv('EXTRACTION_PARALLEL_MIN', '500'))
+# Chunks handed to each worker: several per worker even out slow chunks, few keep pickling cheap
+CHUNKS_PER_WORKER = 4
+MAX_CHUNK_SIZE = 500
+
+def extract_message(content: Optional[str], channel_username: Optional[str]) -> Optional[List[Dict[str, Any]]]:
+    """
+    Extract one message's products and mark those that need review.
+
+    Args:
+        content: Message text
+        channel_username: Source channel
+
+    Returns:
+        Products (with ``review_reason`` where a check failed), or None if extraction raised
+    """
+    try:
+        products = extract_products(content or '', channel_username or '')
+    except Exception as e:
+        logger.warning(f"Extraction failed for a {channel_username} message: {e}")
+        return None
+    for product in products:
+        reason = review_reason(product)
+        if reason:
+            product['review_reason'] = reason
+    return products
+
+def _init_worker():
+    """Load the rules file, if any, before the first chunk arrives (the built-in rules compile on import)."""
+    for channel in list(PATTERNS.channels):
+        PATTERNS.rules_for(channel)
+
+def _extract_chunk(items: Sequence[Tuple[Optional[str], Optional[str]]]) -> List[Optional[List[Dict[str, Any]]]]:
+    return [extract_message(content, channel) for content, channel in items]
+
+def chunk_size(count: int, workers: int) -> int:
+    """Chunk length giving each worker CHUNKS_PER_WORKER chunks, capped at MAX_CHUNK_SIZE."""
+    return max(1, min(MAX_CHUNK_SIZE, math.ceil(count / (workers * CHUNKS_PER_WORKER))))
+
+class ParallelExtractor:
+    """
+    Extracts products for many messages across a lazily started process pool.
+
+    The pool uses the ``spawn`` start method, so it is safe to create from
+    a threaded server process. Pattern statistics of the workers stay in
+    the workers and are not included in ``PATTERNS.stats()``.
+    """
+
+    def __init__(self, workers: int = EXTRACTION_WORKERS, min_parallel: int = EXTRACTION_PARALLEL_MIN):
+        """
+        Initialize the extractor; no processes are started until needed.
+
+        Args:
+            workers: Worker processes; 0 uses every core
+            min_parallel: Inputs smaller than this are extracted in-process
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.min_parallel = min_parallel
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                                mp_context=multiprocessing.get_context('spawn'))
+            return self.pool
+
+    def extract(self, items: Sequence[Tuple[Optional[str], Optional[str]]]) -> List[Optional[List[Dict[str, Any]]]]:
+        """
+        Extract products for each (content, channel_username) pair.
+
+        Args:
+            items: Message texts with their channels
+
+        Returns:
+            One entry per item, in input order: its products, or None if extraction failed
+        """
+        items = list(items)
+        if self.workers < 2 or len(items) < self.min_parallel:
+            return _extract_chunk(items)
+        size = chunk_size(len(items), self.workers)
+        chunks = [items[start:start + size] for start in range(0, len(items), size)]
+        try:
+            results = []
+            # map() yields chunk results in submission order
+            for chunk_result in self._get_pool().map(_extract_chunk, chunks):
+                results.extend(chunk_result)
+            return results
+        except BrokenProcessPool as e:
+            logger.error(f"Extraction pool failed, extracting in-process: {e}")
+            self.close()
+            return _extract_chunk(items)
+
+    def close(self):
+        """Shut the pool down; a later ``extract`` starts a new one."""
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+_extractor = None
+_extractor_lock = threading.Lock()
+
+def get_parallel_extractor() -> ParallelExtractor:
+    """Get the process-wide ParallelExtractor, configured from the environment."""
+    global _extractor
+    with _extractor_lock:
+        if _extractor is None:
+            _extractor = ParallelExtractor()
+        return _extractor
+
+def _read_csv_messages(paths: Sequence[str]) -> List[Dict[str, str]]:
+    messages = []
+    for path in paths:
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            messages.extend(csv.DictReader(f))
+    return messages
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract products from exported channel messages in parallel')
+    parser.add_argument('csv_files', nargs='+', help='CSV exports with content and channel_username columns')
+    parser.add_argument('--output', help='Write one JSON line per message (id, channel_username, products)')
+    parser.add_argument('--workers', type=int, default=EXTRACTION_WORKERS, help='Worker processes (0: every core)')
+    parser.add_argument('--repeat', type=int, default=1, help='Process the input this many times (for timing)')
+    parser.add_argument('--no-cache', action='store_true', help='Extract every message, bypassing the extraction cache')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    messages = _read_csv_messages(args.csv_files) * args.repeat
+    extractor = ParallelExtractor(workers=args.workers, min_parallel=0)
+    started = time.perf_counter()
+    try:
+        items = [(m.get('content'), m.get('channel_username')) for m in messages]
+        if args.no_cache:
+            results = extractor.extract(items)
+        else:
+            cache = get_extraction_cache()
+            results = cache.extract(items, extractor.extract)
+            cache_stats = cache.stats()
+            print(f"Extraction cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    finally:
+        extractor.close()
+    elapsed = time.perf_counter() - started
+
+    products = sum(len(r) for r in results if r)
+    failed = sum(1 for r in results if r is None)
+    print(f"{len(messages)} messages -> {products} products ({failed} failed) in {elapsed:.2f}s "
+          f"with {extractor.workers} workers: {len(messages) / elapsed:.0f} messages/s")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            for message, result in zip(messages, results):
+                record = {'id': message.get('id'), 'channel_username': message.get('channel_username'),
+                          'products': result}
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+if __name__ == '__main__':
+    main()
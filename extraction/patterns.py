@@ -0,0 +1,364 @@
+"""
+Per-channel extraction rules, compiled once and reloadable from a file.
+
+Each channel maps to an extractor (``segmented``, ``line_pairs`` or
+``universal``), its options, category hints and named regex patterns.
+``DEFAULT_RULES`` mirrors CHANNEL_PATTERNS and the channel-specific code
+paths of google_apps_script.js. If EXTRACTION_RULES_PATH points to a JSON
+file of the same shape, its channels are added to (or replace) the
+defaults; the file is re-read when it changes, without a redeploy. An
+entry may ``extend`` another channel and override only what differs::
+
+    {"@new_channel": {"extends": "@top_shop_rahimi", "category_hints": ["snacks"]}}
+
+A pattern is a regex string, or ``{"pattern": ..., "flags": "i"}`` with
+any of ``i`` (ignore case), ``a`` (ASCII ``\\b``/``\\w``) and ``m``
+(multiline). Every compiled pattern counts its calls, matches and time,
+reported by ``PatternRegistry.stats``.
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from extraction.normalization import js_regex
+
+logger = logging.getLogger(__name__)
+
+# JSON file with extra or replacement channel rules; empty uses DEFAULT_RULES only
+EXTRACTION_RULES_PATH = os.getenv('EXTRACTION_RULES_PATH', '')
+# How often the rules file is checked for changes
+EXTRACTION_RULES_CHECK_SEC = float(os.getenv('EXTRACTION_RULES_CHECK_SEC', '5'))
+
+# Extractor -> patterns its rules must define
+EXTRACTORS = {
+    'segmented': ('segment_split', 'bullet_split', 'packaging', 'fallback_price'),
+    'line_pairs': ('segment_split', 'line'),
+    'universal': ('price', 'contact', 'detail_line'),
+}
+DEFAULT_CHANNEL = 'default'
+
+_FLAGS = {'i': re.IGNORECASE, 'a': re.ASCII, 'm': re.MULTILINE}
+
+_SEGMENTED_PATTERNS = {
+    'segment_split': r'\n\s*\n',
+    'bullet_split': '\n(?=(?:✅|🚀|🔥|💎|•|●|▪|📦|✨|🌟|📣|💰|🛍️))',
+    'packaging': [
+        {'pattern': r'(?:تعداد\s+در\s+(?:باکس|کارتن|ورق)|باکس|کارتن|ورق)\s*[:\s]*([0-9]+)\s*عددی', 'flags': 'i'},
+        {'pattern': r'([0-9]+)\s*عددی', 'flags': 'i'},
+    ],
+    'fallback_price': {'pattern': '(?:قیمت|فی|قیمت هر یک باکس)\\s*[:\\s]*([0-9,/۰-۹٫.]+)', 'flags': 'i'},
+}
+
+DEFAULT_RULES: Dict[str, Dict[str, Any]] = {
+    DEFAULT_CHANNEL: {
+        'extractor': 'universal',
+        'category_hints': [],
+        'patterns': {
+            'price': {'pattern': r'[:\s]([0-9,]+(?:/[0-9]{3})?|[0-9,]+)(?:\s*(?:تومان|تومن|ت|T))?', 'flags': 'i'},
+            'contact': {'pattern': r'(wa\.me|https?://|@|📞|تماس|واتساپ|خرید\s*آنلاین|خرید\s*انلاین|لینک)', 'flags': 'i'},
+            'detail_line': {'pattern': r'^(?:تعداد|باکس|کارتن|لینک|آدرس|شعبه|تماس|واتساپ|wa\.me|https?://|@|📞)',
+                            'flags': 'i'},
+        },
+    },
+    '@bonakdarjavan': {
+        'extractor': 'segmented',
+        'group_variations': True,
+        'category_hints': ['food', 'canned', 'conserves', 'کنسرو'],
+        'patterns': _SEGMENTED_PATTERNS,
+    },
+    '@top_shop_rahimi': {
+        'extractor': 'segmented',
+        'group_variations': False,
+        'category_hints': ['beverages', 'drinks', 'energy', 'نوشیدنی', 'انرژی'],
+        'patterns': dict(_SEGMENTED_PATTERNS, **{
+            # The Apps Script version has "\د" where "\d" was meant, so it only
+            # matches Persian digits and separators; kept for identical output
+            'fallback_price': {'pattern': '(?:قیمت|فی|قیمت هر یک باکس)\\s*[:\\s]*([د,/۰-۹٫.]+)',
+                               'flags': 'i'},
+        }),
+    },
+    '@nobelshop118': {
+        'extractor': 'line_pairs',
+        'category_hints': ['beverages', 'coffee', 'cappuccino', 'نوشیدنی', 'قهوه'],
+        'patterns': {
+            # The Apps Script pattern is /\n\s*\ن/: a newline, optional spaces, then a literal "ن"
+            'segment_split': '\n\\s*ن',
+            'line': '([^\n:]+)\\s*:\\s*([0-9/۰-۹,]+)',
+        },
+    },
+    '@wholesale_electronics': {'extends': DEFAULT_CHANNEL, 'category_hints': ['electronics']},
+    '@fashion_wholesale': {'extends': DEFAULT_CHANNEL, 'category_hints': ['clothing', 'fashion']},
+    '@beauty_wholesale': {'extends': DEFAULT_CHANNEL, 'category_hints': ['beauty', 'cosmetics']},
+    '@home_decor': {'extends': DEFAULT_CHANNEL, 'category_hints': ['home', 'furniture']},
+}
+
+class TrackedPattern:
+    """
+    A compiled regex that counts its calls, matches and time.
+
+    Counters are updated without a lock; under concurrent use they are
+    approximate, which is enough for spotting an expensive pattern.
+    """
+
+    __slots__ = ('name', 'regex', 'calls', 'matches', 'seconds')
+
+    def __init__(self, name: str, regex: re.Pattern):
+        self.name = name
+        self.regex = regex
+        self.calls = 0
+        self.matches = 0
+        self.seconds = 0.0
+
+    def _record(self, started: float, matches: int):
+        self.calls += 1
+        self.matches += matches
+        self.seconds += time.perf_counter() - started
+
+    def search(self, text: str) -> Optional[re.Match]:
+        started = time.perf_counter()
+        match = self.regex.search(text)
+        self._record(started, match is not None)
+        return match
+
+    def findall(self, text: str) -> List[Any]:
+        started = time.perf_counter()
+        found = self.regex.findall(text)
+        self._record(started, len(found))
+        return found
+
+    def finditer(self, text: str) -> List[re.Match]:
+        """All matches, as a list (so the time spent matching is measured)."""
+        started = time.perf_counter()
+        found = list(self.regex.finditer(text))
+        self._record(started, len(found))
+        return found
+
+    def split(self, text: str) -> List[str]:
+        started = time.perf_counter()
+        parts = self.regex.split(text)
+        self._record(started, len(parts) - 1)
+        return parts
+
+    def stats(self) -> Dict[str, Any]:
+        return {'calls': self.calls, 'matches': self.matches, 'seconds': round(self.seconds, 6)}
+
+class ChannelRules:
+    """Compiled rules of one channel."""
+
+    def __init__(self, channel: str, spec: Dict[str, Any]):
+        """
+        Compile a channel's rules.
+
+        Args:
+            channel: Channel username, or ``default``
+            spec: Resolved rule dictionary (no ``extends``)
+
+        Raises:
+            ValueError: Unknown extractor, a missing pattern, or a pattern that does not compile
+        """
+        self.channel = channel
+        self.extractor = spec.get('extractor', 'universal')
+        if self.extractor not in EXTRACTORS:
+            raise ValueError(f"{channel}: unknown extractor {self.extractor!r}")
+        self.group_variations = bool(spec.get('group_variations', False))
+        self.category_hints = list(spec.get('category_hints') or [])
+        self.patterns: Dict[str, Any] = {}
+        for name, value in (spec.get('patterns') or {}).items():
+            if isinstance(value, list):
+                self.patterns[name] = [_compile(f"{name}[{i}]", item, channel) for i, item in enumerate(value)]
+            else:
+                self.patterns[name] = _compile(name, value, channel)
+        missing = [name for name in EXTRACTORS[self.extractor] if name not in self.patterns]
+        if missing:
+            raise ValueError(f"{channel}: {self.extractor} extractor needs patterns {', '.join(missing)}")
+
+    def __getitem__(self, name: str):
+        return self.patterns[name]
+
+    def tracked(self) -> Iterable[TrackedPattern]:
+        for value in self.patterns.values():
+            yield from value if isinstance(value, list) else (value,)
+
+def _compile(name: str, value: Any, channel: str) -> TrackedPattern:
+    if isinstance(value, str):
+        pattern, flag_letters = value, ''
+    elif isinstance(value, dict) and isinstance(value.get('pattern'), str):
+        pattern, flag_letters = value['pattern'], value.get('flags', '')
+    else:
+        raise ValueError(f"{channel}.{name}: expected a regex string or {{\"pattern\": ..., \"flags\": ...}}")
+    flags = 0
+    for letter in flag_letters:
+        if letter not in _FLAGS:
+            raise ValueError(f"{channel}.{name}: unknown flag {letter!r}")
+        flags |= _FLAGS[letter]
+    try:
+        # Patterns are ported from Apps Script, so \\s means JavaScript's whitespace
+        return TrackedPattern(name, re.compile(js_regex(pattern), flags))
+    except re.error as e:
+        raise ValueError(f"{channel}.{name}: {e}") from e
+
+def compile_rules(specs: Dict[str, Dict[str, Any]]) -> Dict[str, ChannelRules]:
+    """
+    Resolve ``extends`` and compile every channel.
+
+    Args:
+        specs: Channel username -> rule dictionary
+
+    Returns:
+        Channel username -> compiled rules
+
+    Raises:
+        ValueError: On a cycle, an unknown parent, or an invalid rule
+    """
+    resolved: Dict[str, Dict[str, Any]] = {}
+
+    def resolve(channel: str, chain: tuple) -> Dict[str, Any]:
+        if channel in resolved:
+            return resolved[channel]
+        if channel in chain:
+            raise ValueError(f"Rule inheritance cycle: {' -> '.join(chain + (channel,))}")
+        if channel not in specs:
+            raise ValueError(f"{chain[-1]} extends unknown channel {channel}")
+        spec = dict(specs[channel])
+        parent = spec.pop('extends', None)
+        if parent:
+            merged = copy.deepcopy(resolve(parent, chain + (channel,)))
+            merged['patterns'] = dict(merged.get('patterns') or {}, **(spec.pop('patterns', None) or {}))
+            merged.update(spec)
+            spec = merged
+        resolved[channel] = spec
+        return spec
+
+    return {channel: ChannelRules(channel, resolve(channel, ())) for channel in specs}
+
+def rules_fingerprint(specs: Dict[str, Dict[str, Any]]) -> str:
+    """Short hash of a rule set; it changes whenever any channel's rules do."""
+    encoded = json.dumps(specs, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+    return hashlib.blake2b(encoded, digest_size=8).hexdigest()
+
+class PatternRegistry:
+    """
+    Compiled rules for every channel, reloaded when the rules file changes.
+
+    A rules file that fails to parse or compile is logged and ignored; the
+    previous rules stay in use.
+    """
+
+    def __init__(self, path: str = EXTRACTION_RULES_PATH, check_interval: float = EXTRACTION_RULES_CHECK_SEC):
+        """
+        Initialize the registry.
+
+        Args:
+            path: JSON rules file merged over DEFAULT_RULES; empty for defaults only
+            check_interval: Seconds between checks of the file's modification time
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.loaded_mtime = None
+        self.next_check = 0.0
+        self.reloads = 0
+        self.last_error = None
+        self.channels = compile_rules(DEFAULT_RULES)
+        self.fingerprint = rules_fingerprint(DEFAULT_RULES)
+        self._maybe_reload()
+
+    def rules_for(self, channel: Optional[str]) -> ChannelRules:
+        """
+        Get the rules for a channel, falling back to ``default``.
+
+        Args:
+            channel: Channel username (exact match, e.g. ``@bonakdarjavan``)
+
+        Returns:
+            Compiled rules
+        """
+        if self.path and time.monotonic() >= self.next_check:
+            self._maybe_reload()
+        channels = self.channels
+        return channels.get(channel) or channels[DEFAULT_CHANNEL]
+
+    def version(self) -> str:
+        """
+        Get the fingerprint of the rules in use, checking the rules file first.
+
+        Returns:
+            Hash that changes whenever the loaded rules do
+        """
+        if self.path and time.monotonic() >= self.next_check:
+            self._maybe_reload()
+        return self.fingerprint
+
+    def _maybe_reload(self):
+        if not self.path or not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.next_check = time.monotonic() + self.check_interval
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime == self.loaded_mtime:
+                return
+            self.load(self.path if mtime is not None else None)
+            self.loaded_mtime = mtime
+        finally:
+            self.lock.release()
+
+    def load(self, path: Optional[str]):
+        """
+        Replace the rules with DEFAULT_RULES merged with a rules file.
+
+        Args:
+            path: JSON rules file, or None for the defaults only
+        """
+        try:
+            specs = dict(DEFAULT_RULES)
+            if path:
+                with open(path, encoding='utf-8') as f:
+                    overrides = json.load(f)
+                if not isinstance(overrides, dict):
+                    raise ValueError("rules file must contain an object keyed by channel")
+                specs.update(overrides)
+            channels = compile_rules(specs)
+        except (OSError, ValueError) as e:
+            self.last_error = f"{path}: {e}"
+            logger.error(f"Ignoring extraction rules {path}: {e}")
+            return
+        self.channels = channels
+        self.fingerprint = rules_fingerprint(specs)
+        self.reloads += 1
+        self.last_error = None
+        if path:
+            logger.info(f"Loaded extraction rules from {path}: {len(channels)} channels")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get per-pattern usage and reload state.
+
+        Returns:
+            Dictionary with the rules file, reload count, last load error,
+            and for each channel whose patterns were used, each pattern's
+            calls, matches and seconds (counted since the rules were last loaded)
+        """
+        channels = {}
+        for channel, rules in self.channels.items():
+            used = {pattern.name: pattern.stats() for pattern in rules.tracked() if pattern.calls}
+            if used:
+                channels[channel] = used
+        return {
+            'rules_path': self.path or None,
+            'reloads': self.reloads,
+            'fingerprint': self.fingerprint,
+            'last_error': self.last_error,
+            'channels': channels,
+        }
+
+PATTERNS = PatternRegistry()
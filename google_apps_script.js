@@ -10,15 +10,20 @@ const CONFIG = {
 };
 
 // Persian number conversion helper
+// Lookup tables built once; the service's extraction/normalization.py applies the same mapping
+const DIGIT_MAP = (function() {
+  const map = {};
+  for (let i = 0; i < 10; i++) {
+    map[String.fromCharCode(0x06F0 + i)] = String(i); // Persian
+    map[String.fromCharCode(0x0660 + i)] = String(i); // Arabic-Indic
+  }
+  return map;
+})();
+const ARABIC_LETTER_MAP = { '\u064A': '\u06CC', '\u0643': '\u06A9' }; // ي -> ی, ك -> ک
+
 function persianToEnglishNumbers(text) {
   if (!text) return '';
-  const persianNumbers = ['۰', '۱', '۲', '۳', '۴', '۵', '۶', '۷', '۸', '۹'];
-  const englishNumbers = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9'];
-
-  return text.split('').map(char => {
-    const index = persianNumbers.indexOf(char);
-    return index !== -1 ? englishNumbers[index] : char;
-  }).join('');
+  return text.replace(/[\u06F0-\u06F9\u0660-\u0669]/g, char => DIGIT_MAP[char]);
 }
 
 // Channel-specific extraction patterns
@@ -193,7 +198,10 @@ const MESSAGE_HEADERS = [
   'Media Type',
   'Import Timestamp',
   'Status',
-  'Batch ID'
+  'Batch ID',
+  'Is Update',
+  'Media Count',
+  'Media IDs'
 ];
 
 // Test function for GET requests
@@ -912,7 +920,10 @@ function importMessageData(data, existingRow, status) {
       'Media Type': data.media_type || '',
       'Import Timestamp': new Date().toISOString(),
       'Status': status || (existingRow ? 'updated' : 'imported'),
-      'Batch ID': data.batch_id || ''
+      'Batch ID': data.batch_id || '',
+      'Is Update': data.is_update || false,
+      'Media Count': data.media_count || (data.has_media ? 1 : 0),
+      'Media IDs': mediaIds(data)
     };
 
     // Fill the row based on headers
@@ -1156,11 +1167,64 @@ function batchIngestChunk(spreadsheet, payload) {
   };
 }
 
+// Columnar batches carry one array per field; repetitive fields are sent as
+// {dict: [distinct values], codes: [index per message]}, and the whole body
+// may be gzipped + base64-encoded into payload.data.
+function decodeBatchMessages(payload) {
+  if (Array.isArray(payload.messages)) return payload.messages;
+  if (payload.encoding !== 'columnar-v1') return [];
+
+  var body = payload;
+  if (payload.compression === 'gzip' && payload.data) {
+    var blob = Utilities.newBlob(Utilities.base64Decode(payload.data), 'application/x-gzip');
+    body = JSON.parse(Utilities.ungzip(blob).getDataAsString('UTF-8'));
+  }
+  var columns = body.columns || {};
+  var count = parseInt(body.count || '0', 10) || 0;
+  var messages = [];
+  for (var i = 0; i < count; i++) messages.push({});
+
+  for (var field in columns) {
+    var column = columns[field];
+    var isDict = column && !Array.isArray(column) && Array.isArray(column.codes);
+    for (var j = 0; j < count; j++) {
+      var value;
+      if (isDict) {
+        var code = column.codes[j];
+        value = code < 0 ? null : column.dict[code];
+      } else {
+        value = column[j];
+      }
+      if (value !== null && value !== undefined) messages[j][field] = value;
+    }
+  }
+  return messages;
+}
+
+// Comma-separated message IDs of a merged album's parts (the row's media list)
+function mediaIds(m) {
+  var media = Array.isArray(m.media) ? m.media : [];
+  return media.map(function(part) { return part && part.id ? String(part.id) : ''; })
+    .filter(function(id) { return id; })
+    .join(', ');
+}
+
 function finalizeBatch(spreadsheet, payload) {
   var batchId = String(payload.batch_id || '');
-  var messages = Array.isArray(payload.messages) ? payload.messages : [];
+  var messages = decodeBatchMessages(payload);
   var expected = parseInt(payload.expected_count || '0', 10) || messages.length || 0;
   var written = 0;
+  // Kept for writeExtractedProducts even when the rows below are skipped on a retry
+  var extractedMessages = messages;
+
+  // A retried batch (attempt > 1) may already have been written by an
+  // attempt whose reply timed out; don't write its rows twice.
+  if (messages.length > 0 && parseInt(payload.attempt || '1', 10) > 1) {
+    var already = countBatchMessages(spreadsheet, batchId);
+    if (already > 0) {
+      messages = [];
+    }
+  }
 
   if (messages.length > 0) {
     var sheet = getOrCreateSheet(spreadsheet, 'MessageData', MESSAGE_HEADERS);
@@ -1188,7 +1252,10 @@ function finalizeBatch(spreadsheet, payload) {
         'Media Type': m.media_type || '',
         'Import Timestamp': new Date().toISOString(),
         'Status': status || 'imported',
-        'Batch ID': m.batch_id || ''
+        'Batch ID': m.batch_id || '',
+        'Is Update': m.is_update || false,
+        'Media Count': m.media_count || (m.has_media ? 1 : 0),
+        'Media IDs': mediaIds(m)
       };
 
       for (var h = 0; h < headers.length; h++) {
@@ -1220,7 +1287,9 @@ function finalizeBatch(spreadsheet, payload) {
       written_count: written
     };
   }
-  var extraction = processBatchProducts(spreadsheet, batchId);
+  var extraction = payload.extraction === 'local'
+    ? writeExtractedProducts(spreadsheet, batchId, extractedMessages)
+    : processBatchProducts(spreadsheet, batchId);
   return {
     status: 'success',
     ack: 'ingestion_complete',
@@ -1329,6 +1398,107 @@ function checkSystemicErrors(spreadsheet) {
   }
 }
 
+// --- KEYWORD SCANNING ---
+
+// Keyword groups, the same as extraction/keywords.py in the service. A keyword is a literal or a
+// [head, tail] pair whose tail regex must follow the head; ASCII letters match in any case.
+const KEYWORD_GROUPS = {
+  out_of_stock: ['تمام', 'ناموجود', '❌'],
+  contact: ['wa.me', 'http://', 'https://', '@', '📞', 'تماس', 'واتساپ'],
+  consumer_label: ['مصرف', 'روی جلد', 'مصرف کننده'],
+  sale_label: ['فروش', 'خرید', 'ما', 'همکار', ['دونه', '\\s*ای'], 'فی'],
+  single_hint: [['دونه', '\\s*ای'], ['تک', '\\s*فروش'], ['فی', '\\s*هر\\s*عدد']],
+  packaging: ['باکس', 'کارتن', 'شیرینگ', 'ورق'],
+  // MessageClassifier
+  sold_out: ['تمام شد', 'ناموجود', '🚫'],
+  price_word: ['قیمت', 'تومان'],
+  pricing: ['قیمت', 'تومان', 'تومن', 'ت', 'ریال', 'rial', ':']
+};
+
+/**
+ * Finds every keyword of a set of groups in one pass over a text: one regex alternation,
+ * longest keyword first. Keywords inside a match (including overlapping ones) come from a
+ * table built here, and the search resumes after the match or where a keyword could start
+ * inside it and run past its end.
+ */
+function KeywordScanner(groups) {
+  const entries = {};
+  Object.keys(groups).forEach(group => {
+    groups[group].forEach(keyword => {
+      const head = (Array.isArray(keyword) ? keyword[0] : keyword).toLowerCase();
+      const tail = Array.isArray(keyword) ? new RegExp(keyword[1], 'y') : null;
+      (entries[head] = entries[head] || []).push({ group: group, tail: tail });
+    });
+  });
+  const heads = Object.keys(entries).sort((a, b) => b.length - a.length);
+  this.pattern = new RegExp(heads.map(head => head.replace(/[.*+?^${}()|[\]\\\/]/g, '\\$&')).join('|'), 'g');
+  this.folds = heads.some(head => /[a-z]/.test(head));
+  this.expansions = {};
+  heads.forEach(head => {
+    let resume = head.length;
+    for (let offset = 1; offset < head.length && resume === head.length; offset++) {
+      const rest = head.substring(offset);
+      if (heads.some(other => other.length > rest.length && other.startsWith(rest))) resume = offset;
+    }
+    const keywords = [];
+    for (let offset = 0; offset < resume; offset++) {
+      heads.forEach(other => {
+        if (!head.startsWith(other, offset)) return;
+        entries[other].forEach(entry => {
+          keywords.push({ offset: offset, length: other.length, group: entry.group, tail: entry.tail });
+        });
+      });
+    }
+    this.expansions[head] = { resume: resume, keywords: keywords };
+  });
+}
+
+/** All keyword hits ({start, end, group, keyword}) ordered by start. */
+KeywordScanner.prototype.scan = function(text) {
+  text = text || '';
+  const folded = this.folds ? text.replace(/[A-Z]+/g, letters => letters.toLowerCase()) : text;
+  const pattern = this.pattern;
+  const hits = [];
+  let match;
+  pattern.lastIndex = 0;
+  while ((match = pattern.exec(folded)) !== null) {
+    const start = match.index;
+    const expansion = this.expansions[match[0]];
+    expansion.keywords.forEach(keyword => {
+      let end = start + keyword.offset + keyword.length;
+      if (keyword.tail) {
+        keyword.tail.lastIndex = end;
+        const tailMatch = keyword.tail.exec(folded);
+        if (!tailMatch) return;
+        end += tailMatch[0].length;
+      }
+      hits.push({ start: start + keyword.offset, end: end, group: keyword.group, keyword: text.substring(start + keyword.offset, end) });
+    });
+    pattern.lastIndex = start + expansion.resume;
+  }
+  return hits;
+};
+
+/** Groups with at least one hit, as an object of group -> true. */
+KeywordScanner.prototype.groups = function(text) {
+  const found = {};
+  this.scan(text).forEach(hit => { found[hit.group] = true; });
+  return found;
+};
+
+function keywordScannerFor(groupNames) {
+  const groups = {};
+  groupNames.forEach(name => { groups[name] = KEYWORD_GROUPS[name]; });
+  return new KeywordScanner(groups);
+}
+
+// One scan per product line (analyzePricingForSegment), per segment (detectPresentationMethod)
+// and two per message (MessageClassifier: stock words on the raw text, pricing on the normalized text)
+const LINE_KEYWORDS = keywordScannerFor(['contact', 'consumer_label', 'sale_label', 'packaging']);
+const SEGMENT_KEYWORDS = keywordScannerFor(['out_of_stock', 'single_hint', 'packaging']);
+const STOCK_KEYWORDS = keywordScannerFor(['sold_out', 'price_word']);
+const PRICING_KEYWORDS = keywordScannerFor(['pricing']);
+
 // --- RECOGNITION SYSTEM ---
 
 const MessageClassifier = {
@@ -1341,16 +1511,17 @@ const MessageClassifier = {
 
   classify: function(content, channelUsername) {
     const processed = NormalizationEngine.normalize(content);
-    
-    // Check for Out of Stock intent
-    const isOOS = /(?:تمام شد|ناموجود|🚫)/i.test(content);
-    if (isOOS && !/(?:قیمت|تومان)/i.test(content)) {
+
+    // Check for Out of Stock intent; on the raw text, since normalizing whitespace
+    // would turn "تمام\nشد" into a match
+    const stock = STOCK_KEYWORDS.groups(content);
+    if (stock.sold_out && !stock.price_word) {
       return { type: this.types.OUT_OF_STOCK, confidence: 0.9 };
     }
 
     // Check for Pricing keywords
-    const hasPricing = /(?:قیمت|تومان|تومن|ت|ریال|rial|:|[\d]+\/[\d]+)/i.test(processed);
-    const hasNumbers = /\d+/.test(processed);
+    const hasPricing = PRICING_KEYWORDS.groups(processed).pricing || /\d+\/\d+/.test(processed);
+    const hasNumbers = /\d/.test(processed);
     
     if (hasPricing && hasNumbers) {
       // High confidence if it has specific channel patterns
@@ -1370,7 +1541,7 @@ const MessageClassifier = {
 const NormalizationEngine = {
   normalize: function(text) {
     if (!text) return '';
-    let result = persianToEnglishNumbers(text);
+    let result = persianToEnglishNumbers(text).replace(/[\u064A\u0643]/g, char => ARABIC_LETTER_MAP[char]);
     // Remove zero-width spaces and normalize other whitespace
     result = result.replace(/[\u200B-\u200D\uFEFF]/g, '');
     result = result.replace(/\s+/g, ' ');
@@ -1811,9 +1982,9 @@ function inferPriceTypeFromPackaging(packaging) {
 }
 
 function detectPresentationMethod(segment) {
-  const s = segment || '';
-  const hasSingle = /(?:دونه\s*ای|تک\s*فروش|فی\s*هر\s*عدد)/i.test(s);
-  const hasPack = /(?:باکس|کارتن|شیرینگ|ورق)/i.test(s);
+  const found = SEGMENT_KEYWORDS.groups(segment || '');
+  const hasSingle = !!found.single_hint;
+  const hasPack = !!found.packaging;
   if (hasSingle && hasPack) return 'both';
   if (hasPack) return 'pack_only';
   if (hasSingle) return 'single_only';
@@ -1847,24 +2018,24 @@ function analyzePricingForSegment(lines) {
   const candidates = [];
   lines.forEach(line => {
     const norm = NormalizationEngine.normalize(line).replace(/(\d+)\/(\d+)/g, '$1$2').replace(/[,.\u066B]/g, '');
-    const isContact = /(wa\.me|https?:\/\/|@|📞|تماس|واتساپ)/i.test(line);
+    const found = LINE_KEYWORDS.groups(line);
     const nums = norm.match(/\b\d{4,}\b/g);
-    if (nums && !isContact) {
+    if (nums && !found.contact) {
       nums.forEach(n => {
         if (n.length >= 4 && n.length <= 8) candidates.push(parseInt(n, 10));
       });
     }
     // Label-based assignment
-    if (/(?:مصرف|روی جلد|مصرف کننده)/i.test(line)) {
+    if (found.consumer_label) {
       const m = norm.match(/\b\d{4,}\b/);
       if (m) result.actual_price = NormalizationEngine.parsePrice(m[0]);
     }
-    if (/(?:فروش|خرید|ما|همکار|دونه\s*ای|فی)/i.test(line)) {
+    if (found.sale_label) {
       const m = norm.match(/\b\d{4,}\b/);
       if (m) result.sale_price = NormalizationEngine.parsePrice(m[0]);
     }
     // Pack hints
-    if (/(?:باکس|کارتن|شیرینگ|ورق)/i.test(line)) {
+    if (found.packaging) {
       result.price_type = 'pack';
     }
   });
@@ -2141,6 +2312,126 @@ function extractContactInfo(content, customPatterns) {
   return '';
 }
 
+// Bulk path for payload.extraction === 'local': the service already ran
+// extractProducts and the discount/confidence checks, so each message
+// carries its products (and review_reason). The Products sheet is read once,
+// matched in memory by name + channel like findExistingProduct, and written
+// with one setValues per updated row plus one for all new rows. Messages
+// without a products array (extraction failed service-side) go through
+// importProductData as in processBatchProducts.
+function writeExtractedProducts(spreadsheet, batchId, messages) {
+  var sheet = getOrCreateSheet(spreadsheet, 'Products', PRODUCT_HEADERS);
+  var values = sheet.getDataRange().getValues();
+  var headers = values[0];
+  var nameIdx = headers.indexOf('Product Name');
+  var channelIdx = headers.indexOf('Channel Username');
+  var saleIdx = headers.indexOf('Sale Price');
+
+  var rowsByKey = {};
+  var history = {};
+  for (var i = 1; i < values.length; i++) {
+    var existingName = values[i][nameIdx] ? values[i][nameIdx].toString().toLowerCase() : '';
+    if (!existingName) continue;
+    var existingKey = existingName + '\u0001' + values[i][channelIdx];
+    if (rowsByKey[existingKey] === undefined) rowsByKey[existingKey] = i;
+    var v = parseInt(values[i][saleIdx], 10);
+    if (!isNaN(v) && v > 0) {
+      var h = history[existingName] || (history[existingName] = { sum: 0, count: 0 });
+      h.sum += v;
+      h.count++;
+    }
+  }
+
+  var newRows = [];
+  var newRowsByKey = {};
+  var updatedRows = {};
+  var fallback = [];
+  var processed = 0;
+
+  for (var m = 0; m < messages.length; m++) {
+    var msg = messages[m] || {};
+    msg.batch_id = batchId;
+    if (!Array.isArray(msg.products)) {
+      fallback.push(msg);
+      continue;
+    }
+    for (var p = 0; p < msg.products.length; p++) {
+      var product = msg.products[p];
+      var name = String(product.name || '').toLowerCase();
+
+      // Price-history part of performQualityChecks
+      var reason = product.review_reason || '';
+      var past = history[name];
+      if (past && past.count >= 3) {
+        var avg = past.sum / past.count;
+        var salePrice = product.sale_price || product.price || 0;
+        if (Math.abs(salePrice - avg) / avg > 0.5) {
+          reason = reason ? (reason + '; deviates from history') : 'Deviates from history';
+        }
+      }
+      if (reason) {
+        product.status = 'needs_review';
+        logExtractionIssue(spreadsheet, 'WARN', msg.id, reason);
+      } else {
+        product.status = 'imported';
+      }
+
+      // Like findExistingProduct, a product without a name never matches a row
+      var key = name ? name + '\u0001' + (msg.channel_username || '') : null;
+      if (key === null) {
+        newRows.push(createProductRow(sheet, product, msg, headers));
+      } else if (rowsByKey[key] !== undefined) {
+        applyProductUpdate(headers, values[rowsByKey[key]], product, msg);
+        updatedRows[rowsByKey[key]] = true;
+      } else if (newRowsByKey[key] !== undefined) {
+        applyProductUpdate(headers, newRows[newRowsByKey[key]], product, msg);
+      } else {
+        newRowsByKey[key] = newRows.length;
+        newRows.push(createProductRow(sheet, product, msg, headers));
+      }
+    }
+    processed++;
+  }
+
+  for (var row in updatedRows) {
+    var r = parseInt(row, 10);
+    sheet.getRange(r + 1, 1, 1, headers.length).setValues([values[r]]);
+  }
+  if (newRows.length > 0) {
+    sheet.getRange(sheet.getLastRow() + 1, 1, newRows.length, headers.length).setValues(newRows);
+  }
+
+  for (var f = 0; f < fallback.length; f++) {
+    var ok = false;
+    for (var attempt = 0; attempt < 3 && !ok; attempt++) {
+      var res = importProductData(fallback[f]);
+      ok = !!res && !!res.success;
+    }
+    if (!ok) {
+      deleteProductsByBatchId(spreadsheet, batchId);
+      return { status: 'error', processed: processed, rollback: true };
+    }
+    processed++;
+  }
+  return { status: 'success', processed: processed };
+}
+
+// In-memory counterpart of updateProduct for a row array
+function applyProductUpdate(headers, row, product, messageData) {
+  var updates = productUpdates(product, messageData);
+  for (var u = 0; u < updates.length; u++) {
+    var col = headers.indexOf(updates[u].header);
+    if (col === -1) continue;
+    var value = updates[u].value;
+    if (value === undefined || value === null) {
+      if (updates[u].updateOnly) continue;
+      value = '';
+    }
+    row[col] = value;
+  }
+  return row;
+}
+
 function findExistingProduct(sheet, productName, channelUsername) {
   try {
     const data = sheet.getDataRange().getValues();
@@ -2174,38 +2465,43 @@ function findExistingProduct(sheet, productName, channelUsername) {
   }
 }
 
+// Columns updateProduct writes; updateOnly columns keep their value when the new one is missing
+function productUpdates(product, messageData) {
+  return [
+    { header: 'Channel ID', value: messageData.channel_username || messageData.channel || '' },
+    { header: 'Product Name', value: product.name },
+    { header: 'Variation Type', value: product.variation_type || '' },
+    { header: 'Sale Price', value: product.sale_price, updateOnly: true },
+    { header: 'Actual Price', value: product.actual_price, updateOnly: true },
+    { header: 'Price Type', value: product.price_type || '' },
+    { header: 'Price', value: product.price, updateOnly: true },
+    { header: 'Currency', value: product.currency },
+    { header: 'Consumer Price', value: product.consumer_price, updateOnly: true },
+    { header: 'Double Pack Price', value: product.double_pack_price, updateOnly: true },
+    { header: 'Double Pack Consumer Price', value: product.double_pack_consumer_price, updateOnly: true },
+    { header: 'Packaging', value: product.packaging },
+    { header: 'Volume', value: product.volume },
+    { header: 'Category', value: product.category },
+    { header: 'Description', value: product.description, updateOnly: true },
+    { header: 'Stock Status', value: product.stock_status },
+    { header: 'Location', value: product.location },
+    { header: 'Contact Info', value: product.contact_info },
+    { header: 'Original Message', value: messageData.content },
+    { header: 'Channel', value: messageData.channel },
+    { header: 'Channel Username', value: messageData.channel_username },
+    { header: 'Message Timestamp', value: messageData.timestamp },
+    { header: 'Forwarded By', value: messageData.forwarded_by },
+    { header: 'Last Updated', value: new Date().toISOString() },
+    { header: 'Extraction Confidence Score', value: product.extraction_confidence || product.confidence },
+    { header: 'Confidence', value: product.confidence },
+    { header: 'Status', value: product.status || 'updated' }
+  ];
+}
+
 function updateProduct(sheet, rowNumber, product, messageData) {
   try {
     // Update individual cells using dynamic column lookup (flexible positioning)
-    const updates = [
-      { header: 'Channel ID', value: messageData.channel_username || messageData.channel || '' },
-      { header: 'Product Name', value: product.name },
-      { header: 'Variation Type', value: product.variation_type || '' },
-      { header: 'Sale Price', value: product.sale_price, updateOnly: true },
-      { header: 'Actual Price', value: product.actual_price, updateOnly: true },
-      { header: 'Price Type', value: product.price_type || '' },
-      { header: 'Price', value: product.price, updateOnly: true },
-      { header: 'Currency', value: product.currency },
-      { header: 'Consumer Price', value: product.consumer_price, updateOnly: true },
-      { header: 'Double Pack Price', value: product.double_pack_price, updateOnly: true },
-      { header: 'Double Pack Consumer Price', value: product.double_pack_consumer_price, updateOnly: true },
-      { header: 'Packaging', value: product.packaging },
-      { header: 'Volume', value: product.volume },
-      { header: 'Category', value: product.category },
-      { header: 'Description', value: product.description, updateOnly: true },
-      { header: 'Stock Status', value: product.stock_status },
-      { header: 'Location', value: product.location },
-      { header: 'Contact Info', value: product.contact_info },
-      { header: 'Original Message', value: messageData.content },
-      { header: 'Channel', value: messageData.channel },
-      { header: 'Channel Username', value: messageData.channel_username },
-      { header: 'Message Timestamp', value: messageData.timestamp },
-      { header: 'Forwarded By', value: messageData.forwarded_by },
-      { header: 'Last Updated', value: new Date().toISOString() },
-      { header: 'Extraction Confidence Score', value: product.extraction_confidence || product.confidence },
-      { header: 'Confidence', value: product.confidence },
-      { header: 'Status', value: product.status || 'updated' }
-    ];
+    const updates = productUpdates(product, messageData);
 
     // Apply each update
     for (const update of updates) {
@@ -2230,8 +2526,8 @@ function updateProduct(sheet, rowNumber, product, messageData) {
   }
 }
 
-function createProductRow(sheet, product, messageData) {
-  const headers = sheet.getRange(1, 1, 1, sheet.getLastColumn()).getValues()[0];
+function createProductRow(sheet, product, messageData, knownHeaders) {
+  const headers = knownHeaders || sheet.getRange(1, 1, 1, sheet.getLastColumn()).getValues()[0];
   const row = new Array(headers.length).fill('');
   
   // Map header names to indices
@@ -0,0 +1,75 @@
+"""
+Gunicorn settings for the Flask webhook app (loaded automatically from the working directory).
+
+With more than one worker, the master starts a single batch coordinator
+process (utils.batch_coordinator) before forking workers and passes its
+socket path to them in BATCH_COORDINATOR_SOCKET, so every worker feeds the
+same buffer, spool and de-duplicator. The coordinator is restarted if it
+exits and stopped (draining buffered batches) when gunicorn shuts down.
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+timeout = 0
+
+COORDINATOR_START_TIMEOUT_SEC = 10.0
+
+coordinator = {'process': None, 'stopping': False}
+
+def _spawn_coordinator(socket_path):
+    return subprocess.Popen([sys.executable, '-m', 'utils.batch_coordinator', socket_path],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), start_new_session=True)
+
+def _wait_for_socket(socket_path, process):
+    deadline = time.monotonic() + COORDINATOR_START_TIMEOUT_SEC
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(socket_path)
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def _watch_coordinator(server, socket_path):
+    while True:
+        code = coordinator['process'].wait()
+        if coordinator['stopping']:
+            return
+        server.log.error(f"Batch coordinator exited with code {code}; restarting")
+        time.sleep(1)
+        coordinator['process'] = _spawn_coordinator(socket_path)
+
+def on_starting(server):
+    if server.cfg.workers <= 1 or server.cfg.worker_class_str not in ('sync', 'gthread'):
+        return
+    socket_path = os.getenv('BATCH_COORDINATOR_SOCKET') or os.path.join(
+        tempfile.gettempdir(), f"telegram-batch-{os.getpid()}.sock")
+    coordinator['process'] = _spawn_coordinator(socket_path)
+    if not _wait_for_socket(socket_path, coordinator['process']):
+        raise RuntimeError(f"Batch coordinator did not start on {socket_path}")
+    # Inherited by the workers forked after this hook
+    os.environ['BATCH_COORDINATOR_SOCKET'] = socket_path
+    server.log.info(f"Batch coordinator started on {socket_path} for {server.cfg.workers} workers")
+    threading.Thread(target=_watch_coordinator, args=(server, socket_path),
+                     name='coordinator-watchdog', daemon=True).start()
+
+def on_exit(server):
+    process = coordinator['process']
+    if process is None:
+        return
+    coordinator['stopping'] = True
+    process.terminate()
+    try:
+        process.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        process.kill()
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+"""
+Offline load test for the /webhook -> BatchManager -> Apps Script path.
+
+Generates synthetic Telegram updates, serves app.py in-process (or targets
+an already running server with --url) and points it at a local stand-in
+for the Apps Script web app that answers like finalizeBatch, with
+configurable latency and lock-timeout errors. Reports webhook throughput
+and p50/p99 latency, and end-to-end p50/p99 from the webhook POST to the
+stub acknowledging the batch that carried the message.
+
+Examples:
+    python load_test.py --updates 5000 --concurrency 32
+    python load_test.py --gas-latency 2 --gas-per-message 0.01 --lock-timeout-rate 0.1
+    python load_test.py --rate 200 --duration 30 --json
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from utils.wire_format import decode_columns
+
+SAMPLE_TEXTS = [
+    "کنسرو ماهی ۱۸۰ گرمی تاپ\n✅\nقیمت هر باکس: ۱,۲۵۰,۰۰۰ تومان\nدونه ای: ۵۲,۰۰۰ تومان\nموجود ✅",
+    "کاپوچینو گوددی ۳۰ تایی\n: ۷۵/۰۰۰\n\nهات چاکلت ۲۰ تایی\n: ۶۵/۰۰۰\n\n📍 میدان محمدیه پلاک ۱۰",
+    "روغن سرخ کردنی ۱.۵ لیتری\nقیمت: ۲۳۵,۰۰۰ تومان\nکارتن ۶ عددی",
+    "برنج طارم ۱۰ کیلویی\nفی: ۱,۸۵۰,۰۰۰\nارسال به سراسر کشور",
+    "Nescafe Gold 200g - 420,000\nLavazza Oro 250g - 510,000",
+]
+
+class UpdateGenerator:
+    """
+    Produces synthetic Telegram updates with a configurable mix.
+
+    Forwards come from ``channels`` channel origins or from user origins;
+    the rest are direct text messages. Media updates carry the text as a
+    caption. A fraction of updates re-forward an earlier channel post or
+    repeat an earlier ``update_id`` so the de-duplicator is exercised.
+    """
+
+    def __init__(self, forward_ratio=0.9, user_origin_ratio=0.1, channels=20, media_ratio=0.3,
+                 caption_ratio=0.8, duplicate_ratio=0.02, seed=1):
+        """
+        Initialize the generator.
+
+        Args:
+            forward_ratio: Fraction of updates that are forwards
+            user_origin_ratio: Fraction of forwards whose origin is a user rather than a channel
+            channels: Number of distinct source channels
+            media_ratio: Fraction of updates carrying a photo, video or document
+            caption_ratio: Fraction of media updates that have a caption
+            duplicate_ratio: Fraction of updates that repeat an earlier post or update_id
+            seed: Random seed, so runs are comparable
+        """
+        self.forward_ratio = forward_ratio
+        self.user_origin_ratio = user_origin_ratio
+        self.channels = channels
+        self.media_ratio = media_ratio
+        self.caption_ratio = caption_ratio
+        self.duplicate_ratio = duplicate_ratio
+        self.random = random.Random(seed)
+        self.next_id = 1
+        self.history = []
+
+    def generate(self):
+        """
+        Build the next update.
+
+        Returns:
+            Tuple of (update dictionary, message ID the row will carry, or
+            None if the update is expected to be dropped as a duplicate)
+        """
+        rnd = self.random
+        if self.history and rnd.random() < self.duplicate_ratio:
+            update = json.loads(json.dumps(rnd.choice(self.history)))
+            if rnd.random() < 0.5:
+                # Same post forwarded again by someone else
+                update['update_id'] = self._take_id()
+                update['message']['message_id'] = update['update_id']
+            return update, None
+
+        update_id = self._take_id()
+        text = rnd.choice(SAMPLE_TEXTS)
+        message = {
+            'message_id': update_id,
+            'from': {'id': 1000 + rnd.randrange(50), 'username': f"tester{rnd.randrange(50)}"},
+            'chat': {'id': 1000 + rnd.randrange(50), 'type': 'private'},
+            'date': int(time.time())
+        }
+
+        if rnd.random() < self.media_ratio:
+            kind = rnd.choice(['photo', 'video', 'document'])
+            if kind == 'photo':
+                message['photo'] = [{'file_id': f"p{update_id}", 'width': 1280, 'height': 1280}]
+            else:
+                message[kind] = {'file_id': f"{kind[0]}{update_id}"}
+            if rnd.random() < self.caption_ratio:
+                message['caption'] = text
+        else:
+            message['text'] = text
+
+        if rnd.random() < self.forward_ratio:
+            if rnd.random() < self.user_origin_ratio:
+                message['forward_origin'] = {
+                    'type': 'user',
+                    'sender_user': {'id': 42, 'first_name': 'Seller', 'username': 'seller'},
+                    'date': message['date'] - 60
+                }
+            else:
+                channel = rnd.randrange(self.channels)
+                message['forward_origin'] = {
+                    'type': 'channel',
+                    'chat': {'id': -1000000 - channel, 'title': f"Channel {channel}", 'username': f"channel{channel}"},
+                    'message_id': update_id,
+                    'date': message['date'] - 60
+                }
+        elif 'text' not in message:
+            # Direct messages without text are ignored by the webhook
+            message['text'] = text
+
+        update = {'update_id': update_id, 'message': message}
+        if 'forward_origin' in message and message['forward_origin']['type'] == 'channel':
+            self.history.append(update)
+            if len(self.history) > 1000:
+                self.history.pop(0)
+        return update, str(update_id)
+
+    def _take_id(self):
+        update_id = self.next_id
+        self.next_id += 1
+        return update_id
+
+class AppsScriptStub:
+    """
+    Local HTTP stand-in for the Apps Script web app.
+
+    Answers batch_ingest posts like finalizeBatch, after sleeping
+    ``latency + per_message * len(messages)`` seconds. With probability
+    ``lock_timeout_rate`` it instead answers like doPost when
+    ``LockService`` times out. Apps Script runs one execution at a time
+    under the script lock, so requests are served one by one.
+    """
+
+    def __init__(self, latency=1.0, per_message=0.005, lock_timeout_rate=0.0, seed=1):
+        self.latency = latency
+        self.per_message = per_message
+        self.lock_timeout_rate = lock_timeout_rate
+        self.random = random.Random(seed)
+        self.script_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.delivered = {}
+        self.batches = 0
+        self.batch_sizes = []
+        self.lock_timeouts = 0
+        self.server = None
+
+    def start(self, port=0):
+        """Start serving on 127.0.0.1 and return the web app URL."""
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                reply = stub.handle(json.loads(raw or b'{}'))
+                body = json.dumps(reply).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                body = b'{"status": "ok"}'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='gas-stub', daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}/exec"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def handle(self, payload):
+        with self.script_lock:
+            with self.lock:
+                lock_timeout = self.random.random() < self.lock_timeout_rate
+            if lock_timeout:
+                with self.lock:
+                    self.lock_timeouts += 1
+                return {'status': 'error', 'message': 'Server busy, please try again later (Lock timeout)'}
+
+            messages = decode_batch_messages(payload)
+            time.sleep(self.latency + self.per_message * len(messages))
+            now = time.monotonic()
+            with self.lock:
+                self.batches += 1
+                self.batch_sizes.append(len(messages))
+                for message in messages:
+                    self.delivered.setdefault(str(message.get('id')), now)
+            return {
+                'status': 'success',
+                'ack': 'ingestion_complete',
+                'batch_id': payload.get('batch_id'),
+                'expected_count': len(messages),
+                'written_count': len(messages),
+                'extraction_status': 'skipped',
+                'processed_messages': len(messages),
+                'rollback': False
+            }
+
+def decode_batch_messages(payload):
+    """Python counterpart of decodeBatchMessages in google_apps_script.js."""
+    if isinstance(payload.get('messages'), list):
+        return payload['messages']
+    if payload.get('compression') == 'gzip':
+        body = json.loads(gzip.decompress(base64.b64decode(payload['data'])).decode('utf-8'))
+    else:
+        body = payload
+    if 'columns' not in body:
+        return []
+    return decode_columns(body)
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers, or None if it is empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_local_app(gas_url, spool_path):
+    """
+    Import app.py against the stub and serve it on a local port.
+
+    Returns:
+        Tuple of (webhook URL, imported app module)
+    """
+    os.environ['GOOGLE_WEB_APP_URL'] = gas_url
+    os.environ['WEBHOOK_SPOOL_PATH'] = spool_path
+    # No real bot: skip the Telegram Application and status notifications
+    os.environ.pop('TELEGRAM_BOT_TOKEN', None)
+    os.environ.pop('BATCH_COORDINATOR_SOCKET', None)
+
+    import app as webhook_app
+    from werkzeug.serving import make_server
+
+    port = free_port()
+    server = make_server('127.0.0.1', port, webhook_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='webhook-server', daemon=True).start()
+    return f"http://127.0.0.1:{port}/webhook", webhook_app
+
+def run_load(url, updates, concurrency, rate=None):
+    """
+    POST updates to the webhook and time each request.
+
+    Args:
+        url: Webhook URL
+        updates: List of (update, expected message ID or None)
+        concurrency: Number of sender threads
+        rate: Target updates per second, or None to send as fast as possible
+
+    Returns:
+        Tuple of (send start time by message ID, webhook latencies, status counts, elapsed seconds)
+    """
+    local = threading.local()
+    sent_at = {}
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    started = time.monotonic()
+
+    def send(index):
+        update, message_id = updates[index]
+        if rate:
+            delay = started + index / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        begin = time.monotonic()
+        try:
+            resp = session.post(url, json=update, timeout=30)
+            status = resp.json().get('status', str(resp.status_code)) if resp.ok else f"http_{resp.status_code}"
+        except Exception:
+            status = 'exception'
+        elapsed = time.monotonic() - begin
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            if message_id is not None and status == 'success':
+                sent_at[message_id] = begin
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(len(updates))))
+    return sent_at, latencies, statuses, time.monotonic() - started
+
+def wait_for_delivery(stub, expected, timeout):
+    """Wait until the stub has acknowledged every expected message or the timeout passes."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with stub.lock:
+            if all(message_id in stub.delivered for message_id in expected):
+                return
+        time.sleep(0.1)
+
+def build_report(stub, sent_at, latencies, statuses, send_seconds, load_started):
+    with stub.lock:
+        delivered = dict(stub.delivered)
+        batch_sizes = list(stub.batch_sizes)
+        lock_timeouts = stub.lock_timeouts
+    e2e = [delivered[mid] - sent_at[mid] for mid in sent_at if mid in delivered]
+    accepted = statuses.get('success', 0)
+    last_delivery = max((delivered[mid] for mid in sent_at if mid in delivered), default=None)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 1)
+
+    return {
+        'updates_sent': len(latencies),
+        'statuses': statuses,
+        'send_seconds': round(send_seconds, 2),
+        'webhook_throughput_per_sec': round(len(latencies) / send_seconds, 1) if send_seconds else None,
+        'webhook_p50_ms': ms(percentile(latencies, 50)),
+        'webhook_p99_ms': ms(percentile(latencies, 99)),
+        'delivered': len(e2e),
+        'undelivered': accepted - len(e2e),
+        'delivered_throughput_per_sec': round(len(e2e) / (last_delivery - load_started), 1) if last_delivery else None,
+        'e2e_p50_ms': ms(percentile(e2e, 50)),
+        'e2e_p99_ms': ms(percentile(e2e, 99)),
+        'batches': len(batch_sizes),
+        'avg_batch_size': round(sum(batch_sizes) / len(batch_sizes), 1) if batch_sizes else None,
+        'lock_timeouts_injected': lock_timeouts
+    }
+
+def print_report(report):
+    print("=" * 50)
+    print("Webhook load test")
+    print("=" * 50)
+    print(f"Updates sent:        {report['updates_sent']} in {report['send_seconds']}s")
+    print(f"Webhook responses:   {report['statuses']}")
+    print(f"Webhook throughput:  {report['webhook_throughput_per_sec']} updates/s")
+    print(f"Webhook latency:     p50 {report['webhook_p50_ms']} ms, p99 {report['webhook_p99_ms']} ms")
+    print(f"Delivered to stub:   {report['delivered']} ({report['undelivered']} accepted but not acknowledged)")
+    print(f"Delivered throughput: {report['delivered_throughput_per_sec']} messages/s")
+    print(f"End-to-end latency:  p50 {report['e2e_p50_ms']} ms, p99 {report['e2e_p99_ms']} ms")
+    print(f"Batches:             {report['batches']} (avg {report['avg_batch_size']} messages)")
+    print(f"Lock timeouts:       {report['lock_timeouts_injected']}")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Offline load test for the webhook batching pipeline')
+    parser.add_argument('--updates', type=int, default=2000, help='Number of updates to send')
+    parser.add_argument('--duration', type=float, help='With --rate, send for this many seconds instead of --updates')
+    parser.add_argument('--rate', type=float, help='Target updates per second (default: as fast as possible)')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent webhook senders')
+    parser.add_argument('--url', help='Webhook URL of an already running server (default: serve app.py in-process)')
+    parser.add_argument('--stub-port', type=int, default=0,
+                        help='Port for the Apps Script stub; with --url, start the server with '
+                             'GOOGLE_WEB_APP_URL=http://127.0.0.1:<port>/exec')
+    parser.add_argument('--gas-latency', type=float, default=1.0, help='Stub base latency per batch, in seconds')
+    parser.add_argument('--gas-per-message', type=float, default=0.005, help='Stub extra latency per message, in seconds')
+    parser.add_argument('--lock-timeout-rate', type=float, default=0.0, help='Fraction of batches answered with a lock timeout')
+    parser.add_argument('--forward-ratio', type=float, default=0.9, help='Fraction of updates that are forwards')
+    parser.add_argument('--user-origin-ratio', type=float, default=0.1, help='Fraction of forwards from user origins')
+    parser.add_argument('--channels', type=int, default=20, help='Distinct source channels')
+    parser.add_argument('--media-ratio', type=float, default=0.3, help='Fraction of updates with media')
+    parser.add_argument('--caption-ratio', type=float, default=0.8, help='Fraction of media updates with a caption')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.02, help='Fraction of repeated updates and forwards')
+    parser.add_argument('--no-spool', action='store_true', help='Disable the webhook spool in the in-process app')
+    parser.add_argument('--drain-timeout', type=float, default=60.0, help='Seconds to wait for outstanding batches')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Keep the app INFO logging')
+    return parser.parse_args()
+
+def main():
+    """Main execution function."""
+    args = parse_arguments()
+
+    stub = AppsScriptStub(latency=args.gas_latency, per_message=args.gas_per_message,
+                          lock_timeout_rate=args.lock_timeout_rate, seed=args.seed)
+    gas_url = stub.start(args.stub_port)
+
+    workdir = tempfile.mkdtemp(prefix='load_test_')
+    url = args.url
+    webhook_app = None
+    if not url:
+        spool_path = '' if args.no_spool else os.path.join(workdir, 'webhook_spool.jsonl')
+        url, webhook_app = start_local_app(gas_url, spool_path)
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    print(f"Apps Script stub: {gas_url}", file=sys.stderr)
+    print(f"Webhook: {url}", file=sys.stderr)
+
+    generator = UpdateGenerator(
+        forward_ratio=args.forward_ratio, user_origin_ratio=args.user_origin_ratio, channels=args.channels,
+        media_ratio=args.media_ratio, caption_ratio=args.caption_ratio,
+        duplicate_ratio=args.duplicate_ratio, seed=args.seed
+    )
+    count = int(args.rate * args.duration) if args.rate and args.duration else args.updates
+    updates = [generator.generate() for _ in range(count)]
+
+    load_started = time.monotonic()
+    sent_at, latencies, statuses, send_seconds = run_load(url, updates, args.concurrency, args.rate)
+    wait_for_delivery(stub, list(sent_at), args.drain_timeout)
+
+    report = build_report(stub, sent_at, latencies, statuses, send_seconds, load_started)
+    if webhook_app is not None and webhook_app.batch_manager is not None:
+        report['flush_policy'] = webhook_app.batch_manager.policy.stats()
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+    stub.stop()
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,9 @@ Posts data to a Google Apps Script web app.
 
 import time
 import logging
-import requests
 from channels.telegram_bot_reader import TelegramBotReader
 from utils.config import load_config
+from utils.http_client import get_http_client
 from utils.logger import setup_logger
 
 class SimpleAutoImporter:
@@ -83,7 +83,7 @@ class SimpleAutoImporter:
             }
 
             # Send to Google Apps Script
-            response = requests.post(self.web_app_url, json=data, timeout=30)
+            response = get_http_client().post(self.web_app_url, endpoint='apps_script', json=data)
 
             if response.status_code == 200:
                 print(f"SUCCESS: Imported message from {data['channel']}")
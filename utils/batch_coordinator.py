@@ -0,0 +1,346 @@
+"""
+Host-wide batch coordinator shared by all gunicorn workers.
+
+With more than one worker, each process would otherwise keep its own
+buffer, timer and spool, send small fragmented batches and generate
+colliding batch IDs. Instead one coordinator process owns the single
+BatchManager, spool and de-duplicator, and workers talk to it over a Unix
+socket with newline-delimited JSON requests:
+
+    {"op": "add", "data": {...}}      -> {"ok": true}
+    {"op": "check", "key": "u:123"}   -> {"ok": true, "duplicate": false}
+    {"op": "forget", "key": "u:123"}  -> {"ok": true}
+    {"op": "content", "key": "o:-100:5", "digest": "..."} -> {"ok": true, "outcome": "changed", "previous": "..."}
+    {"op": "restore", "key": "o:-100:5", "digest": "...", "previous": "..."} -> {"ok": true}
+    {"op": "overloaded"}              -> {"ok": true, "overloaded": false}
+    {"op": "stats"}                   -> {"ok": true, "dedup": {...}, "content_index": {...}, "batching": {...}}
+    {"op": "metrics"}                 -> {"ok": true, "text": "..."}
+    {"op": "gas_health"}              -> {"ok": true, "status": "connected", "stats": {...}}
+
+``add`` answers only after the message is in the spool, so a worker's 200
+to Telegram still means the message is durable. Batch IDs are generated by
+the coordinator alone and are therefore unique across the host. The
+coordinator also runs the only Apps Script health probe, so adding workers
+does not multiply the probe traffic.
+
+Run with:
+    python -m utils.batch_coordinator /tmp/telegram-batch.sock
+gunicorn.conf.py starts it automatically when gunicorn runs more than one worker.
+"""
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from utils.batch_manager import create_batch_manager
+from utils.dedup import create_content_index, create_deduplicator, forward_origin_key, update_key
+from utils.health_probe import GasHealthProbe
+from utils.metrics import REGISTRY
+from utils.pipeline_metrics import register_pipeline_gauges
+
+logger = logging.getLogger(__name__)
+
+# Metrics recorded by the workers themselves; everything else comes from the coordinator
+WORKER_METRIC_PREFIXES = ('webhook_',)
+# Workers cache the coordinator's load-shedding verdict for this long
+OVERLOAD_CHECK_SEC = 0.5
+
+class CoordinatorError(RuntimeError):
+    """Raised when the coordinator rejects a request."""
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Serves one worker connection until the worker disconnects."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.dispatch(json.loads(line))
+            except Exception as e:
+                logger.error(f"Coordinator request failed: {e}")
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+
+class BatchCoordinator(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server in front of one BatchManager, UpdateDeduplicator and ContentHashIndex.
+
+    Each worker connection is served by its own thread, so spool fsyncs of
+    concurrent ``add`` requests are still group-committed.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, manager, deduplicator, content_index, gas_probe=None):
+        """
+        Bind the coordinator socket.
+
+        Args:
+            socket_path: Filesystem path of the Unix socket
+            manager: BatchManager messages are handed to, or None if Apps Script is not configured
+            deduplicator: UpdateDeduplicator shared by all workers
+            content_index: ContentHashIndex shared by all workers
+            gas_probe: GasHealthProbe whose results are served to workers, or None
+        """
+        self.manager = manager
+        self.deduplicator = deduplicator
+        self.content_index = content_index
+        self.gas_probe = gas_probe
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+
+    def dispatch(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        op = request.get('op')
+        if op == 'add':
+            if self.manager is None:
+                return {'ok': False, 'error': 'GOOGLE_WEB_APP_URL not configured'}
+            self.manager.add_message(request['data'])
+            return {'ok': True}
+        if op == 'check':
+            return {'ok': True, 'duplicate': self.deduplicator.check_and_add(request['key'])}
+        if op == 'forget':
+            self.deduplicator.forget(request['key'])
+            return {'ok': True}
+        if op == 'content':
+            outcome, previous = self.content_index.exchange(request['key'], request['digest'])
+            return {'ok': True, 'outcome': outcome, 'previous': previous}
+        if op == 'restore':
+            self.content_index.restore(request['key'], request['digest'], request.get('previous'))
+            return {'ok': True}
+        if op == 'overloaded':
+            return {'ok': True, 'overloaded': self.manager is not None and self.manager.is_overloaded()}
+        if op == 'stats':
+            batching = None
+            if self.manager is not None:
+                batching = {
+                    'buffer_depth': self.manager.buffer_depth(),
+                    'send_queue_depth': self.manager.send_queue.qsize(),
+                    'oldest_unflushed_age': self.manager.oldest_unflushed_age(),
+                    'policy': self.manager.policy.stats(),
+                    'delivery': self.manager.delivery_stats(),
+                }
+            return {'ok': True, 'dedup': self.deduplicator.stats(), 'content_index': self.content_index.stats(),
+                    'batching': batching}
+        if op == 'metrics':
+            return {'ok': True, 'text': REGISTRY.render(skip_prefixes=WORKER_METRIC_PREFIXES)}
+        if op == 'gas_health':
+            if self.gas_probe is None:
+                return {'ok': True, 'status': 'unknown', 'stats': None}
+            return {'ok': True, 'status': self.gas_probe.status(), 'stats': self.gas_probe.stats()}
+        return {'ok': False, 'error': f"Unknown op: {op}"}
+
+class CoordinatorClient:
+    """
+    Worker-side handle to the coordinator, usable in place of a BatchManager.
+
+    Each worker thread keeps its own connection and reconnects once if the
+    coordinator was restarted since the connection was opened.
+    """
+
+    def __init__(self, socket_path: str, timeout: float = 60.0):
+        """
+        Initialize the client.
+
+        Args:
+            socket_path: Filesystem path of the coordinator socket
+            timeout: Socket timeout per request, in seconds
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.overloaded = (0.0, False)
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.local.sock = sock
+        self.local.reader = sock.makefile('rb')
+
+    def _disconnect(self):
+        sock = getattr(self.local, 'sock', None)
+        if sock is not None:
+            try:
+                self.local.reader.close()
+                sock.close()
+            except OSError:
+                pass
+        self.local.sock = None
+
+    def call(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Send one request and wait for its response.
+
+        Args:
+            request: Request dictionary with an ``op`` key
+
+        Returns:
+            Response dictionary
+
+        Raises:
+            CoordinatorError: If the coordinator reports an error
+            OSError: If the coordinator cannot be reached
+        """
+        payload = json.dumps(request, ensure_ascii=False).encode('utf-8') + b'\n'
+        reused = getattr(self.local, 'sock', None) is not None
+        while True:
+            if getattr(self.local, 'sock', None) is None:
+                self._connect()
+            try:
+                self.local.sock.sendall(payload)
+                line = self.local.reader.readline()
+                if not line:
+                    raise ConnectionResetError("Coordinator closed the connection")
+                break
+            except OSError:
+                self._disconnect()
+                if not reused:
+                    raise
+                # Stale connection from before a coordinator restart; retry once on a fresh one
+                reused = False
+        response = json.loads(line)
+        if not response.get('ok'):
+            raise CoordinatorError(response.get('error', 'unknown error'))
+        return response
+
+    def add_message(self, data):
+        self.call({'op': 'add', 'data': data})
+
+    def is_overloaded(self) -> bool:
+        """Whether the coordinator's backlog is over BATCH_SHED_THRESHOLD, re-checked at most every OVERLOAD_CHECK_SEC."""
+        checked_at, overloaded = self.overloaded
+        now = time.monotonic()
+        if now - checked_at >= OVERLOAD_CHECK_SEC:
+            overloaded = self.call({'op': 'overloaded'})['overloaded']
+            self.overloaded = (now, overloaded)
+        return overloaded
+
+    def delivery_stats(self) -> Optional[Dict[str, Any]]:
+        """Get circuit breaker state and backlog sizes from the coordinator."""
+        batching = self.stats()['batching']
+        return batching['delivery'] if batching else None
+
+    def stats(self) -> Dict[str, Any]:
+        """Get de-duplication and batching stats from the coordinator."""
+        return self.call({'op': 'stats'})
+
+    def metrics_text(self) -> str:
+        """Get the coordinator's pipeline metrics in Prometheus text format."""
+        return self.call({'op': 'metrics'})['text']
+
+class RemoteDeduplicator:
+    """UpdateDeduplicator interface backed by the coordinator's shared instance."""
+
+    def __init__(self, client: CoordinatorClient):
+        self.client = client
+
+    def check_and_add(self, key: str) -> bool:
+        return self.client.call({'op': 'check', 'key': key})['duplicate']
+
+    def forget(self, key: str):
+        self.client.call({'op': 'forget', 'key': key})
+
+    def is_duplicate_update(self, update: Dict[str, Any]) -> bool:
+        """Check a raw update by its ``update_id``."""
+        key = update_key(update)
+        if key is None:
+            return False
+        return self.check_and_add(key)
+
+    def is_duplicate_forward(self, message: Dict[str, Any]) -> bool:
+        """Check a message by the channel post it was forwarded from."""
+        key = forward_origin_key(message)
+        if key is None:
+            return False
+        return self.check_and_add(key)
+
+    def stats(self) -> Dict[str, Any]:
+        return self.client.stats()['dedup']
+
+class RemoteContentIndex:
+    """ContentHashIndex interface backed by the coordinator's shared instance."""
+
+    def __init__(self, client: CoordinatorClient):
+        self.client = client
+
+    def observe(self, key: str, digest: str) -> str:
+        return self.exchange(key, digest)[0]
+
+    def exchange(self, key: str, digest: str) -> Tuple[str, Optional[str]]:
+        response = self.client.call({'op': 'content', 'key': key, 'digest': digest})
+        return response['outcome'], response.get('previous')
+
+    def restore(self, key: str, digest: str, previous: Optional[str]):
+        self.client.call({'op': 'restore', 'key': key, 'digest': digest, 'previous': previous})
+
+    def stats(self) -> Dict[str, Any]:
+        return self.client.stats()['content_index']
+
+class RemoteHealthProbe:
+    """GasHealthProbe interface backed by the probe running in the coordinator."""
+
+    def __init__(self, client: CoordinatorClient):
+        self.client = client
+
+    def status(self) -> str:
+        return self.client.call({'op': 'gas_health'})['status']
+
+    def stats(self) -> Optional[Dict[str, Any]]:
+        return self.client.call({'op': 'gas_health'})['stats']
+
+def run_coordinator(socket_path: str, stop_timeout: Optional[float] = 30.0):
+    """
+    Serve the coordinator until SIGTERM or SIGINT, then drain buffered batches.
+
+    Args:
+        socket_path: Filesystem path of the Unix socket
+        stop_timeout: How long to wait for in-flight batches on shutdown
+    """
+    web_app_url = os.getenv('GOOGLE_WEB_APP_URL')
+    manager = None
+    if web_app_url:
+        manager = create_batch_manager(web_app_url, os.getenv('TELEGRAM_BOT_TOKEN'))
+    else:
+        logger.error("GOOGLE_WEB_APP_URL environment variable not found!")
+    deduplicator = create_deduplicator()
+    register_pipeline_gauges(lambda: manager, deduplicator)
+
+    gas_probe = None
+    if web_app_url:
+        gas_probe = GasHealthProbe(web_app_url)
+        gas_probe.start()
+
+    server = BatchCoordinator(socket_path, manager, deduplicator, create_content_index(), gas_probe)
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.set())
+
+    serving = threading.Thread(target=server.serve_forever, name='batch-coordinator', daemon=True)
+    serving.start()
+    logger.info(f"Batch coordinator listening on {socket_path}")
+    stopping.wait()
+
+    logger.info("Batch coordinator stopping")
+    server.shutdown()
+    server.server_close()
+    if gas_probe:
+        gas_probe.stop()
+    if manager:
+        manager.stop(stop_timeout)
+    try:
+        os.unlink(socket_path)
+    except OSError:
+        pass
+
+if __name__ == '__main__':
+    from utils.logger import setup_logger
+
+    setup_logger(logging.INFO)
+    run_coordinator(sys.argv[1] if len(sys.argv) > 1 else os.environ['BATCH_COORDINATOR_SOCKET'])
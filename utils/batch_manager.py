@@ -0,0 +1,467 @@
+"""
+Batching of webhook messages for Apps Script batch_ingest.
+"""
+
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from extraction.bulk import EXTRACTION_MODE
+from extraction.cache import get_extraction_cache
+from extraction.patterns import PATTERNS
+from utils.delivery import RETRY, SPLIT, BatchDelivery, BatchFactory, CircuitBreaker
+from utils.flush_policy import AdaptiveFlushPolicy
+from utils.http_client import get_http_client
+from utils.lanes import (
+    BATCH_INTERACTIVE_MAX_SIZE, BATCH_INTERACTIVE_WAIT_SEC, LANE_BULK, LANE_INTERACTIVE, LaneRouter
+)
+from utils.media_groups import MEDIA_GROUP_WINDOW_SEC, MediaGroupCoalescer
+from utils.notifier import BatchNotifier
+from utils.spool import DeadLetterFile, MessageSpool, SpillFile
+from utils.wire_format import check_payload_format
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds; the adaptive flush policy tunes the actual values per batch
+BATCH_MAX_SIZE = 100
+BATCH_MAX_WAIT_SEC = 5.0
+BATCH_MIN_SIZE = int(os.getenv('BATCH_MIN_SIZE', '10'))
+BATCH_MIN_WAIT_SEC = float(os.getenv('BATCH_MIN_WAIT_SEC', '0.5'))
+BATCH_TARGET_LATENCY_SEC = float(os.getenv('BATCH_TARGET_LATENCY_SEC', '10'))
+BATCH_MAX_PAYLOAD_BYTES = int(os.getenv('BATCH_MAX_PAYLOAD_BYTES', '2000000'))
+# 'rows', 'columnar' or 'columnar+gzip'; columnar needs the matching Apps Script deployment.
+# Checked on import, so a typo stops the service at startup instead of failing every batch.
+BATCH_PAYLOAD_FORMAT = check_payload_format(os.getenv('BATCH_PAYLOAD_FORMAT', 'rows'))
+BATCH_SEND_QUEUE_SIZE = int(os.getenv('BATCH_SEND_QUEUE_SIZE', '4'))
+# Set WEBHOOK_SPOOL_PATH to a file on a persistent volume; empty disables the spool
+WEBHOOK_SPOOL_PATH = os.getenv('WEBHOOK_SPOOL_PATH', 'spool/webhook_spool.jsonl')
+# Batches Apps Script rejects for good are moved here (and out of the spool); empty drops them with an error log
+WEBHOOK_DEAD_LETTER_PATH = os.getenv('WEBHOOK_DEAD_LETTER_PATH', 'spool/webhook_dead_letter.jsonl')
+# Lock timeouts, 429/5xx and network errors are retried with jittered exponential backoff
+BATCH_RETRY_BASE_SEC = float(os.getenv('BATCH_RETRY_BASE_SEC', '1'))
+BATCH_RETRY_MAX_SEC = float(os.getenv('BATCH_RETRY_MAX_SEC', '60'))
+# Script errors, ingestion_incomplete and non-JSON replies are retried this many times per batch
+# before it is dead-lettered; 0 retries them indefinitely
+BATCH_MAX_ERROR_ATTEMPTS = int(os.getenv('BATCH_MAX_ERROR_ATTEMPTS', '20'))
+BATCH_BREAKER_FAILURES = int(os.getenv('BATCH_BREAKER_FAILURES', '5'))
+BATCH_BREAKER_RESET_SEC = float(os.getenv('BATCH_BREAKER_RESET_SEC', '30'))
+# While the breaker is open, a buffer this large is moved to WEBHOOK_SPILL_PATH; empty disables spilling
+BATCH_SPILL_THRESHOLD = int(os.getenv('BATCH_SPILL_THRESHOLD', '5000'))
+WEBHOOK_SPILL_PATH = os.getenv('WEBHOOK_SPILL_PATH', 'spool/webhook_spill.jsonl')
+# Above this many undelivered messages the webhook answers 503 so Telegram retries later; 0 disables
+BATCH_SHED_THRESHOLD = int(os.getenv('BATCH_SHED_THRESHOLD', '100000'))
+
+class BatchManager:
+    """
+    Buffers webhook messages and ships them to Apps Script in batches.
+
+    Webhook threads only append to the active buffer. When it is full (or the
+    wait timer fires) the buffer is swapped out and handed to a dedicated
+    sender thread through a bounded queue, so the slow Apps Script POST never
+    runs on a request thread or while holding ``self.lock``.
+
+    With a spool, each message is recorded durably before ``add_message``
+    returns and only acknowledged once Apps Script confirms its batch was
+    ingested, or rejected it and the batch was moved to the dead-letter
+    file; unacknowledged messages are replayed on startup.
+
+    Batch size and flush delay come from an ``AdaptiveFlushPolicy`` fed with
+    the round-trip time and payload size of every batch.
+
+    Transient failures (lock timeouts, 429/5xx, network errors) are retried
+    with backoff, and a ``CircuitBreaker`` pauses delivery while Apps Script
+    is saturated. Meanwhile a large buffer is spilled to a ``SpillFile``,
+    and ``is_overloaded`` tells the webhook to shed load once the backlog
+    passes BATCH_SHED_THRESHOLD.
+
+    Album parts (rows with a ``media_group_id``) are spooled individually
+    but held in a ``MediaGroupCoalescer`` and only buffered once merged
+    into a single row.
+
+    A ``LaneRouter`` splits traffic into two lanes. Interactive messages
+    (direct messages, and chats forwarding only a few posts while nothing
+    else is waiting to be sent) get their own small buffer that is flushed after BATCH_INTERACTIVE_WAIT_SEC, and their
+    batches jump ahead of queued bulk batches. Bulk forwards use the
+    adaptive policy, and each bulk batch is taken round-robin across chats.
+    """
+
+    def __init__(self, web_app_url, spool=None, notifier=None, policy=None, breaker=None, spill=None,
+                 media_groups=None, router=None, dead_letters=None):
+        self.web_app_url = web_app_url
+        self.spool = spool
+        self.notifier = notifier
+        self.spill = spill
+        self.dead_letters = dead_letters
+        self.breaker = breaker or CircuitBreaker(
+            failure_threshold=BATCH_BREAKER_FAILURES,
+            reset_timeout=BATCH_BREAKER_RESET_SEC
+        )
+        self.policy = policy or AdaptiveFlushPolicy(
+            min_size=BATCH_MIN_SIZE,
+            max_size=BATCH_MAX_SIZE,
+            min_wait=BATCH_MIN_WAIT_SEC,
+            max_wait=BATCH_MAX_WAIT_SEC,
+            target_latency=BATCH_TARGET_LATENCY_SEC,
+            max_payload_bytes=BATCH_MAX_PAYLOAD_BYTES
+        )
+        if media_groups is None and MEDIA_GROUP_WINDOW_SEC > 0:
+            media_groups = MediaGroupCoalescer()
+        self.media_groups = media_groups
+        self.media_group_timer = None
+        self.router = router or LaneRouter()
+        self.batches = BatchFactory()
+        self.delivery = BatchDelivery(self.breaker, self.policy, spool=spool, notifier=notifier,
+                                      dead_letters=dead_letters, payload_format=BATCH_PAYLOAD_FORMAT,
+                                      retry_base=BATCH_RETRY_BASE_SEC, retry_max=BATCH_RETRY_MAX_SEC,
+                                      max_error_attempts=BATCH_MAX_ERROR_ATTEMPTS)
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.interactive = []
+        self.interactive_timer = None
+        self.in_flight_since = None
+        self.timer = None
+        self.backlogged = False
+        self.stopping = threading.Event()
+        # (priority, order, batch): interactive batches are sent before queued bulk ones.
+        # Unbounded; _queue_full_locked applies BATCH_SEND_QUEUE_SIZE per lane.
+        self.send_queue = queue.PriorityQueue()
+        self.queue_order = itertools.count()
+        self.sender = threading.Thread(target=self._sender_loop, name='batch-sender', daemon=True)
+        self.sender.start()
+        if self.spool:
+            self.replay_spool()
+
+    def replay_spool(self):
+        """Re-buffer messages that were spooled but never acknowledged."""
+        pending = self.spool.pending()
+        if not pending:
+            return
+        logger.info(f"Replaying {len(pending)} spooled messages")
+        with self.lock:
+            for seq, data in pending:
+                self._accept_locked([seq], data)
+            self._handoff_interactive_locked()
+            self._handoff_locked()
+            if self._has_pending_locked():
+                self.start_timer()
+
+    def start_timer(self):
+        if self.timer:
+            return
+        self.timer = threading.Timer(self.policy.flush_delay(), self.flush_and_finalize)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def add_message(self, data):
+        # Group-committed fsync happens before taking the batch lock
+        seq = self.spool.append(data) if self.spool else None
+        self.policy.record_arrival()
+        with self.lock:
+            self._accept_locked([seq] if seq is not None else [], data)
+            if (self.spill is not None and len(self.buffer) >= BATCH_SPILL_THRESHOLD
+                    and self.breaker.is_open()):
+                self._spill_locked()
+            self._handoff_interactive_locked()
+            self._handoff_locked()
+            if self._has_pending_locked():
+                self.start_timer()
+
+    def flush_and_finalize(self):
+        with self.lock:
+            self.timer = None
+            self._handoff_locked(partial=True)
+            if self._has_pending_locked():
+                # Sender is still busy with earlier batches; try again later
+                self.start_timer()
+
+    def flush_interactive(self):
+        with self.lock:
+            self.interactive_timer = None
+            self._handoff_interactive_locked(partial=True)
+
+    def release_media_groups(self):
+        """Buffer albums whose coalescing window has closed."""
+        with self.lock:
+            self.media_group_timer = None
+            for seqs, data, first_arrival in self.media_groups.take_due():
+                self._append_locked(seqs, data, first_arrival)
+            self._handoff_interactive_locked()
+            self._handoff_locked()
+            if self._has_pending_locked():
+                self.start_timer()
+            self._schedule_media_groups_locked()
+
+    def backlog(self):
+        """Messages accepted but not yet handed to the sender, in memory, spilled or held as album parts."""
+        held = len(self.media_groups) if self.media_groups else 0
+        return len(self.buffer) + len(self.interactive) + (len(self.spill) if self.spill else 0) + held
+
+    def is_overloaded(self):
+        """Whether the webhook should shed load until the backlog drains."""
+        return BATCH_SHED_THRESHOLD > 0 and self.backlog() >= BATCH_SHED_THRESHOLD
+
+    def delivery_stats(self):
+        """Get circuit breaker state, backlog sizes and, with local extraction, pattern usage."""
+        stats = {
+            'breaker': self.breaker.stats(),
+            'backlog': self.backlog(),
+            'spilled': len(self.spill) if self.spill else 0,
+            'dead_lettered': len(self.dead_letters) if self.dead_letters else 0,
+            'album_parts_held': len(self.media_groups) if self.media_groups else 0,
+            'lanes': {
+                'interactive_buffered': len(self.interactive),
+                'bulk_buffered': len(self.buffer),
+                'routed': self.router.stats(),
+            },
+            'overloaded': self.is_overloaded(),
+        }
+        if EXTRACTION_MODE == 'local':
+            stats['extraction_patterns'] = PATTERNS.stats()
+            stats['extraction_cache'] = get_extraction_cache().stats()
+        return stats
+
+    def stop(self, timeout=None):
+        """
+        Hand off anything buffered and wait for the sender to drain.
+
+        Each remaining batch gets a single attempt; batches that still fail
+        stay in the spool and are replayed on the next start.
+        """
+        self.stopping.set()
+        with self.lock:
+            for timer in (self.timer, self.interactive_timer):
+                if timer:
+                    timer.cancel()
+            self.timer = self.interactive_timer = None
+            if self.media_group_timer:
+                self.media_group_timer.cancel()
+                self.media_group_timer = None
+            if self.media_groups:
+                for seqs, data, first_arrival in self.media_groups.take_due(force=True):
+                    self._append_locked(seqs, data, first_arrival)
+            while self.interactive:
+                self._enqueue_locked(self._take_interactive_batch_locked())
+            while self.buffer:
+                self._enqueue_locked(self._take_batch_locked())
+        self.send_queue.put((2, next(self.queue_order), None))
+        self.sender.join(timeout)
+        if self.spool:
+            self.spool.close()
+        if self.spill:
+            self.spill.close()
+        if self.dead_letters:
+            self.dead_letters.close()
+        if self.notifier:
+            self.notifier.close(timeout)
+
+    def _accept_locked(self, seqs, data):
+        """Buffer a message, or hold it until the rest of its album arrives."""
+        if self.media_groups is None or not self.media_groups.is_part(data):
+            self._append_locked(seqs, data)
+            return
+        completed = self.media_groups.add(seqs, data)
+        if completed:
+            self._append_locked(*completed)
+        self._schedule_media_groups_locked()
+
+    def _schedule_media_groups_locked(self):
+        deadline = self.media_groups.next_deadline()
+        if deadline is None or self.media_group_timer:
+            return
+        self.media_group_timer = threading.Timer(max(0.0, deadline - time.monotonic()), self.release_media_groups)
+        self.media_group_timer.daemon = True
+        self.media_group_timer.start()
+
+    def _append_locked(self, seqs, data, enqueued_at=None):
+        # seqs: spool sequence numbers behind this row (several for a merged album)
+        size = len(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        entry = (seqs, data, size, enqueued_at or time.monotonic())
+        if self.router.route(data, self.backlog() + self._queued_messages()) == LANE_INTERACTIVE:
+            self.interactive.append(entry)
+            if self.interactive_timer is None:
+                self.interactive_timer = threading.Timer(BATCH_INTERACTIVE_WAIT_SEC, self.flush_interactive)
+                self.interactive_timer.daemon = True
+                self.interactive_timer.start()
+            return
+        self.buffer.append(entry)
+        self.buffered_bytes += size
+
+    def _queued_messages(self):
+        with self.send_queue.mutex:
+            return sum(len(batch['messages']) for _, _, batch in self.send_queue.queue if batch)
+
+    def buffer_depth(self):
+        """Messages waiting in either lane's buffer, not yet handed to the sender."""
+        return len(self.buffer) + len(self.interactive)
+
+    def oldest_unflushed_age(self):
+        """Seconds the oldest message not yet sent to Apps Script has waited."""
+        with self.lock:
+            times = [entries[0][3] for entries in (self.buffer, self.interactive) if entries]
+            if self.spill:
+                times.append(self.spill.peek()[2])
+            if self.media_groups and self.media_groups.oldest() is not None:
+                times.append(self.media_groups.oldest())
+        with self.send_queue.mutex:
+            times.extend(batch['enqueued_at'] for _, _, batch in self.send_queue.queue if batch)
+        if self.in_flight_since is not None:
+            times.append(self.in_flight_since)
+        return time.monotonic() - min(times) if times else 0.0
+
+    def _has_pending_locked(self):
+        return bool(self.buffer) or bool(self.spill)
+
+    def _batch_ready_locked(self):
+        return (bool(self.spill)
+                or len(self.buffer) >= self.policy.batch_size
+                or self.buffered_bytes >= self.policy.max_payload_bytes)
+
+    def _spill_locked(self):
+        """Move the whole buffer to the spill file (and out of the spool's memory)."""
+        self.spill.extend([[seqs, data, enqueued_at] for seqs, data, _, enqueued_at in self.buffer])
+        if self.spool:
+            self.spool.evict(seq for seqs, _, _, _ in self.buffer for seq in seqs)
+        logger.warning(f"Apps Script delivery paused; spilled {len(self.buffer)} messages to {self.spill.path}")
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    def _take_batch_locked(self):
+        # Spilled messages are older than anything in the buffer, so they go first
+        limit = self.policy.batch_limit(self.backlog())
+        if self.spill and not self.stopping.is_set():
+            entries = [(seqs, data, size, enqueued_at)
+                       for (seqs, data, enqueued_at), size in self.spill.take(limit, self.policy.max_payload_bytes)]
+            return self.batches.make(entries, LANE_BULK)
+
+        # Cut at the adaptive batch size or the payload cap, whichever comes first, round-robin across chats
+        batch, self.buffer, taken_bytes = self.batches.cut(self.buffer, limit, self.policy.max_payload_bytes)
+        self.buffered_bytes -= taken_bytes
+        return batch
+
+    def _take_interactive_batch_locked(self):
+        batch, self.interactive, _ = self.batches.cut(self.interactive, BATCH_INTERACTIVE_MAX_SIZE,
+                                                      self.policy.max_payload_bytes, LANE_INTERACTIVE)
+        return batch
+
+    def _queue_full_locked(self, lane):
+        # Interactive batches may use a second BATCH_SEND_QUEUE_SIZE worth of slots beyond the bulk ones
+        limit = BATCH_SEND_QUEUE_SIZE * (2 if lane == LANE_INTERACTIVE else 1)
+        return self.send_queue.qsize() >= limit
+
+    def _enqueue_locked(self, batch):
+        priority = 0 if batch['lane'] == LANE_INTERACTIVE else 1
+        self.send_queue.put_nowait((priority, next(self.queue_order), batch))
+
+    def _handoff_interactive_locked(self, partial=False):
+        """Queue interactive batches once the lane is full or its timer fired."""
+        while self.interactive and (partial or len(self.interactive) >= BATCH_INTERACTIVE_MAX_SIZE):
+            if self._queue_full_locked(LANE_INTERACTIVE):
+                break
+            self._enqueue_locked(self._take_interactive_batch_locked())
+        if self.interactive and self.interactive_timer is None:
+            # Lane not full yet, or the send queue is; check again shortly
+            self.interactive_timer = threading.Timer(BATCH_INTERACTIVE_WAIT_SEC, self.flush_interactive)
+            self.interactive_timer.daemon = True
+            self.interactive_timer.start()
+
+    def _handoff_locked(self, partial=False):
+        """Swap batches out of the bulk buffer and queue them for the sender."""
+        while self._has_pending_locked() and (partial or self._batch_ready_locked()):
+            if self._queue_full_locked(LANE_BULK):
+                if not self.backlogged:
+                    logger.warning(f"Batch send queue full; keeping {len(self.buffer)} messages buffered")
+                    self.backlogged = True
+                return
+            self._enqueue_locked(self._take_batch_locked())
+            self.backlogged = False
+
+    def _sender_loop(self):
+        while True:
+            _, _, batch = self.send_queue.get()
+            try:
+                if batch is None:
+                    return
+                self.in_flight_since = batch['enqueued_at']
+                self._deliver(batch)
+            except Exception as e:
+                logger.error(f"Batch sender error: {e}")
+            finally:
+                self.in_flight_since = None
+                self.send_queue.task_done()
+
+    def _pause(self, delay):
+        """Wait ``delay`` seconds; returns True early if the manager is stopping."""
+        return delay > 0 and self.stopping.wait(delay)
+
+    def _deliver(self, batch):
+        """Send a batch, retrying transient failures until it is delivered or rejected."""
+        attempt = 0
+        while not self._pause(self.delivery.breaker_wait()):
+            outcome = self._send_batch(batch, attempt)
+            if outcome == SPLIT:
+                with self.lock:
+                    parts = self.batches.split(batch)
+                for part in parts:
+                    self._deliver(part)
+                return
+            if outcome != RETRY:
+                return
+            attempt += 1
+            if self._pause(self.delivery.retry_delay(attempt)):
+                # Shutting down; the batch stays in the spool for the next start
+                return
+
+    def _send_batch(self, batch, attempt=0):
+        """
+        Post a batch to Apps Script once.
+
+        Local extraction and payload encoding are part of the attempt: if
+        they fail, the attempt counts as a transient failure like a network
+        error.
+
+        Returns:
+            DELIVERED, RETRY or REJECTED (see ``utils.delivery.classify_reply``),
+            or SPLIT if the batch was not posted because it is over the payload cap
+        """
+        outcome = RETRY
+        size = 0
+        started = time.monotonic()
+        try:
+            body = self.delivery.encode(batch, self.delivery.messages(batch), attempt)
+            if body is None:
+                outcome = SPLIT
+                return outcome
+            size = len(body)
+            started = time.monotonic()
+            resp = get_http_client().post(self.web_app_url, endpoint='apps_script', data=body, headers={'Content-Type': 'application/json; charset=utf-8'})
+            outcome = self.delivery.handle_reply(batch, attempt, resp.status_code, resp.text,
+                                                 time.monotonic() - started)
+            if outcome != RETRY:
+                self.delivery.settle(batch, outcome)
+        except Exception as e:
+            logger.error(f"Batch {batch['batch_id']} attempt {attempt + 1} failed: {e}")
+        finally:
+            self.delivery.record_attempt(batch, outcome, time.monotonic() - started, size)
+        return outcome
+
+def create_batch_manager(web_app_url, bot_token=None):
+    """
+    Build a BatchManager with the spool, dead-letter file and notifier configured from the environment.
+
+    Args:
+        web_app_url: Apps Script web app URL
+        bot_token: Telegram bot token for status messages, if any
+
+    Returns:
+        Started BatchManager
+    """
+    spool = MessageSpool(WEBHOOK_SPOOL_PATH) if WEBHOOK_SPOOL_PATH else None
+    spill = SpillFile(WEBHOOK_SPILL_PATH) if WEBHOOK_SPILL_PATH else None
+    dead_letters = DeadLetterFile(WEBHOOK_DEAD_LETTER_PATH) if WEBHOOK_DEAD_LETTER_PATH else None
+    notifier = BatchNotifier(bot_token) if bot_token else None
+    return BatchManager(web_app_url, spool=spool, notifier=notifier, spill=spill, dead_letters=dead_letters)
@@ -0,0 +1,330 @@
+"""
+De-duplication of Telegram updates before they reach the batcher.
+"""
+
+import hashlib
+import math
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from extraction.normalization import normalize
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over string keys.
+
+    Uses double hashing of a single blake2b digest to derive the bit
+    positions, so each lookup costs one hash call.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        """
+        Size the filter for the given capacity and false-positive rate.
+
+        Args:
+            capacity: Number of keys the filter is sized for
+            error_rate: Target false-positive rate at capacity
+        """
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+class UpdateDeduplicator:
+    """
+    Drops repeated update IDs and repeated forwards of the same channel post.
+
+    Recent keys live in a memory-capped LRU. Keys evicted from it move to
+    a Bloom filter that covers a much longer history; it rotates between
+    two generations once the current one reaches capacity, so memory and
+    the false-positive rate stay bounded. Since a key only reaches the
+    filter once it is old, a key recorded for a message that was then not
+    accepted can still be removed with ``forget``.
+    """
+
+    def __init__(self, lru_size: int = 50000, bloom_capacity: int = 1000000, bloom_error_rate: float = 0.000001):
+        """
+        Initialize the de-duplicator.
+
+        Args:
+            lru_size: Maximum number of recent keys kept exactly
+            bloom_capacity: Keys per Bloom filter generation
+            bloom_error_rate: False-positive rate per generation
+        """
+        self.lru_size = lru_size
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.lock = threading.Lock()
+        self.recent = OrderedDict()
+        self.bloom = BloomFilter(bloom_capacity, bloom_error_rate)
+        self.previous_bloom: Optional[BloomFilter] = None
+        self.counters = {'checks': 0, 'lru_hits': 0, 'bloom_hits': 0}
+
+    def check_and_add(self, key: str) -> bool:
+        """
+        Record a key and report whether it was already seen.
+
+        Args:
+            key: De-duplication key
+
+        Returns:
+            True if the key is a duplicate
+        """
+        with self.lock:
+            self.counters['checks'] += 1
+            if key in self.recent:
+                self.recent.move_to_end(key)
+                self.counters['lru_hits'] += 1
+                return True
+            if key in self.bloom or (self.previous_bloom is not None and key in self.previous_bloom):
+                self.counters['bloom_hits'] += 1
+                return True
+
+            self.recent[key] = True
+            if len(self.recent) > self.lru_size:
+                evicted, _ = self.recent.popitem(last=False)
+                if self.bloom.count >= self.bloom_capacity:
+                    self.previous_bloom = self.bloom
+                    self.bloom = BloomFilter(self.bloom_capacity, self.bloom_error_rate)
+                self.bloom.add(evicted)
+            return False
+
+    def forget(self, key: str):
+        """
+        Remove a key recorded by ``check_and_add``, so its next occurrence is not a duplicate.
+
+        Args:
+            key: De-duplication key
+        """
+        with self.lock:
+            self.recent.pop(key, None)
+
+    def is_duplicate_update(self, update: Dict[str, Any]) -> bool:
+        """Check a raw update by its ``update_id``."""
+        key = update_key(update)
+        if key is None:
+            return False
+        return self.check_and_add(key)
+
+    def is_duplicate_forward(self, message: Dict[str, Any]) -> bool:
+        """Check a message by the channel post it was forwarded from."""
+        key = forward_origin_key(message)
+        if key is None:
+            return False
+        return self.check_and_add(key)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get hit counters and current sizes.
+
+        Returns:
+            Dictionary of counters, hit rate and memory usage
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats['hit_rate'] = (stats['lru_hits'] + stats['bloom_hits']) / stats['checks'] if stats['checks'] else 0.0
+            stats['lru_size'] = len(self.recent)
+            stats['bloom_keys'] = self.bloom.count
+            stats['bloom_bytes'] = len(self.bloom.bits) + (len(self.previous_bloom.bits) if self.previous_bloom else 0)
+        return stats
+
+# Outcomes of ContentHashIndex.observe
+CONTENT_NEW = 'new'
+CONTENT_UNCHANGED = 'unchanged'
+CONTENT_CHANGED = 'changed'
+
+# Bidi marks and isolates and tatweel do not change meaning either; extraction keeps them
+_FORMATTING = str.maketrans('', '', '\u200e\u200f\u202a\u202b\u202c\u202d\u202e\u2066\u2067\u2068\u2069\u0640')
+
+class ContentHashIndex:
+    """
+    Remembers a content digest per origin message, to tell real edits from no-ops.
+
+    Telegram sends an edit update for any change, including ones that leave
+    the text as it was (formatting, media, whitespace). Keys are origin
+    messages (``o:<chat>:<message>`` for channel posts, ``m:<chat>:<message>``
+    for direct messages); the most recent ``size`` keys are kept.
+    """
+
+    def __init__(self, size: int = 100000):
+        """
+        Initialize the index.
+
+        Args:
+            size: Maximum number of origin messages remembered
+        """
+        self.size = size
+        self.lock = threading.Lock()
+        self.digests = OrderedDict()
+        self.counters = {CONTENT_NEW: 0, CONTENT_UNCHANGED: 0, CONTENT_CHANGED: 0}
+
+    def observe(self, key: str, digest: str) -> str:
+        """
+        Record the latest digest for an origin message.
+
+        Args:
+            key: Origin message key
+            digest: Digest from ``content_digest``
+
+        Returns:
+            CONTENT_NEW if the key was not known, CONTENT_UNCHANGED if the
+            digest matches the last one seen, otherwise CONTENT_CHANGED
+        """
+        return self.exchange(key, digest)[0]
+
+    def exchange(self, key: str, digest: str) -> Tuple[str, Optional[str]]:
+        """
+        Record the latest digest for an origin message and return the one it replaced.
+
+        Args:
+            key: Origin message key
+            digest: Digest from ``content_digest``
+
+        Returns:
+            Tuple of (outcome as from ``observe``, previous digest or None)
+        """
+        with self.lock:
+            previous = self.digests.get(key)
+            self.digests[key] = digest
+            self.digests.move_to_end(key)
+            if len(self.digests) > self.size:
+                self.digests.popitem(last=False)
+            if previous is None:
+                outcome = CONTENT_NEW
+            elif previous == digest:
+                outcome = CONTENT_UNCHANGED
+            else:
+                outcome = CONTENT_CHANGED
+            self.counters[outcome] += 1
+            return outcome, previous
+
+    def restore(self, key: str, digest: str, previous: Optional[str]):
+        """
+        Undo an ``exchange`` whose message was not accepted.
+
+        Nothing changes if another digest was recorded for the key since.
+
+        Args:
+            key: Origin message key
+            digest: Digest that was recorded
+            previous: Digest it replaced, or None if the key was new
+        """
+        with self.lock:
+            if self.digests.get(key) != digest:
+                return
+            if previous is None:
+                del self.digests[key]
+            else:
+                self.digests[key] = previous
+
+    def stats(self) -> Dict[str, Any]:
+        """Get outcome counters and the number of origin messages remembered."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self.digests)
+        return stats
+
+def normalize_content(text: Optional[str]) -> str:
+    """
+    Normalize message text for change detection.
+
+    Applies NFKC, drops bidi formatting characters and tatweel, then the
+    extractors' ``normalize`` (ASCII digits, Persian yeh/keheh, no
+    zero-width characters, collapsed whitespace), so text the extractors
+    treat as the same is not reported as an edit.
+
+    Args:
+        text: Message text or caption
+
+    Returns:
+        Normalized text
+    """
+    return normalize(unicodedata.normalize('NFKC', text or '').translate(_FORMATTING))
+
+def content_digest(text: Optional[str]) -> str:
+    """Get a short digest of the normalized text."""
+    return hashlib.blake2b(normalize_content(text).encode('utf-8'), digest_size=16).hexdigest()
+
+def create_content_index() -> ContentHashIndex:
+    """Build a ContentHashIndex sized from CONTENT_INDEX_SIZE."""
+    return ContentHashIndex(size=int(os.getenv('CONTENT_INDEX_SIZE', '100000')))
+
+def create_deduplicator() -> UpdateDeduplicator:
+    """Build an UpdateDeduplicator sized from DEDUP_LRU_SIZE and DEDUP_BLOOM_CAPACITY."""
+    return UpdateDeduplicator(
+        lru_size=int(os.getenv('DEDUP_LRU_SIZE', '50000')),
+        bloom_capacity=int(os.getenv('DEDUP_BLOOM_CAPACITY', '1000000'))
+    )
+
+def update_key(update: Dict[str, Any]) -> Optional[str]:
+    """
+    Build a key identifying a raw update.
+
+    Args:
+        update: Telegram update dictionary
+
+    Returns:
+        Key string, or None if the update has no ``update_id``
+    """
+    update_id = update.get('update_id')
+    if update_id is None:
+        return None
+    return f"u:{update_id}"
+
+def forward_origin_key(message: Dict[str, Any]) -> Optional[str]:
+    """
+    Build a key identifying the original channel post of a forward.
+
+    Args:
+        message: Telegram message dictionary
+
+    Returns:
+        Key string, or None if the message is not a forwarded channel post
+    """
+    forward_origin = message.get('forward_origin') or {}
+    if forward_origin.get('type') != 'channel':
+        return None
+    chat_id = (forward_origin.get('chat') or {}).get('id')
+    message_id = forward_origin.get('message_id')
+    if chat_id is None or message_id is None:
+        return None
+    return f"o:{chat_id}:{message_id}"
+
+def message_origin_key(message: Dict[str, Any], channel_post: bool = False) -> Optional[str]:
+    """
+    Build the content-index key of a message as sent in its own chat.
+
+    A channel post shares its key with forwards of it (see
+    ``forward_origin_key``), so an edit of the post is compared against
+    the content that was forwarded.
+
+    Args:
+        message: Telegram message dictionary
+        channel_post: Whether the message is a post in a channel
+
+    Returns:
+        Key string, or None if the chat or message ID is missing
+    """
+    chat_id = (message.get('chat') or {}).get('id')
+    message_id = message.get('message_id')
+    if chat_id is None or message_id is None:
+        return None
+    return f"{'o' if channel_post else 'm'}:{chat_id}:{message_id}"
@@ -0,0 +1,456 @@
+"""
+Batch delivery to Apps Script, shared by the threaded and asyncio batch managers.
+
+``doPost`` answers "Server busy ... (Lock timeout)" when it cannot get the
+script lock, and Apps Script returns 5xx/429 when overloaded. Those replies
+(and network errors) are retried with jittered exponential backoff; after
+several in a row the circuit breaker opens and the sender pauses instead of
+adding to the pile-up. Replies where the script ran but failed (an
+exception caught by ``doPost``, ``ingestion_incomplete``, or an HTML quota
+or error page instead of JSON) are retried too, but only a bounded number
+of times per batch, so one batch that always fails cannot block delivery.
+Only a batch that fails validation is rejected outright.
+
+``BatchFactory`` cuts buffered entries into batches and ``BatchDelivery``
+does everything around the HTTP POST (payload, reply handling, metrics,
+spool acks, status messages), so the two managers only differ in how they
+post and wait. Batches are cut by the size of the raw rows; with local
+extraction the products attached afterwards can push the body past the
+payload cap, so ``encode`` measures the final body and an oversized batch
+is split in two (``SPLIT``) before it is first posted.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from extraction.bulk import EXTRACTION_MODE, attach_products
+from utils.lanes import LANE_BULK, fair_take
+from utils.pipeline_metrics import (
+    BATCH_ACKS, BATCH_DEAD_LETTERED, BATCH_FAILURES, BATCH_INCOMPLETE, BATCH_PAYLOAD_BYTES, BATCH_ROLLBACKS,
+    BATCH_RETRIES, BATCH_SIZE, GAS_ROUNDTRIP_SECONDS
+)
+from utils.wire_format import build_batch_payload
+
+logger = logging.getLogger(__name__)
+
+DELIVERED = 'delivered'
+RETRY = 'retry'
+REJECTED = 'rejected'
+# Script-level failure; retried up to ``max_error_attempts`` times, then REJECTED
+ERROR = 'error'
+# Body over the payload cap; the batch is split with ``BatchFactory.split`` instead of posted
+SPLIT = 'split'
+
+def classify_reply(status_code: Optional[int], data: Dict[str, Any]) -> str:
+    """
+    Decide what to do with an Apps Script reply to a batch.
+
+    Args:
+        status_code: HTTP status, or None if the request failed without a response
+        data: Parsed JSON reply (empty if the body was not JSON)
+
+    Returns:
+        DELIVERED if the batch was acknowledged, RETRY for transient
+        failures (lock timeouts, paused ingestion, 429/5xx, network errors),
+        REJECTED if the batch failed validation, otherwise ERROR (script
+        exceptions, ``ingestion_incomplete``, non-JSON pages)
+    """
+    if status_code is None or status_code == 429 or status_code >= 500:
+        return RETRY
+    if data.get('ack') == 'ingestion_complete':
+        return DELIVERED
+    message = str(data.get('message', ''))
+    if data.get('status') == 'ingestion_disabled' or 'Lock timeout' in message:
+        return RETRY
+    if data.get('status') == 'error' and message.startswith('Validation failed'):
+        return REJECTED
+    return ERROR
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """
+    Get a "full jitter" exponential backoff delay.
+
+    Args:
+        attempt: Retry number, starting at 1
+        base: Delay scale for the first retry, in seconds
+        cap: Upper bound for the delay, in seconds
+
+    Returns:
+        Random delay between 0 and min(cap, base * 2 ** (attempt - 1))
+    """
+    return random.uniform(0, min(cap, base * (2 ** (attempt - 1))))
+
+class CircuitBreaker:
+    """
+    Pauses delivery while Apps Script keeps failing.
+
+    After ``failure_threshold`` consecutive transient failures the breaker
+    opens for ``reset_timeout`` seconds. Once that passes it lets a single
+    probe through (half-open): success closes it, failure re-opens it with
+    the timeout doubled, up to ``max_reset_timeout``.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, max_reset_timeout: float = 300.0):
+        """
+        Initialize the breaker.
+
+        Args:
+            failure_threshold: Consecutive failures that open the breaker
+            reset_timeout: First open period, in seconds
+            max_reset_timeout: Longest open period after repeated failed probes
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.open_for = reset_timeout
+        self.times_opened = 0
+
+    def is_open(self) -> bool:
+        """Whether delivery is currently paused or waiting for a probe."""
+        with self.lock:
+            return self.opened_at is not None
+
+    def wait_time(self) -> float:
+        """
+        Get how long to wait before the next attempt is allowed.
+
+        Returns:
+            0 when closed or when the open period has elapsed (half-open), else seconds left
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.opened_at + self.open_for - time.monotonic())
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.open_for = self.reset_timeout
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.opened_at is not None:
+                # Failed probe while half-open
+                self.open_for = min(self.max_reset_timeout, self.open_for * 2)
+                self.opened_at = time.monotonic()
+            elif self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the breaker state."""
+        with self.lock:
+            state = 'closed'
+            if self.opened_at is not None:
+                state = 'open' if time.monotonic() < self.opened_at + self.open_for else 'half_open'
+            return {
+                'state': state,
+                'consecutive_failures': self.failures,
+                'open_for': self.open_for,
+                'times_opened': self.times_opened,
+            }
+
+
+# Buffered entry: (spool seqs behind the row, row, encoded size, monotonic arrival time)
+Entry = Tuple[List[int], Dict[str, Any], int, float]
+
+def entry_chat(entry: Entry) -> Any:
+    return entry[1].get('chat_id')
+
+def entry_size(entry: Entry) -> int:
+    return entry[2]
+
+class BatchFactory:
+    """Turns buffered entries into batches with unique, increasing IDs."""
+
+    def __init__(self):
+        self.last_batch_id = 0
+
+    def next_batch_id(self) -> str:
+        # Millisecond timestamps, bumped so two batches never share an ID
+        batch_id = max(int(time.time() * 1000), self.last_batch_id + 1)
+        self.last_batch_id = batch_id
+        return str(batch_id)
+
+    def make(self, entries: Sequence[Entry], lane: str) -> Dict[str, Any]:
+        """
+        Build a batch from entries.
+
+        Args:
+            entries: Entries in the batch, oldest first
+            lane: Lane the batch is sent on
+
+        Returns:
+            Batch dictionary with batch_id, lane, messages, spool_seqs (plus
+            message_seqs, the seqs behind each message), enqueued_at and chat_ids
+        """
+        return self._build(self.next_batch_id(), lane, [m for _, m, _, _ in entries],
+                           [seqs for seqs, _, _, _ in entries], entries[0][3])
+
+    def split(self, batch: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Split a batch that was never posted into two halves.
+
+        The first half keeps the batch ID. Products already attached by
+        ``BatchDelivery.messages`` are split along with the rows.
+
+        Args:
+            batch: Batch with at least two messages
+
+        Returns:
+            The two halves, oldest first
+        """
+        half = len(batch['messages']) // 2
+        parts = []
+        for batch_id, part in ((batch['batch_id'], slice(0, half)), (self.next_batch_id(), slice(half, None))):
+            new = self._build(batch_id, batch['lane'], batch['messages'][part], batch['message_seqs'][part],
+                              batch['enqueued_at'])
+            if 'extracted' in batch:
+                new['extracted'] = batch['extracted'][part]
+            parts.append(new)
+        return parts
+
+    @staticmethod
+    def _build(batch_id: str, lane: str, messages: List[Dict[str, Any]], message_seqs: List[List[int]],
+               enqueued_at: float) -> Dict[str, Any]:
+        return {
+            'batch_id': batch_id,
+            'lane': lane,
+            'messages': messages,
+            'message_seqs': message_seqs,
+            'spool_seqs': [seq for seqs in message_seqs for seq in seqs],
+            'enqueued_at': enqueued_at,
+            'chat_ids': {m.get('chat_id') for m in messages if m.get('chat_id')}
+        }
+
+    def cut(self, entries: Sequence[Entry], limit: int, max_bytes: int,
+            lane: str = LANE_BULK) -> Tuple[Dict[str, Any], List[Entry], int]:
+        """
+        Cut a batch from a buffer round-robin across chats (see ``fair_take``).
+
+        Args:
+            entries: Buffered entries, oldest first
+            limit: Maximum number of messages
+            max_bytes: Payload cap
+            lane: Lane the batch is sent on
+
+        Returns:
+            Tuple of (batch, remaining entries, bytes taken from the buffer)
+        """
+        taken, rest = fair_take(entries, limit, max_bytes, entry_chat, entry_size)
+        return self.make(taken, lane), rest, sum(entry_size(entry) for entry in taken)
+
+class BatchDelivery:
+    """
+    Everything around posting a batch except the HTTP call and the waiting.
+
+    A manager encodes the batch with ``encode`` (splitting it with
+    ``BatchFactory.split`` if that returns None), posts it, passes the reply
+    to ``handle_reply`` and the outcome to ``settle`` (disk I/O; the asyncio
+    manager runs it in an executor), and always reports the attempt with
+    ``record_attempt``. Rejected batches (failed validation, or still
+    failing after ``max_error_attempts`` error replies) would fail again on
+    every replay, so ``settle`` moves them to the dead-letter file and
+    acknowledges them too. ``breaker_wait`` and ``retry_delay`` say how long
+    to pause before the next attempt.
+    """
+
+    def __init__(self, breaker: CircuitBreaker, policy, spool=None, notifier=None, dead_letters=None,
+                 payload_format: str = 'rows', retry_base: float = 1.0, retry_max: float = 60.0,
+                 max_error_attempts: int = 20):
+        """
+        Initialize the delivery helper.
+
+        Args:
+            breaker: CircuitBreaker shared by all attempts
+            policy: AdaptiveFlushPolicy fed with bulk batch round-trips; its
+                ``max_payload_bytes`` caps the encoded body
+            spool: MessageSpool acknowledged once a batch is delivered, if any
+            notifier: BatchNotifier for per-chat status messages, if any
+            dead_letters: DeadLetterFile for rejected batches, if any
+            payload_format: 'rows', 'columnar' or 'columnar+gzip'
+            retry_base: Backoff scale for the first retry, in seconds
+            retry_max: Upper bound for the backoff, in seconds
+            max_error_attempts: Error replies (see ``classify_reply``) after which
+                a batch is rejected; 0 retries them indefinitely
+        """
+        self.breaker = breaker
+        self.policy = policy
+        self.spool = spool
+        self.notifier = notifier
+        self.dead_letters = dead_letters
+        self.payload_format = payload_format
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.max_error_attempts = max_error_attempts
+
+    @staticmethod
+    def messages(batch: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Get the rows to send, with products attached when EXTRACTION_MODE is local.
+
+        Extraction runs once per batch; retries resend the same products. It
+        is CPU-bound, so the asyncio manager calls this in an executor.
+        """
+        if EXTRACTION_MODE != 'local':
+            return batch['messages']
+        if 'extracted' not in batch:
+            batch['extracted'] = attach_products(batch['messages'])
+        return batch['extracted']
+
+    def encode(self, batch: Dict[str, Any], messages: List[Dict[str, Any]], attempt: int) -> Optional[bytes]:
+        """
+        Build the request body of one attempt.
+
+        Args:
+            batch: Batch from ``BatchFactory``
+            messages: Rows from ``messages``
+            attempt: Attempt number, starting at 0
+
+        Returns:
+            UTF-8 JSON body, or None if the first attempt of a batch with
+            several messages is over the payload cap and the batch must be
+            split. Later attempts are never split: an earlier one may already
+            have written rows under this batch ID.
+        """
+        payload = build_batch_payload(batch['batch_id'], messages, self.payload_format, EXTRACTION_MODE)
+        if attempt:
+            # Lets finalizeBatch skip rows an earlier, timed-out attempt already wrote
+            payload['attempt'] = attempt + 1
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        if not attempt and len(messages) > 1 and len(body) > self.policy.max_payload_bytes:
+            logger.info(f"Batch {batch['batch_id']}: {len(body)} byte body over the "
+                        f"{self.policy.max_payload_bytes} byte cap; splitting {len(messages)} messages")
+            return None
+        BATCH_SIZE.observe(len(messages))
+        BATCH_PAYLOAD_BYTES.observe(len(body))
+        return body
+
+    def handle_reply(self, batch: Dict[str, Any], attempt: int, status_code: int, text: str,
+                     elapsed: float) -> str:
+        """
+        Classify an Apps Script reply, update metrics and notify the batch's chats.
+
+        Args:
+            batch: Batch that was posted
+            attempt: Attempt number, starting at 0
+            status_code: HTTP status
+            text: Response body
+            elapsed: Round-trip time, in seconds
+
+        Returns:
+            DELIVERED, RETRY or REJECTED (see ``classify_reply``)
+        """
+        GAS_ROUNDTRIP_SECONDS.observe(elapsed)
+        logger.info("Finalize ack: %s %.200s", status_code, text)
+        try:
+            data = json.loads(text)
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        status = data.get("status")
+        ack = data.get("ack")
+        processed = data.get("processed_messages")
+        rollback = data.get("rollback")
+        outcome = classify_reply(status_code, data)
+        if ack == 'ingestion_incomplete':
+            BATCH_INCOMPLETE.inc()
+        if outcome == ERROR:
+            batch['error_replies'] = batch.get('error_replies', 0) + 1
+            if self.max_error_attempts <= 0 or batch['error_replies'] < self.max_error_attempts:
+                outcome = RETRY
+            else:
+                outcome = REJECTED
+        if outcome == RETRY:
+            logger.warning(f"Batch {batch['batch_id']} attempt {attempt + 1} failed: "
+                           f"{status_code} {data.get('message') or status or text[:200]}")
+            return outcome
+        if outcome == DELIVERED:
+            BATCH_ACKS.inc()
+        else:
+            BATCH_FAILURES.inc()
+            batch['rejection'] = {'http_status': status_code, 'status': status, 'ack': ack,
+                                  'message': data.get('message') or (None if data else text[:200]),
+                                  'error_replies': batch.get('error_replies', 0)}
+        if rollback:
+            BATCH_ROLLBACKS.inc()
+        if self.notifier:
+            text = f"Batch {batch['batch_id']}: status={status}, ack={ack}, processed={processed}, rollback={rollback}"
+            for chat_id in batch['chat_ids']:
+                self.notifier.notify(chat_id, text)
+        return outcome
+
+    def settle(self, batch: Dict[str, Any], outcome: str):
+        """
+        Acknowledge a delivered batch in the spool, or dead-letter and acknowledge a rejected one.
+
+        Args:
+            batch: Batch that was posted
+            outcome: DELIVERED or REJECTED
+
+        Raises:
+            OSError: If the dead-letter file cannot be written; the batch then stays in the spool
+        """
+        if outcome == REJECTED:
+            reason = batch.get('rejection') or {}
+            if self.dead_letters is not None:
+                self.dead_letters.add(batch['batch_id'], reason, batch['messages'])
+                where = f"moved to {self.dead_letters.path}"
+            else:
+                where = "dropped (no dead-letter file configured)"
+            BATCH_DEAD_LETTERED.inc()
+            logger.error(f"Batch {batch['batch_id']} rejected by Apps Script "
+                         f"({reason.get('ack') or reason.get('status')}: {reason.get('message')}); "
+                         f"{len(batch['messages'])} messages {where}")
+        if self.spool:
+            self.spool.ack(batch['spool_seqs'])
+
+    def record_attempt(self, batch: Dict[str, Any], outcome: str, elapsed: float, size: int):
+        """
+        Feed an attempt to the circuit breaker and, for bulk batches, the flush policy.
+
+        Args:
+            batch: Batch that was posted
+            outcome: DELIVERED, RETRY, REJECTED or SPLIT (not counted)
+            elapsed: Seconds from the start of the attempt
+            size: Request body size in bytes
+        """
+        if outcome == SPLIT:
+            return
+        if outcome == RETRY:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        if batch['lane'] == LANE_BULK:
+            # Small interactive batches would skew the adaptive batch size
+            self.policy.record_batch(elapsed, size, outcome == DELIVERED)
+
+    def breaker_wait(self) -> float:
+        """Seconds to pause before the next attempt while the circuit breaker is open."""
+        wait = self.breaker.wait_time()
+        if wait > 0:
+            logger.warning(f"Apps Script circuit breaker open; pausing delivery for {wait:.1f}s")
+        return wait
+
+    def retry_delay(self, attempt: int) -> float:
+        """
+        Count a retry and get its backoff delay.
+
+        Args:
+            attempt: Retry number, starting at 1
+
+        Returns:
+            Seconds to wait before the retry
+        """
+        BATCH_RETRIES.inc()
+        return backoff_delay(attempt, self.retry_base, self.retry_max)
@@ -0,0 +1,122 @@
+"""
+Adaptive batch size and flush timing for Apps Script batch ingestion.
+"""
+
+import math
+import threading
+import time
+from typing import Any, Dict
+
+class AdaptiveFlushPolicy:
+    """
+    AIMD controller for how many messages to send per batch and how long to wait.
+
+    After each batch the measured round-trip time is compared with
+    ``target_latency``: below target the batch size grows by
+    ``increase_step``; above target, or on failure, it is multiplied by
+    ``decrease_factor``. The wait window follows the arrival rate: when
+    traffic is too light to fill a batch within ``max_wait`` the buffer is
+    flushed after ``min_wait`` so quiet periods get fast acks, while bursts
+    fill batches by size. A backlog of several full batches is always drained
+    in ``max_size`` batches so a burst costs as few round trips as possible.
+    Batches never exceed ``max_payload_bytes``.
+    """
+
+    def __init__(self, min_size: int = 10, max_size: int = 100, min_wait: float = 0.5, max_wait: float = 5.0,
+                 target_latency: float = 10.0, max_payload_bytes: int = 2000000,
+                 increase_step: int = 5, decrease_factor: float = 0.5):
+        """
+        Initialize the policy.
+
+        Args:
+            min_size: Lower bound for the batch size
+            max_size: Upper bound (and starting value) for the batch size
+            min_wait: Flush delay used when traffic is light
+            max_wait: Longest a message may wait in the buffer
+            target_latency: Apps Script round-trip time to aim for, in seconds
+            max_payload_bytes: Hard cap on the JSON body of one batch
+            increase_step: Additive increase applied below target latency
+            decrease_factor: Multiplicative decrease applied above target
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.target_latency = target_latency
+        self.max_payload_bytes = max_payload_bytes
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+
+        self.lock = threading.Lock()
+        self.batch_size = max_size
+        self.arrival_rate = 0.0  # messages/second, decayed over max_wait
+        self.last_arrival = None
+        self.last_rtt = None
+        self.last_payload_bytes = None
+
+    def record_arrival(self):
+        """Update the arrival-rate estimate with one new message."""
+        now = time.monotonic()
+        with self.lock:
+            self.arrival_rate = self._decayed_rate_locked(now) + 1.0 / self.max_wait
+            self.last_arrival = now
+
+    def _decayed_rate_locked(self, now):
+        if self.last_arrival is None:
+            return 0.0
+        return self.arrival_rate * math.exp(-(now - self.last_arrival) / self.max_wait)
+
+    def flush_delay(self) -> float:
+        """
+        Get how long to wait before flushing a partially filled buffer.
+
+        Returns:
+            Delay in seconds
+        """
+        with self.lock:
+            rate = self._decayed_rate_locked(time.monotonic())
+            if rate <= 0 or self.batch_size / rate > self.max_wait:
+                return self.min_wait
+            return self.max_wait
+
+    def batch_limit(self, backlog: int) -> int:
+        """
+        Get the number of messages to cut into the next batch.
+
+        Args:
+            backlog: Messages currently waiting in the buffer
+
+        Returns:
+            Batch size; a backlog of several full batches is drained at max_size
+        """
+        with self.lock:
+            if backlog >= 2 * self.max_size:
+                return self.max_size
+            return self.batch_size
+
+    def record_batch(self, rtt: float, payload_bytes: int, ok: bool):
+        """
+        Adjust the batch size after a batch round trip.
+
+        Args:
+            rtt: Apps Script round-trip time in seconds
+            payload_bytes: Size of the request body
+            ok: Whether Apps Script acknowledged the batch
+        """
+        with self.lock:
+            self.last_rtt = rtt
+            self.last_payload_bytes = payload_bytes
+            if ok and rtt <= self.target_latency:
+                self.batch_size = min(self.max_size, self.batch_size + self.increase_step)
+            else:
+                self.batch_size = max(self.min_size, int(self.batch_size * self.decrease_factor))
+
+    def stats(self) -> Dict[str, Any]:
+        """Get the current policy state."""
+        with self.lock:
+            return {
+                'batch_size': self.batch_size,
+                'arrival_rate': round(self._decayed_rate_locked(time.monotonic()), 3),
+                'last_rtt': self.last_rtt,
+                'last_payload_bytes': self.last_payload_bytes,
+            }
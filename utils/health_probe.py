@@ -0,0 +1,119 @@
+"""
+Background reachability probe for the Apps Script web app.
+
+``/health/detailed`` used to call ``?action=health`` on the request
+thread, so every monitoring poll added load to Apps Script and could hold
+a worker thread for the full timeout. The probe checks on its own
+interval instead and the endpoint reads the cached result.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from utils.http_client import get_http_client
+
+logger = logging.getLogger(__name__)
+
+GAS_HEALTH_PROBE_SEC = float(os.getenv('GAS_HEALTH_PROBE_SEC', '30'))
+# Number of recent probe outcomes kept for /health/detailed
+GAS_HEALTH_HISTORY = int(os.getenv('GAS_HEALTH_HISTORY', '20'))
+
+class GasHealthProbe:
+    """
+    Probes ``{web_app_url}?action=health`` from a daemon thread.
+
+    Each outcome is ``connected`` (HTTP 200), ``error`` (any other status)
+    or ``unreachable`` (no response), stored with its time and latency.
+    Until the first probe finishes the status is ``unknown``.
+    """
+
+    def __init__(self, web_app_url: str, interval: float = GAS_HEALTH_PROBE_SEC,
+                 history_size: int = GAS_HEALTH_HISTORY):
+        """
+        Initialize the probe; call ``start`` to begin probing.
+
+        Args:
+            web_app_url: Apps Script web app URL
+            interval: Seconds between probes
+            history_size: Number of recent outcomes to keep
+        """
+        self.url = f'{web_app_url}?action=health'
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.latest: Optional[Dict[str, Any]] = None
+        self.history = deque(maxlen=history_size)
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start the probe thread; the first probe runs immediately."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='gas-health-probe', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.probe()
+            self.stopping.wait(self.interval)
+
+    def probe(self) -> Dict[str, Any]:
+        """
+        Check Apps Script once and record the outcome.
+
+        Returns:
+            The recorded outcome
+        """
+        started = time.perf_counter()
+        status_code = None
+        try:
+            response = get_http_client().get(self.url, endpoint='apps_script_health')
+            status_code = response.status_code
+            status = 'connected' if status_code == 200 else 'error'
+        except Exception as e:
+            logger.debug("Apps Script health probe failed: %s", e)
+            status = 'unreachable'
+        outcome = {
+            'status': status,
+            'status_code': status_code,
+            'latency_ms': round((time.perf_counter() - started) * 1000, 1),
+            'checked_at': int(time.time()),
+        }
+        with self.lock:
+            previous = self.latest
+            self.latest = outcome
+            self.history.append(outcome)
+        if previous is not None and previous['status'] != status:
+            logger.warning(f"Apps Script health changed: {previous['status']} -> {status}")
+        return outcome
+
+    def status(self) -> str:
+        """Get the latest probe status, or ``unknown`` before the first probe."""
+        with self.lock:
+            return self.latest['status'] if self.latest else 'unknown'
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the cached probe result and recent history.
+
+        Returns:
+            Dictionary with the latest outcome, its age in seconds, the
+            fraction of recent probes that connected, and the history (oldest first)
+        """
+        with self.lock:
+            latest = dict(self.latest) if self.latest else None
+            history = list(self.history)
+        connected = sum(1 for outcome in history if outcome['status'] == 'connected')
+        return {
+            'latest': latest,
+            'age_seconds': int(time.time()) - latest['checked_at'] if latest else None,
+            'interval_seconds': self.interval,
+            'success_ratio': round(connected / len(history), 3) if history else None,
+            'history': [{key: outcome[key] for key in ('status', 'latency_ms', 'checked_at')} for outcome in history],
+        }
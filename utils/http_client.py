@@ -0,0 +1,139 @@
+"""
+Shared HTTP client with keep-alive connection pools for outbound calls.
+"""
+
+import os
+import random
+import threading
+import time
+from typing import Any, Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Per-endpoint timeouts (connect, read) and retry policies.
+# POSTs to Apps Script are not retried here: a retried batch could be written twice.
+ENDPOINT_POLICIES = {
+    'default': {'timeout': (5, 30), 'retries': 0},
+    'apps_script': {'timeout': (5, 60), 'retries': 0},
+    'apps_script_health': {'timeout': (2, 2), 'retries': 0},
+    'telegram': {'timeout': (5, 10), 'retries': 2, 'retry_statuses': (429, 500, 502, 503, 504)},
+}
+
+RETRY_BACKOFF_SEC = 0.5
+RETRY_METHODS = ('GET', 'HEAD')
+
+class HttpClient:
+    """
+    Thin wrapper around a ``requests.Session`` shared by every module.
+
+    Connections to script.google.com and api.telegram.org are kept alive in
+    per-host pools, so repeated calls skip the TCP and TLS handshake. Calls
+    name an endpoint from ``ENDPOINT_POLICIES`` to pick up its timeout and
+    retry policy.
+    """
+
+    def __init__(self, pool_connections: int = None, pool_maxsize: int = None):
+        """
+        Initialize the client.
+
+        Args:
+            pool_connections: Number of per-host pools to keep
+            pool_maxsize: Maximum idle connections kept per host
+        """
+        self.pool_connections = pool_connections or int(os.getenv('HTTP_POOL_CONNECTIONS', '10'))
+        self.pool_maxsize = pool_maxsize or int(os.getenv('HTTP_POOL_MAXSIZE', '16'))
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self.lock = threading.Lock()
+        self.counters: Dict[str, Dict[str, int]] = {}
+
+    def request(self, method: str, url: str, endpoint: str = 'default', **kwargs) -> requests.Response:
+        """
+        Send a request using the endpoint's timeout and retry policy.
+
+        Args:
+            method: HTTP method
+            url: Request URL
+            endpoint: Name of a policy in ENDPOINT_POLICIES
+            **kwargs: Passed through to ``requests.Session.request``
+
+        Returns:
+            The final response; the last exception is re-raised if every attempt failed
+        """
+        policy = ENDPOINT_POLICIES.get(endpoint, ENDPOINT_POLICIES['default'])
+        kwargs.setdefault('timeout', policy['timeout'])
+        retries = policy.get('retries', 0) if method.upper() in RETRY_METHODS else 0
+        retry_statuses = policy.get('retry_statuses', ())
+
+        attempt = 0
+        while True:
+            self._count(endpoint, 'requests')
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException:
+                self._count(endpoint, 'errors')
+                if attempt >= retries:
+                    raise
+            else:
+                if response.status_code not in retry_statuses or attempt >= retries:
+                    return response
+            attempt += 1
+            self._count(endpoint, 'retries')
+            time.sleep(RETRY_BACKOFF_SEC * (2 ** (attempt - 1)) * (0.5 + random.random()))
+
+    def get(self, url: str, endpoint: str = 'default', **kwargs) -> requests.Response:
+        """Send a GET request. See ``request``."""
+        return self.request('GET', url, endpoint=endpoint, **kwargs)
+
+    def post(self, url: str, endpoint: str = 'default', **kwargs) -> requests.Response:
+        """Send a POST request. See ``request``."""
+        return self.request('POST', url, endpoint=endpoint, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get request counters and connection reuse per host.
+
+        Returns:
+            Dictionary with per-endpoint counters and per-host pool stats
+        """
+        hosts = {}
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_sent = pool.num_requests
+            connections = pool.num_connections
+            hosts[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                'requests': requests_sent,
+                'connections_opened': connections,
+                'connections_reused': max(requests_sent - connections, 0),
+            }
+        with self.lock:
+            endpoints = {name: dict(counts) for name, counts in self.counters.items()}
+        return {'endpoints': endpoints, 'hosts': hosts, 'pool_maxsize': self.pool_maxsize}
+
+    def _count(self, endpoint: str, counter: str):
+        with self.lock:
+            counts = self.counters.setdefault(endpoint, {'requests': 0, 'errors': 0, 'retries': 0})
+            counts[counter] += 1
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_http_client() -> HttpClient:
+    """
+    Get the process-wide shared HTTP client.
+
+    Returns:
+        Shared HttpClient instance
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
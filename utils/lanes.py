@@ -0,0 +1,150 @@
+"""
+Priority lanes for the batcher: interactive messages vs bulk forwarding.
+
+A user forwarding a single post wants a status reply within a second or
+two; a chat backfilling hundreds of forwards wants them packed into large
+batches. ``LaneRouter`` sends direct messages and chats that forward
+only a few messages to the interactive lane, and chats over
+BATCH_BULK_CHAT_THRESHOLD messages per BATCH_BULK_WINDOW_SEC to the bulk
+lane. Forwards only take the interactive lane while fewer than
+BATCH_INTERACTIVE_MAX_BACKLOG messages (by default: none) are waiting to
+be sent: during a burst from many light forwarders, small interactive
+batches jumping the queue would cost more round trips than they save
+latency. ``fair_take`` cuts bulk batches round-robin across chats so one
+heavy forwarder cannot hold everyone else's messages back.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+LANE_INTERACTIVE = 'interactive'
+LANE_BULK = 'bulk'
+
+# A chat that sends more than this many messages within the window is treated as bulk
+BATCH_BULK_CHAT_THRESHOLD = int(os.getenv('BATCH_BULK_CHAT_THRESHOLD', '5'))
+BATCH_BULK_WINDOW_SEC = float(os.getenv('BATCH_BULK_WINDOW_SEC', '30'))
+# Interactive batches are flushed after this delay, or once this many messages are waiting
+BATCH_INTERACTIVE_WAIT_SEC = float(os.getenv('BATCH_INTERACTIVE_WAIT_SEC', '0.2'))
+BATCH_INTERACTIVE_MAX_SIZE = int(os.getenv('BATCH_INTERACTIVE_MAX_SIZE', '20'))
+# Forwards only use the interactive lane while fewer messages than this are waiting; 0 removes the limit
+BATCH_INTERACTIVE_MAX_BACKLOG = int(os.getenv('BATCH_INTERACTIVE_MAX_BACKLOG', '1'))
+
+class LaneRouter:
+    """
+    Picks a lane per message from the sending chat's recent volume.
+
+    Direct messages are always interactive. Rows without a ``chat_id``
+    (channel post edits, replays of such rows) go to the bulk lane, and so
+    does every forward while the backlog is at ``max_backlog``. The most
+    recent ``max_chats`` chats are tracked.
+    """
+
+    def __init__(self, threshold: int = BATCH_BULK_CHAT_THRESHOLD, window: float = BATCH_BULK_WINDOW_SEC,
+                 max_chats: int = 10000, max_backlog: int = BATCH_INTERACTIVE_MAX_BACKLOG):
+        """
+        Initialize the router.
+
+        Args:
+            threshold: Messages per window above which a chat is bulk; 0 sends everything to the bulk lane
+            window: Sliding window for counting a chat's messages, in seconds
+            max_chats: Number of chats whose recent arrivals are remembered
+            max_backlog: Waiting messages at which forwards stop using the interactive lane; 0 for no limit
+        """
+        self.threshold = threshold
+        self.window = window
+        self.max_chats = max_chats
+        self.max_backlog = max_backlog
+        self.lock = threading.Lock()
+        self.arrivals: 'OrderedDict[Any, deque]' = OrderedDict()
+        self.counters = {LANE_INTERACTIVE: 0, LANE_BULK: 0, 'bulk_while_backlogged': 0}
+
+    def route(self, data: Dict[str, Any], backlog: int = 0) -> str:
+        """
+        Record a message and choose its lane.
+
+        Args:
+            data: Message row
+            backlog: Messages currently waiting to be sent, in either lane
+
+        Returns:
+            LANE_INTERACTIVE or LANE_BULK
+        """
+        chat_id = data.get('chat_id')
+        if data.get('channel_username') == 'DirectMessage':
+            lane = LANE_INTERACTIVE
+        elif chat_id is None or self.threshold <= 0:
+            lane = LANE_BULK
+        else:
+            now = time.monotonic()
+            with self.lock:
+                recent = self.arrivals.pop(chat_id, None) or deque()
+                recent.append(now)
+                while recent and recent[0] <= now - self.window:
+                    recent.popleft()
+                # Cap per-chat memory: only the count up to the threshold matters
+                while len(recent) > self.threshold + 1:
+                    recent.popleft()
+                self.arrivals[chat_id] = recent
+                if len(self.arrivals) > self.max_chats:
+                    self.arrivals.popitem(last=False)
+            lane = LANE_BULK if len(recent) > self.threshold else LANE_INTERACTIVE
+            if lane == LANE_INTERACTIVE and 0 < self.max_backlog <= backlog:
+                lane = LANE_BULK
+                with self.lock:
+                    self.counters['bulk_while_backlogged'] += 1
+        with self.lock:
+            self.counters[lane] += 1
+        return lane
+
+    def stats(self) -> Dict[str, Any]:
+        """Get messages routed per lane (and how many were kept off the interactive lane by the backlog) and the number of chats tracked."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats['chats_tracked'] = len(self.arrivals)
+        return stats
+
+def fair_take(entries: Sequence, limit: int, max_bytes: int,
+              chat_of: Callable[[Any], Any], size_of: Callable[[Any], int]) -> Tuple[List, List]:
+    """
+    Cut a batch from a buffer, taking messages round-robin across chats.
+
+    Messages of one chat keep their order, and every chat with messages
+    waiting gets a turn before any chat gets a second one.
+
+    Args:
+        entries: Buffered entries, oldest first
+        limit: Maximum number of entries to take
+        max_bytes: Payload cap; the first entry is always taken
+        chat_of: Returns the chat an entry belongs to
+        size_of: Returns the payload size of an entry
+
+    Returns:
+        Tuple of (taken entries, remaining entries in their original order)
+    """
+    queues: 'OrderedDict[Any, deque]' = OrderedDict()
+    for index, entry in enumerate(entries):
+        queues.setdefault(chat_of(entry), deque()).append(index)
+
+    chosen, size = set(), 0
+    while queues and len(chosen) < limit:
+        for chat in list(queues):
+            index = queues[chat][0]
+            entry_size = size_of(entries[index])
+            if chosen and size + entry_size > max_bytes:
+                # This chat's next message does not fit; give the others their turn
+                del queues[chat]
+                continue
+            chosen.add(index)
+            size += entry_size
+            queues[chat].popleft()
+            if not queues[chat]:
+                del queues[chat]
+            if len(chosen) >= limit:
+                break
+
+    taken = [entries[index] for index in sorted(chosen)]
+    rest = [entry for index, entry in enumerate(entries) if index not in chosen]
+    return taken, rest
@@ -1,32 +1,172 @@
 """
 Logging configuration utilities.
+
+Loggers hand records to a bounded in-memory queue; a background listener
+thread formats them and does the console and file I/O, so request threads
+never block on a disk or pipe. The log file holds one JSON object per line
+and is rotated by size. Rotation is not safe across processes, so when
+several processes share the file only one of them rotates it and the others
+reopen it after it has been renamed. Chatty records below WARNING are
+rate-limited per call site.
 """
 
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
 import sys
+import threading
+import time
+from datetime import datetime, timezone
 from pathlib import Path
 
-def setup_logger(log_level: int = logging.INFO, log_file: str = 'channel_import.log'):
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Records below WARNING allowed per second from one call site; 0 disables the limit
+LOG_RATE_PER_SEC = float(os.getenv('LOG_RATE_PER_SEC', '20'))
+# 'text' (default) or 'json' for the console; the log file is always JSON lines
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else was passed via ``extra=``
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'suppressed'}
+
+_EXC_FORMATTER = logging.Formatter()
+
+_listener = None
+_setup_lock = threading.Lock()
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects, including ``extra`` fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token-bucket limit on records below WARNING, per call site.
+
+    Warnings and errors always pass. The number of records dropped since
+    the last one that passed is attached to it as ``suppressed``.
+    """
+
+    def __init__(self, per_second: float, burst: int = None):
+        """
+        Initialize the filter.
+
+        Args:
+            per_second: Sustained records per second allowed from one call site
+            burst: Records allowed in a burst (defaults to ``per_second``)
+        """
+        super().__init__()
+        self.per_second = per_second
+        self.burst = burst or max(1, int(per_second))
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.per_second <= 0:
+            return True
+        key = (record.name, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated, suppressed = self.buckets.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - updated) * self.per_second)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now, suppressed + 1)
+                return False
+            self.buckets[key] = (tokens - 1, now, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking or raising when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge args now (they may change later) but leave formatting to the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _EXC_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logger(log_level: int = logging.INFO, log_file: str = 'channel_import.log', rotate: bool = True):
     """
     Setup logging configuration for the application.
 
+    Safe to call more than once; later calls only change the level.
+
     Args:
         log_level: Logging level (e.g., logging.DEBUG, logging.INFO)
-        log_file: Path to log file
+        log_file: Path to log file, rotated at LOG_MAX_BYTES
+        rotate: Whether this process rotates the log file; pass False when
+            another process writing the same file rotates it (gunicorn
+            workers behind the batch coordinator)
     """
-    # Create logs directory if it doesn't exist
-    log_path = Path(log_file)
-    log_path.parent.mkdir(exist_ok=True)
-
-    # Configure logging
-    logging.basicConfig(
-        level=log_level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_file),
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
+    global _listener
+    root = logging.getLogger()
+    with _setup_lock:
+        root.setLevel(log_level)
+        if _listener is not None:
+            return
+
+        # Create logs directory if it doesn't exist
+        log_path = Path(log_file)
+        log_path.parent.mkdir(exist_ok=True)
+
+        if rotate:
+            file_handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+        else:
+            # Reopens the file once the rotating process has renamed it
+            file_handler = logging.handlers.WatchedFileHandler(log_file, encoding='utf-8')
+        file_handler.setFormatter(JsonFormatter())
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        queue_handler = DroppingQueueHandler(log_queue)
+        if LOG_RATE_PER_SEC > 0:
+            queue_handler.addFilter(RateLimitFilter(LOG_RATE_PER_SEC))
+        root.addHandler(queue_handler)
+
+        _listener = logging.handlers.QueueListener(log_queue, console_handler, file_handler)
+        _listener.start()
+        atexit.register(_listener.stop)
 
     # Reduce verbosity of some third-party libraries
     logging.getLogger('googleapiclient').setLevel(logging.WARNING)
@@ -0,0 +1,115 @@
+"""
+Coalescing of album (media group) parts into a single message row.
+
+Telegram delivers an album as one update per photo/video, all sharing a
+``media_group_id`` and usually with the caption on just one of them.
+Parts are held for a short window after the latest one arrives and then
+merged by ``merge_media_group``, so an album costs one MessageData row
+and one extraction instead of one per item.
+"""
+
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.telegram_updates import merge_media_group
+
+# Hold album parts this long after the latest one arrived; 0 disables coalescing
+MEDIA_GROUP_WINDOW_SEC = float(os.getenv('MEDIA_GROUP_WINDOW_SEC', '1.0'))
+# Release an album at most this long after its first part, even if parts keep arriving
+MEDIA_GROUP_MAX_WAIT_SEC = float(os.getenv('MEDIA_GROUP_MAX_WAIT_SEC', '5.0'))
+# Telegram albums hold at most 10 items; a full album is released immediately
+MEDIA_GROUP_MAX_PARTS = 10
+
+class MediaGroupCoalescer:
+    """
+    Holds album parts per (chat, media_group_id) until their window closes.
+
+    Not thread-safe: the batch managers call it under their own lock (or
+    from the event loop). Each part keeps the spool sequence numbers it was
+    recorded under, so the merged row acknowledges all of them at once.
+    """
+
+    def __init__(self, window: float = MEDIA_GROUP_WINDOW_SEC, max_wait: float = MEDIA_GROUP_MAX_WAIT_SEC,
+                 max_parts: int = MEDIA_GROUP_MAX_PARTS):
+        """
+        Initialize the coalescer.
+
+        Args:
+            window: Seconds to wait for further parts after the latest one
+            max_wait: Longest an album is held after its first part
+            max_parts: Part count that releases an album without waiting
+        """
+        self.window = window
+        self.max_wait = max_wait
+        self.max_parts = max_parts
+        # key -> {'seqs': [...], 'parts': [...], 'first': t, 'last': t}
+        self.groups: Dict[Tuple[Any, str], Dict[str, Any]] = {}
+        self.held = 0
+
+    def __len__(self) -> int:
+        """Number of parts currently held."""
+        return self.held
+
+    @staticmethod
+    def is_part(data: Dict[str, Any]) -> bool:
+        """Whether a message row belongs to an album."""
+        return bool(data.get('media_group_id'))
+
+    def add(self, seqs: List[int], data: Dict[str, Any]) -> Optional[Tuple[List[int], Dict[str, Any], float]]:
+        """
+        Hold an album part.
+
+        Args:
+            seqs: Spool sequence numbers of the part (empty without a spool)
+            data: Message row with a ``media_group_id``
+
+        Returns:
+            (seqs, merged row, first arrival) if this part completed the album, else None
+        """
+        now = time.monotonic()
+        key = (data.get('chat_id'), data['media_group_id'])
+        group = self.groups.setdefault(key, {'seqs': [], 'parts': [], 'first': now, 'last': now})
+        group['seqs'].extend(seqs)
+        group['parts'].append(data)
+        group['last'] = now
+        self.held += 1
+        if len(group['parts']) >= self.max_parts:
+            return self._release(key)
+        return None
+
+    def next_deadline(self) -> Optional[float]:
+        """Monotonic time at which the next album is due, or None if nothing is held."""
+        if not self.groups:
+            return None
+        return min(self._deadline(group) for group in self.groups.values())
+
+    def oldest(self) -> Optional[float]:
+        """Monotonic arrival time of the oldest held part, or None."""
+        if not self.groups:
+            return None
+        return min(group['first'] for group in self.groups.values())
+
+    def take_due(self, force: bool = False) -> List[Tuple[List[int], Dict[str, Any], float]]:
+        """
+        Release albums whose window has closed.
+
+        Args:
+            force: Release every held album regardless of its window (used on shutdown)
+
+        Returns:
+            List of (seqs, merged row, first arrival), oldest album first
+        """
+        now = time.monotonic()
+        due = [key for key, group in self.groups.items() if force or self._deadline(group) <= now]
+        released = [self._release(key) for key in due]
+        released.sort(key=lambda entry: entry[2])
+        return released
+
+    def _deadline(self, group: Dict[str, Any]) -> float:
+        return min(group['last'] + self.window, group['first'] + self.max_wait)
+
+    def _release(self, key) -> Tuple[List[int], Dict[str, Any], float]:
+        group = self.groups.pop(key)
+        self.held -= len(group['parts'])
+        return group['seqs'], merge_media_group(group['parts']), group['first']
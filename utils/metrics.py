@@ -0,0 +1,166 @@
+"""
+Minimal Prometheus-style metrics with near lock-free recording.
+
+Counters and histograms keep one shard per recording thread, so the hot
+path only touches thread-local lists; a lock is taken once per thread to
+register its shard and when ``/metrics`` is rendered. Shards of threads
+that have exited (Flask's ``threaded=True`` starts one per request) are
+folded into a base total then, so the shard list only grows with the
+number of live threads. Gauges are callables evaluated at scrape time.
+"""
+
+import bisect
+import threading
+from typing import Callable, List, Sequence, Tuple
+
+class _Sharded:
+    """Base class for metrics whose state is split per thread."""
+
+    def __init__(self, name: str, help_text: str, width: int):
+        self.name = name
+        self.help_text = help_text
+        self.width = width
+        self.local = threading.local()
+        # (owning thread, shard); a shard is only written by its own thread
+        self.shards: List[Tuple[threading.Thread, list]] = []
+        # Totals of shards whose thread has exited
+        self.base = [0] * self.width
+        self.shards_lock = threading.Lock()
+
+    def _shard(self) -> list:
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = [0] * self.width
+            self.local.shard = shard
+            with self.shards_lock:
+                self._fold_dead_locked()
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _fold_dead_locked(self):
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                # Its thread is gone, so nothing writes to the shard any more
+                for i, value in enumerate(shard):
+                    self.base[i] += value
+        self.shards = live
+
+    def _totals(self) -> list:
+        with self.shards_lock:
+            self._fold_dead_locked()
+            totals = list(self.base)
+            shards = [shard for _, shard in self.shards]
+        for shard in shards:
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return totals
+
+class Counter(_Sharded):
+    """Monotonically increasing counter."""
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text, 1)
+
+    def inc(self, amount: float = 1):
+        self._shard()[0] += amount
+
+    def value(self) -> float:
+        return self._totals()[0]
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}",
+                f"# TYPE {self.name} counter",
+                f"{self.name} {_fmt(self.value())}"]
+
+class Histogram(_Sharded):
+    """Histogram with fixed upper bounds, rendered with cumulative buckets."""
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float]):
+        self.buckets = sorted(buckets)
+        # One slot per bucket, one for +Inf, then sum and count
+        super().__init__(name, help_text, len(self.buckets) + 3)
+
+    def observe(self, value: float):
+        shard = self._shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+
+    def render(self) -> List[str]:
+        totals = self._totals()
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, totals):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_fmt(bound)}"}} {cumulative}')
+        cumulative += totals[len(self.buckets)]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {_fmt(totals[-2])}")
+        lines.append(f"{self.name}_count {totals[-1]}")
+        return lines
+
+class Gauge:
+    """Gauge whose value is read from a callable at scrape time."""
+
+    def __init__(self, name: str, help_text: str, func: Callable[[], float], metric_type: str = 'gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.metric_type = metric_type
+
+    def render(self) -> List[str]:
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.help_text}",
+                f"# TYPE {self.name} {self.metric_type}",
+                f"{self.name} {_fmt(value)}"]
+
+class Registry:
+    """Collection of metrics rendered together in Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None and not isinstance(metric, Gauge):
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._register(Counter(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float]) -> Histogram:
+        return self._register(Histogram(name, help_text, buckets))
+
+    def gauge(self, name: str, help_text: str, func: Callable[[], float], metric_type: str = 'gauge') -> Gauge:
+        """Register a scrape-time gauge; re-registering a name replaces it."""
+        return self._register(Gauge(name, help_text, func, metric_type))
+
+    def render(self, skip_prefixes: Sequence[str] = ()) -> str:
+        """Render all metrics, leaving out names that start with any of ``skip_prefixes``."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            if skip_prefixes and metric.name.startswith(tuple(skip_prefixes)):
+                continue
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+def _fmt(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+REGISTRY = Registry()
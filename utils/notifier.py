@@ -0,0 +1,135 @@
+"""
+Background Telegram notifier for batch status messages.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from utils.http_client import get_http_client
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows roughly 30 messages/second overall and 1/second per chat
+GLOBAL_RATE_PER_SEC = 30.0
+PER_CHAT_INTERVAL_SEC = 1.0
+MAX_MESSAGE_CHARS = 4000
+
+class BatchNotifier:
+    """
+    Sends status lines to Telegram chats without blocking the caller.
+
+    ``notify`` only queues a line. A dispatcher thread hands chats to a small
+    worker pool while respecting the global and per-chat rate limits; every
+    line queued for a chat while it waits is merged into a single message.
+    A 429 reply pauses that chat for the ``retry_after`` Telegram asks for
+    and keeps its lines for the next attempt.
+    """
+
+    def __init__(self, bot_token: str, workers: int = 4):
+        """
+        Initialize the notifier and start its dispatcher thread.
+
+        Args:
+            bot_token: Telegram bot token used for sendMessage
+            workers: Number of concurrent sendMessage calls
+        """
+        self.url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='notifier')
+        self.cond = threading.Condition()
+        self.pending: Dict[int, List[str]] = {}
+        self.next_allowed: Dict[int, float] = {}
+        self.in_flight = set()
+        self.next_global = 0.0
+        self.closed = False
+        self.dispatcher = threading.Thread(target=self._dispatch_loop, name='notifier-dispatch', daemon=True)
+        self.dispatcher.start()
+
+    def notify(self, chat_id: int, text: str):
+        """
+        Queue a status line for a chat.
+
+        Args:
+            chat_id: Telegram chat ID
+            text: Line to send; merged with other lines queued for the chat
+        """
+        with self.cond:
+            self.pending.setdefault(chat_id, []).append(text)
+            if len(self.next_allowed) > 10000:
+                now = time.monotonic()
+                self.next_allowed = {c: t for c, t in self.next_allowed.items() if t > now}
+            self.cond.notify()
+
+    def close(self, timeout: float = None):
+        """Stop dispatching and wait for in-flight sends to finish."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.dispatcher.join(timeout)
+        self.executor.shutdown(wait=True)
+
+    def _dispatch_loop(self):
+        while True:
+            with self.cond:
+                if self.closed:
+                    return
+                now = time.monotonic()
+                chat_id, wake_at = self._next_ready_locked(now)
+                if chat_id is None:
+                    self.cond.wait(None if wake_at is None else max(wake_at - now, 0.01))
+                    continue
+                lines = self._take_lines_locked(chat_id)
+                self.in_flight.add(chat_id)
+                self.next_global = now + 1.0 / GLOBAL_RATE_PER_SEC
+            self.executor.submit(self._send, chat_id, lines)
+
+    def _next_ready_locked(self, now):
+        """Pick a chat that may be sent to now, or when to look again."""
+        wake_at = None
+        if self.next_global > now:
+            wake_at = self.next_global
+        for chat_id, lines in self.pending.items():
+            if not lines or chat_id in self.in_flight:
+                continue
+            ready_at = max(self.next_allowed.get(chat_id, 0.0), self.next_global)
+            if ready_at <= now:
+                return chat_id, None
+            wake_at = ready_at if wake_at is None else min(wake_at, ready_at)
+        return None, wake_at
+
+    def _take_lines_locked(self, chat_id):
+        lines = self.pending.pop(chat_id)
+        taken, size = [], 0
+        while lines and (not taken or size + len(lines[0]) + 1 <= MAX_MESSAGE_CHARS):
+            line = lines.pop(0)
+            taken.append(line)
+            size += len(line) + 1
+        if lines:
+            self.pending[chat_id] = lines
+        return taken
+
+    def _send(self, chat_id, lines):
+        retry_after = None
+        try:
+            resp = get_http_client().post(self.url, endpoint='telegram', json={'chat_id': chat_id, 'text': '\n'.join(lines)})
+            if resp.status_code == 429:
+                try:
+                    retry_after = resp.json().get('parameters', {}).get('retry_after', 1)
+                except Exception:
+                    retry_after = 1
+                logger.warning(f"Telegram rate limited chat {chat_id}; retrying in {retry_after}s")
+            elif resp.status_code != 200:
+                logger.error(f"Telegram status send failed for chat {chat_id}: {resp.status_code}")
+        except Exception as e:
+            logger.error(f"Error sending Telegram status: {e}")
+        finally:
+            with self.cond:
+                self.in_flight.discard(chat_id)
+                if retry_after is not None:
+                    self.pending[chat_id] = lines + self.pending.get(chat_id, [])
+                    self.next_allowed[chat_id] = time.monotonic() + float(retry_after)
+                else:
+                    self.next_allowed[chat_id] = time.monotonic() + PER_CHAT_INTERVAL_SEC
+                self.cond.notify()
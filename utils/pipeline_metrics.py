@@ -0,0 +1,50 @@
+"""
+Metrics shared by the Flask and asyncio webhook servers.
+"""
+
+from utils.metrics import REGISTRY
+
+WEBHOOK_SECONDS = REGISTRY.histogram(
+    'webhook_request_seconds', 'Time spent handling a /webhook request',
+    (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+BATCH_SIZE = REGISTRY.histogram(
+    'batch_size_messages', 'Messages per batch sent to Apps Script',
+    (1, 5, 10, 25, 50, 75, 100, 150, 200))
+BATCH_PAYLOAD_BYTES = REGISTRY.histogram(
+    'batch_payload_bytes', 'Request body size of batches sent to Apps Script',
+    (1000, 10000, 50000, 100000, 250000, 500000, 1000000, 2000000, 5000000))
+GAS_ROUNDTRIP_SECONDS = REGISTRY.histogram(
+    'gas_roundtrip_seconds', 'Apps Script finalizeBatch round-trip time',
+    (0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0))
+BATCH_ACKS = REGISTRY.counter('batch_acks_total', 'Batches acknowledged with ingestion_complete')
+BATCH_ROLLBACKS = REGISTRY.counter('batch_rollbacks_total', 'Batches whose product extraction was rolled back')
+BATCH_INCOMPLETE = REGISTRY.counter('batch_ingestion_incomplete_total', 'Batch attempts answered with ingestion_incomplete')
+BATCH_FAILURES = REGISTRY.counter('batch_failures_total', 'Batches that failed without an ack')
+BATCH_DEAD_LETTERED = REGISTRY.counter('batch_dead_lettered_total', 'Rejected batches moved to the dead-letter file')
+BATCH_RETRIES = REGISTRY.counter('batch_retries_total', 'Batch attempts retried after a lock timeout, 429/5xx or network error')
+WEBHOOK_SHED = REGISTRY.counter('webhook_shed_total', 'Webhook requests answered 503 because the backlog was too large')
+
+def register_pipeline_gauges(get_manager, deduplicator):
+    """
+    Register scrape-time gauges for a batch manager and de-duplicator.
+
+    Args:
+        get_manager: Callable returning the current batch manager or None
+        deduplicator: UpdateDeduplicator instance
+    """
+    REGISTRY.gauge('batch_buffer_depth', 'Messages buffered and not yet handed to the sender',
+                   lambda: get_manager().buffer_depth() if get_manager() else 0)
+    REGISTRY.gauge('batch_send_queue_depth', 'Batches waiting for the sender',
+                   lambda: get_manager().send_queue.qsize() if get_manager() else 0)
+    REGISTRY.gauge('batch_oldest_unflushed_age_seconds', 'Age of the oldest message not yet sent to Apps Script',
+                   lambda: get_manager().oldest_unflushed_age() if get_manager() else 0)
+    REGISTRY.gauge('batch_adaptive_size', 'Current adaptive batch size',
+                   lambda: get_manager().policy.batch_size if get_manager() else None)
+    REGISTRY.gauge('batch_backlog_messages', 'Messages accepted but not yet handed to the sender, including spilled ones',
+                   lambda: get_manager().backlog() if get_manager() else 0)
+    REGISTRY.gauge('batch_circuit_open', '1 while delivery to Apps Script is paused by the circuit breaker',
+                   lambda: int(get_manager().breaker.is_open()) if get_manager() else 0)
+    REGISTRY.gauge('dedup_checks_total', 'Keys checked by the update de-duplicator',
+                   lambda: deduplicator.stats()['checks'], 'counter')
+    REGISTRY.gauge('dedup_hits_total', 'Updates dropped as duplicates',
+                   lambda: deduplicator.stats()['lru_hits'] + deduplicator.stats()['bloom_hits'], 'counter')
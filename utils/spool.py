@@ -0,0 +1,352 @@
+"""
+Write-ahead spool for webhook messages waiting to be delivered to Apps Script.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+class MessageSpool:
+    """
+    Append-only, fsync-backed log of buffered messages.
+
+    Every message is written to the spool before the webhook acknowledges it.
+    Once Apps Script acknowledges the batch that carried it (or rejects it
+    and the batch is moved to a ``DeadLetterFile``), an ack record is
+    appended; acknowledged entries are dropped when the file is compacted.
+    On startup, entries without an ack are returned by ``pending()`` so they
+    can be replayed.
+
+    Appends use group commit: callers write their record and then wait for a
+    background flusher that fsyncs everything written during the last
+    ``commit_interval`` seconds in one go, so a burst of webhook requests
+    shares a single disk flush.
+    """
+
+    def __init__(self, path: str, commit_interval: float = 0.005, compact_every: int = 1000):
+        """
+        Open (or create) the spool and load unacknowledged entries.
+
+        Args:
+            path: Spool file path; put it on a persistent volume in production
+            commit_interval: Seconds to gather appends before each fsync
+            compact_every: Number of acked entries that triggers compaction
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.commit_interval = commit_interval
+        self.compact_every = compact_every
+
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.entries: Dict[int, Dict[str, Any]] = {}
+        self.next_seq = 1
+        self.acked_since_compact = 0
+        self.writes = 0
+        self.synced_writes = 0
+        self.closed = False
+
+        self._load()
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.flusher = threading.Thread(target=self._flush_loop, name='spool-flusher', daemon=True)
+        self.flusher.start()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        acked = set()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write from a crash mid-append
+                    continue
+                if 'ack' in record:
+                    acked.update(record['ack'])
+                elif 'seq' in record:
+                    self.entries[record['seq']] = record['msg']
+                    self.next_seq = max(self.next_seq, record['seq'] + 1)
+        for seq in acked:
+            self.entries.pop(seq, None)
+        if self.entries:
+            logger.info(f"Spool {self.path}: {len(self.entries)} unacknowledged messages to replay")
+        self._rewrite()
+
+    def pending(self) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        Get unacknowledged entries in the order they were spooled.
+
+        Returns:
+            List of (sequence number, message) tuples
+        """
+        with self.lock:
+            return sorted(self.entries.items())
+
+    def append(self, message: Dict[str, Any]) -> int:
+        """
+        Durably record a message, blocking until it has been fsynced.
+
+        Args:
+            message: Message dictionary to record
+
+        Returns:
+            Sequence number used to acknowledge the message later
+        """
+        seq, ticket = self.write(message)
+        self.wait_synced(ticket)
+        return seq
+
+    def write(self, message: Dict[str, Any]) -> Tuple[int, int]:
+        """
+        Record a message without waiting for the fsync.
+
+        Args:
+            message: Message dictionary to record
+
+        Returns:
+            Tuple of (sequence number, write ticket for ``wait_synced``)
+        """
+        encoded = json.dumps(message, ensure_ascii=False)
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.entries[seq] = message
+            ticket = self._write_locked(f'{{"seq": {seq}, "msg": {encoded}}}\n')
+        return seq, ticket
+
+    def wait_synced(self, ticket: int):
+        """
+        Block until the write identified by ``ticket`` has been fsynced.
+
+        Args:
+            ticket: Write ticket returned by ``write``
+        """
+        with self.lock:
+            while self.synced_writes < ticket and not self.closed:
+                self.synced.wait()
+
+    def ack(self, seqs: Iterable[int]):
+        """
+        Mark entries as delivered (or moved to the dead-letter file).
+
+        Ack records are not waited on: losing one only means the batch is
+        replayed after a crash.
+
+        Args:
+            seqs: Sequence numbers returned by ``append``
+        """
+        seqs = [seq for seq in seqs if seq is not None]
+        if not seqs:
+            return
+        with self.lock:
+            for seq in seqs:
+                self.entries.pop(seq, None)
+            self._write_locked(json.dumps({'ack': seqs}) + '\n')
+            self.acked_since_compact += len(seqs)
+            if self.acked_since_compact >= self.compact_every:
+                self._compact_locked()
+
+    def close(self):
+        """Flush outstanding writes and stop the flusher thread."""
+        with self.lock:
+            self.closed = True
+            self.synced.notify_all()
+        self.flusher.join()
+        self.file.close()
+
+    def _write_locked(self, line: str) -> int:
+        self.file.write(line)
+        self.writes += 1
+        self.synced.notify_all()
+        return self.writes
+
+    def _flush_loop(self):
+        while True:
+            with self.lock:
+                while self.synced_writes >= self.writes and not self.closed:
+                    self.synced.wait()
+                if self.closed and self.synced_writes >= self.writes:
+                    return
+            # Let concurrent appenders join this commit
+            time.sleep(self.commit_interval)
+            with self.lock:
+                target = self.writes
+                self.file.flush()
+                fd = os.dup(self.file.fileno())
+            # fsync outside the lock so appenders can keep writing meanwhile
+            try:
+                os.fsync(fd)
+            except OSError as e:
+                logger.error(f"Spool fsync failed: {e}")
+            finally:
+                os.close(fd)
+            with self.lock:
+                self.synced_writes = max(self.synced_writes, target)
+                self.synced.notify_all()
+
+    def _compact_locked(self):
+        self.file.close()
+        self._rewrite()
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.acked_since_compact = 0
+        # The rewrite was fsynced, so everything written so far is durable
+        self.synced_writes = self.writes
+        self.synced.notify_all()
+
+    def evict(self, seqs: Iterable[int]):
+        """
+        Drop in-memory copies of unacknowledged messages; they stay on disk.
+
+        Used when the batcher spills its buffer while delivery is paused, so
+        a long Apps Script outage does not keep every message in memory.
+
+        Args:
+            seqs: Sequence numbers returned by ``append``
+        """
+        with self.lock:
+            for seq in seqs:
+                if seq in self.entries:
+                    self.entries[seq] = None
+
+    def _rewrite(self):
+        """Atomically replace the spool with only its unacknowledged entries."""
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            # Copied from the old file, since evicted entries are only on disk
+            if self.path.exists():
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        if record.get('seq') in self.entries:
+                            out.write(line if line.endswith('\n') else line + '\n')
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, self.path)
+
+class DeadLetterFile:
+    """
+    Append-only file of batches Apps Script rejected.
+
+    A rejected batch (failed validation, or still failing after the
+    bounded number of error replies) would fail again on every replay, so
+    it is written here and then acknowledged in the spool. Each line holds the batch ID, the time, the
+    reply that rejected it and its messages; fix the cause and re-send them
+    from this file.
+    """
+
+    def __init__(self, path: str):
+        """
+        Open (or create) the file for appending.
+
+        Args:
+            path: Dead-letter file path; put it next to the spool
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(self, batch_id: str, reason: Dict[str, Any], messages: List[Dict[str, Any]]):
+        """
+        Durably record a rejected batch.
+
+        Args:
+            batch_id: Batch identifier
+            reason: Reply fields explaining the rejection
+            messages: Messages of the batch
+        """
+        record = {'batch_id': batch_id, 'rejected_at': int(time.time()), 'reason': reason, 'messages': messages}
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+        # The spool forgets these messages once this returns
+        os.fsync(self.file.fileno())
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+class SpillFile:
+    """
+    FIFO overflow file for batcher entries while delivery is paused.
+
+    Records are JSON lines read back in the order they were written; the
+    file is truncated whenever it has been fully drained. It only bounds
+    memory and is not fsynced: durability is the spool's job, so the file
+    is emptied on startup.
+    """
+
+    def __init__(self, path: str):
+        """
+        Create (or truncate) the spill file.
+
+        Args:
+            path: Spill file path
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, 'w+b')
+        self.read_offset = 0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def extend(self, records: List[Any]):
+        """Append records to the end of the file."""
+        self.file.seek(0, os.SEEK_END)
+        for record in records:
+            self.file.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+        self.file.flush()
+        self.count += len(records)
+
+    def peek(self) -> Any:
+        """Get the oldest record without removing it, or None if the file is empty."""
+        if not self.count:
+            return None
+        self.file.seek(self.read_offset)
+        return json.loads(self.file.readline())
+
+    def take(self, limit: int, max_bytes: int) -> List[Tuple[Any, int]]:
+        """
+        Remove the oldest records.
+
+        Args:
+            limit: Maximum number of records
+            max_bytes: Stop before the encoded records exceed this size (at least one is returned)
+
+        Returns:
+            List of (record, encoded size) tuples
+        """
+        records, total = [], 0
+        self.file.seek(self.read_offset)
+        while len(records) < limit:
+            line = self.file.readline()
+            if not line:
+                break
+            if records and total + len(line) > max_bytes:
+                break
+            records.append((json.loads(line), len(line)))
+            total += len(line)
+            self.read_offset += len(line)
+        self.count -= len(records)
+        if not self.count:
+            self.file.seek(0)
+            self.file.truncate()
+            self.read_offset = 0
+        return records
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,109 @@
+"""
+Cold-start timing: per-module import times and time to first /health.
+
+Import this module first in an entry point and call ``track_imports()``;
+every module the entry point imports from then on is timed (inclusive of
+its own imports) until ``finish_imports()``. ``mark()`` records named
+milestones as seconds since the process started.
+"""
+
+import builtins
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+def _process_started_at() -> float:
+    """Process start as a ``time.time()`` value, falling back to now off Linux."""
+    try:
+        with open('/proc/self/stat') as f:
+            # Field 22 (after the parenthesised command name) is the start time in clock ticks since boot
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.time()
+
+class StartupTimer:
+    """Collects import timings and startup milestones for one process."""
+
+    def __init__(self):
+        self.process_started_at = _process_started_at()
+        self.imports: Dict[str, float] = {}
+        self.milestones: Dict[str, float] = {}
+        self.original_import = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def track_imports(self):
+        """Start timing first-time imports made by the entry point."""
+        if self.original_import is not None:
+            return
+        self.original_import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def finish_imports(self):
+        """Stop timing imports and record the ``imports_done`` milestone."""
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+        self.mark('imports_done')
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        original = self.original_import or builtins.__import__
+        # Only time absolute imports of modules not loaded yet, at the outermost level
+        if getattr(self.local, 'depth', 0) or level or name in sys.modules:
+            return original(name, globals, locals, fromlist, level)
+        self.local.depth = 1
+        started = time.perf_counter()
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            self.local.depth = 0
+            with self.lock:
+                self.imports[name] = self.imports.get(name, 0.0) + time.perf_counter() - started
+
+    def mark(self, name: str) -> float:
+        """
+        Record a milestone the first time it is reached.
+
+        Args:
+            name: Milestone name
+
+        Returns:
+            Seconds from process start to the (first) time the milestone was reached
+        """
+        with self.lock:
+            if name not in self.milestones:
+                self.milestones[name] = time.time() - self.process_started_at
+            return self.milestones[name]
+
+    def slowest_imports(self, count: int = 10) -> List[Tuple[str, float]]:
+        """Get the slowest tracked imports as (module, seconds), slowest first."""
+        with self.lock:
+            return sorted(self.imports.items(), key=lambda item: item[1], reverse=True)[:count]
+
+    def report(self) -> Dict[str, Any]:
+        """Get milestones and the slowest imports, in seconds."""
+        with self.lock:
+            milestones = {name: round(value, 3) for name, value in self.milestones.items()}
+            total_imports = sum(self.imports.values())
+        return {
+            'milestones': milestones,
+            'tracked_import_seconds': round(total_imports, 3),
+            'slowest_imports': {name: round(seconds, 3) for name, seconds in self.slowest_imports()},
+        }
+
+    def log_report(self):
+        """Log the startup report at INFO."""
+        report = self.report()
+        imports = ', '.join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in report['slowest_imports'].items())
+        logger.info(f"Startup timings (s since process start): {report['milestones']}; slowest imports: {imports}",
+                    extra={'startup': report})
+
+STARTUP = StartupTimer()
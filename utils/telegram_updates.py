@@ -0,0 +1,266 @@
+"""
+Parsing of raw Telegram webhook updates into MessageData rows.
+
+Shared by the Flask app (app.py) and the asyncio server (async_app.py) so
+both produce identical rows.
+"""
+
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.dedup import (
+    CONTENT_CHANGED, CONTENT_UNCHANGED, content_digest, forward_origin_key, message_origin_key, update_key
+)
+
+logger = logging.getLogger(__name__)
+
+class UpdateClaims:
+    """
+    De-duplication keys and content digests recorded while parsing one update.
+
+    They are recorded before the row reaches the batcher. If the batcher
+    then does not accept the row (coordinator unreachable, spool write
+    error), ``release`` undoes them, so Telegram's redelivery of the update
+    is not dropped as a duplicate or as an unchanged edit.
+    """
+
+    def __init__(self, deduplicator=None, content_index=None):
+        self.deduplicator = deduplicator
+        self.content_index = content_index
+        self.keys: List[str] = []
+        self.digests: List[Tuple[str, str, Optional[str]]] = []
+
+    def check_and_add(self, key: Optional[str]) -> bool:
+        """Check a key with the de-duplicator, remembering it if it was new."""
+        if self.deduplicator is None or key is None:
+            return False
+        duplicate = self.deduplicator.check_and_add(key)
+        if not duplicate:
+            self.keys.append(key)
+        return duplicate
+
+    def observe(self, key: Optional[str], message: Dict[str, Any]) -> Optional[str]:
+        """Record a message's content digest, remembering the one it replaced."""
+        if self.content_index is None or key is None:
+            return None
+        digest = content_digest(message.get('text') or message.get('caption'))
+        outcome, previous = self.content_index.exchange(key, digest)
+        if outcome != CONTENT_UNCHANGED:
+            self.digests.append((key, digest, previous))
+        return outcome
+
+    def release(self):
+        """Undo everything recorded for this update; errors are logged, not raised."""
+        try:
+            for key in self.keys:
+                self.deduplicator.forget(key)
+            for key, digest, previous in self.digests:
+                self.content_index.restore(key, digest, previous)
+        except Exception as e:
+            logger.error(f"Could not release de-duplication keys {self.keys}: {e}")
+        self.keys = []
+        self.digests = []
+
+def extract_forward_data(message):
+    """Extract data from forwarded Telegram message."""
+    forward_origin = message.get('forward_origin', {})
+
+    # Base data
+    data = {
+        'id': str(message.get('message_id', '')),
+        'content': message.get('text', '') or message.get('caption', ''),
+        'has_media': bool(message.get('photo') or message.get('document') or message.get('video')),
+        'media_type': get_media_type(message),
+        'forwarded_by': message.get('from', {}).get('username', 'Unknown'),
+        'forwarded_at': message.get('date', ''),
+        'channel': 'telegram',
+        'channel_username': 'Unknown',
+        'author': 'Unknown',
+        'timestamp': None,
+        'url': '',
+        'chat_id': message.get('chat', {}).get('id')
+    }
+    # Parts of an album share this; they are merged into one row before batching
+    if message.get('media_group_id'):
+        data['media_group_id'] = str(message['media_group_id'])
+
+    # Extract origin information
+    origin_type = forward_origin.get('type')
+    if origin_type == 'channel':
+        chat = forward_origin.get('chat', {})
+        data['channel_username'] = f"@{chat.get('username', '')}" if chat.get('username') else chat.get('title', 'Channel')
+        data['author'] = chat.get('title', 'Channel')
+        data['timestamp'] = forward_origin.get('date', '')
+        if chat.get('username'):
+            data['url'] = f"https://t.me/{chat['username']}/{forward_origin.get('message_id', '')}"
+
+    elif origin_type == 'user':
+        sender = forward_origin.get('sender_user', {})
+        if sender:
+            first_name = sender.get('first_name', '')
+            last_name = sender.get('last_name', '')
+            username = sender.get('username', '')
+            data['author'] = f"{first_name} {last_name}".strip() or username or 'User'
+            data['timestamp'] = forward_origin.get('date', '')
+
+    return data
+
+def get_media_type(message):
+    """Get media type from message."""
+    if message.get('photo'):
+        return 'photo'
+    elif message.get('document'):
+        return 'document'
+    elif message.get('video'):
+        return 'video'
+    elif message.get('audio'):
+        return 'audio'
+    elif message.get('voice'):
+        return 'voice'
+    return None
+
+def merge_media_group(parts: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Merge the rows of one album (updates sharing ``media_group_id``) into a single row.
+
+    Usually only one part carries the caption; that part supplies the
+    content, ID and URL of the merged row.
+
+    Args:
+        parts: Rows built by ``extract_forward_data`` for the album's messages
+
+    Returns:
+        Row with the caption part's fields plus ``media`` (one entry per
+        part, in message order) and ``media_count``
+    """
+    parts = sorted(parts, key=lambda part: int(part['id']) if str(part.get('id', '')).isdigit() else 0)
+    captioned = next((part for part in parts if part.get('content')), parts[0])
+    merged = dict(captioned)
+    merged['media'] = [{'id': part.get('id'), 'media_type': part.get('media_type')} for part in parts]
+    merged['media_count'] = len(parts)
+    merged['has_media'] = any(part.get('has_media') for part in parts)
+    media_types = {part.get('media_type') for part in parts if part.get('media_type')}
+    if len(media_types) > 1:
+        merged['media_type'] = 'mixed'
+    return merged
+
+def extract_direct_data(message):
+    """Extract minimal data from a direct (not forwarded) text message."""
+    return {
+        'id': str(message.get('message_id')),
+        'content': message.get('text'),
+        'channel_username': 'DirectMessage',
+        'author': message.get('from', {}).get('username', 'User'),
+        'timestamp': message.get('date'),
+        'channel': 'telegram'
+    }
+
+def extract_channel_post_data(message):
+    """Extract data from a post in a channel the bot is a member of."""
+    chat = message.get('chat', {})
+    return {
+        'id': str(message.get('message_id', '')),
+        'content': message.get('text', '') or message.get('caption', ''),
+        'has_media': bool(message.get('photo') or message.get('document') or message.get('video')),
+        'media_type': get_media_type(message),
+        'channel': 'telegram',
+        'channel_username': f"@{chat['username']}" if chat.get('username') else chat.get('title', 'Channel'),
+        'author': chat.get('title', 'Channel'),
+        'timestamp': message.get('date', ''),
+        'url': f"https://t.me/{chat['username']}/{message.get('message_id', '')}" if chat.get('username') else ''
+    }
+
+def parse_edit(update_json: Dict[str, Any], content_index=None,
+               claims: Optional[UpdateClaims] = None) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Turn an ``edited_message`` or ``edited_channel_post`` update into an update row.
+
+    Edits whose normalized text matches what was last seen for the origin
+    message are dropped. Edits of messages the index does not know (evicted,
+    or seen before a restart) are forwarded, since they may have changed.
+
+    Args:
+        update_json: Raw update from the webhook
+        content_index: ContentHashIndex (or remote equivalent); without one edits are ignored
+        claims: Records the digest so it can be restored if the row is not accepted
+
+    Returns:
+        Tuple of (row marked ``is_update`` or None, response body)
+    """
+    if content_index is None:
+        return None, {'status': 'ignored'}
+    claims = claims or UpdateClaims(content_index=content_index)
+    channel_post = 'edited_channel_post' in update_json
+    message = update_json['edited_channel_post' if channel_post else 'edited_message']
+    if not (message.get('text') or message.get('caption')):
+        return None, {'status': 'ignored'}
+    if claims.observe(message_origin_key(message, channel_post), message) == CONTENT_UNCHANGED:
+        return None, {'status': 'unchanged', 'source': 'edit'}
+
+    if channel_post:
+        data = extract_channel_post_data(message)
+    elif 'forward_origin' in message:
+        data = extract_forward_data(message)
+    else:
+        data = extract_direct_data(message)
+        data['content'] = message.get('text') or message.get('caption')
+    data['is_update'] = True
+    data['edited_at'] = message.get('edit_date')
+    return data, {'status': 'success', 'source': 'edit'}
+
+def parse_update(update_json: Dict[str, Any], deduplicator=None,
+                 content_index=None) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any], UpdateClaims]:
+    """
+    Turn a Telegram update into a message row for the batcher.
+
+    Args:
+        update_json: Raw update from the webhook
+        deduplicator: Optional UpdateDeduplicator for redeliveries and repeated forwards
+        content_index: Optional ContentHashIndex; enables edit updates and
+            lets a re-forward through when the post's text has changed
+
+    Returns:
+        Tuple of (row to batch or None, response body to return to Telegram
+        once the row has been accepted, UpdateClaims to release if it is not)
+    """
+    claims = UpdateClaims(deduplicator, content_index)
+    try:
+        data, result = _parse_update(update_json, claims)
+    except Exception:
+        # A half-parsed update is not accepted either
+        claims.release()
+        raise
+    return data, result, claims
+
+def _parse_update(update_json: Dict[str, Any], claims: UpdateClaims) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+    # Telegram redelivers updates when we answer slowly
+    if claims.check_and_add(update_key(update_json)):
+        return None, {'status': 'duplicate', 'source': 'update_id'}
+
+    # Handle Telegram Update object
+    if 'message' in update_json:
+        message = update_json['message']
+
+        # 1. Process as forwarded message (original logic)
+        if 'forward_origin' in message:
+            # Several users often forward the same channel post
+            duplicate = claims.check_and_add(forward_origin_key(message))
+            change = claims.observe(forward_origin_key(message), message)
+            if duplicate:
+                if change != CONTENT_CHANGED:
+                    return None, {'status': 'duplicate', 'source': 'forward'}
+                # Re-forward of a post that was edited since it was last seen
+                data = extract_forward_data(message)
+                data['is_update'] = True
+                return data, {'status': 'success', 'source': 'forward_update'}
+            return extract_forward_data(message), {'status': 'success', 'source': 'forward'}
+
+        # 2. Process as direct message (if text exists but not forwarded)
+        elif 'text' in message:
+            claims.observe(message_origin_key(message), message)
+            return extract_direct_data(message), {'status': 'success', 'source': 'direct'}
+
+    elif 'edited_message' in update_json or 'edited_channel_post' in update_json:
+        return parse_edit(update_json, claims.content_index, claims)
+
+    return None, {'status': 'ignored'}
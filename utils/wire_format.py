@@ -0,0 +1,132 @@
+"""
+Compact columnar encoding for batch_ingest payloads.
+
+Instead of a list of message objects that repeat every key, a columnar
+payload carries one array per field. Fields whose values repeat a lot
+(channel, channel_username, forwarded_by, ...) are dictionary-encoded as a
+list of distinct values plus one integer code per message. The columnar
+body can additionally be gzipped and base64-encoded into ``data``; Apps
+Script unpacks it with ``Utilities.ungzip`` in ``decodeBatchMessages``.
+"""
+
+import base64
+import gzip
+import json
+from typing import Any, Dict, List
+
+COLUMNAR_FORMAT = 'columnar-v1'
+# Values of BATCH_PAYLOAD_FORMAT
+PAYLOAD_FORMATS = ('rows', 'columnar', 'columnar+gzip')
+
+def encode_columns(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Encode messages as columns, dictionary-encoding repetitive fields.
+
+    Missing fields are encoded as null and dropped again on decode.
+
+    Args:
+        messages: List of message dictionaries
+
+    Returns:
+        Columnar body with ``format``, ``count`` and ``columns``
+    """
+    fields = []
+    for message in messages:
+        for key in message:
+            if key not in fields:
+                fields.append(key)
+
+    count = len(messages)
+    columns = {}
+    for field in fields:
+        values = [message.get(field) for message in messages]
+        index = {}
+        for value in values:
+            if isinstance(value, str) and value not in index:
+                index[value] = len(index)
+        if index and len(index) * 2 <= count and all(isinstance(v, str) or v is None for v in values):
+            columns[field] = {
+                'dict': list(index),
+                'codes': [-1 if v is None else index[v] for v in values]
+            }
+        else:
+            columns[field] = values
+    return {'format': COLUMNAR_FORMAT, 'count': count, 'columns': columns}
+
+def decode_columns(body: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Decode a body produced by ``encode_columns`` back into messages.
+
+    Args:
+        body: Columnar body
+
+    Returns:
+        List of message dictionaries
+    """
+    messages = [{} for _ in range(body['count'])]
+    for field, column in body['columns'].items():
+        if isinstance(column, dict):
+            values = [None if code < 0 else column['dict'][code] for code in column['codes']]
+        else:
+            values = column
+        for message, value in zip(messages, values):
+            if value is not None:
+                message[field] = value
+    return messages
+
+def check_payload_format(payload_format: str) -> str:
+    """
+    Validate a payload format, typically BATCH_PAYLOAD_FORMAT at startup.
+
+    Args:
+        payload_format: Requested format
+
+    Returns:
+        The format, unchanged
+
+    Raises:
+        ValueError: If the format is not one of PAYLOAD_FORMATS
+    """
+    if payload_format not in PAYLOAD_FORMATS:
+        raise ValueError(f"Unknown batch payload format {payload_format!r}; use one of {', '.join(PAYLOAD_FORMATS)}")
+    return payload_format
+
+def build_batch_payload(batch_id: str, messages: List[Dict[str, Any]], payload_format: str = 'rows',
+                        extraction: str = 'gas') -> Dict[str, Any]:
+    """
+    Build a finalizing batch_ingest payload in the requested format.
+
+    Args:
+        batch_id: Batch identifier
+        messages: Messages in the batch
+        payload_format: 'rows' (list of objects), 'columnar' or 'columnar+gzip'
+        extraction: 'local' if the messages carry extracted ``products``, else 'gas'
+
+    Returns:
+        Payload dictionary ready to be JSON-encoded
+    """
+    payload = {
+        "mode": "batch_ingest",
+        "batch_id": batch_id,
+        "transmission_complete": True,
+        "expected_count": len(messages)
+    }
+    if extraction == 'local':
+        payload['extraction'] = 'local'
+    if payload_format == 'rows':
+        payload['messages'] = messages
+        return payload
+
+    body = encode_columns(messages)
+    if payload_format == 'columnar+gzip':
+        raw = json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        payload['encoding'] = COLUMNAR_FORMAT
+        payload['compression'] = 'gzip'
+        payload['data'] = base64.b64encode(gzip.compress(raw)).decode('ascii')
+    elif payload_format == 'columnar':
+        payload['encoding'] = COLUMNAR_FORMAT
+        payload['columns'] = body['columns']
+        payload['count'] = body['count']
+    else:
+        raise ValueError(f"Unknown batch payload format: {payload_format}")
+    return payload
@@ -5,10 +5,10 @@ No continuous polling - uses Telegram's webhook system.
 """
 
 import logging
-import requests
 from telegram import Update, Bot
 from telegram.ext import Application, MessageHandler, filters, ContextTypes
 from utils.config import load_config
+from utils.http_client import get_http_client
 from utils.logger import setup_logger
 
 class WebhookBot:
@@ -128,10 +128,10 @@ class WebhookBot:
             # Prefer fast ingestion by default; products handled asynchronously
             if 'processing_mode' not in data:
                 data['processing_mode'] = 'message_only'
-            response = requests.post(
+            response = get_http_client().post(
                 self.web_app_url,
+                endpoint='apps_script',
                 json=data,
-                timeout=30,
                 headers={'Content-Type': 'application/json'}
             )
 